@@ -0,0 +1,27 @@
+"""
+Aggregates of features numeric property values, for "function:property" metrics of aggregate endpoint and grid tiles.
+"""
+from django.db.models import Avg, Max, Min, Sum
+
+from .functions import PercentileCont
+from .indexes import get_property_expression
+
+# Aggregates by metric function, percentiles are pNN functions
+AGGREGATE_FUNCTIONS = {'sum': Sum, 'avg': Avg, 'min': Min, 'max': Max}
+
+
+def get_metric_aggregate(metric, value=None):
+    """
+    Aggregate of a "function:property" metric, on the numeric values of the property or on the value expression
+    if set, values of other types are ignored. None if the metric is invalid
+    """
+    function, _sep, prop = metric.partition(':')
+    if not prop:
+        return None
+
+    value = get_property_expression(prop, 'number') if value is None else value
+    if function in AGGREGATE_FUNCTIONS:
+        return AGGREGATE_FUNCTIONS[function](value)
+    if function[:1] == 'p' and function[1:].isdigit() and 0 <= int(function[1:]) <= 100:
+        return PercentileCont(value, int(function[1:]) / 100)
+    return None
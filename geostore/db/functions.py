@@ -1,7 +1,112 @@
-from django.contrib.gis.db.models import BooleanField
+from django.contrib.gis.db.models import BooleanField, FloatField, GeometryField
+from django.contrib.gis.db.models.functions import GeomOutputGeoFunc
+from django.contrib.postgres.fields import ArrayField
+from django.db.models import Aggregate, CharField, Func, TextField, Value
+from django.db.models.functions import Cast
 from django.db.models.lookups import Transform
 
+try:
+    from django.db.models import JSONField
+except ImportError:  # TODO Remove when dropping Django releases < 3.1
+    from django.contrib.postgres.fields import JSONField
+
 
 class IsEmpty(Transform):
     function = 'ST_ISEMPTY'
     output_field = BooleanField()
+
+
+class JSONBConcat(Func):
+    """ Merge jsonb objects, right keys override left ones """
+    arg_joiner = ' || '
+    template = '(%(expressions)s)'
+    output_field = JSONField()
+
+
+class JSONBTypeOf(Func):
+    function = 'jsonb_typeof'
+    output_field = CharField()
+
+
+class TrigramWordSimilar(Func):
+    """ Text containing a word similar to the searched one, can use a gin_trgm_ops index on the text """
+    arg_joiner = ' %%> '
+    template = '(%(expressions)s)'
+    output_field = BooleanField()
+
+
+class ConcatWords(Func):
+    """ Space separated texts, immutable unlike CONCAT so it can be indexed. Texts should not be NULL """
+    arg_joiner = " || ' ' || "
+    template = '(%(expressions)s)'
+    output_field = TextField()
+
+
+class ReducePrecision(GeomOutputGeoFunc):
+    """ Round coordinates to a grid size, snapped to the grid with PostGIS < 3.1 """
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        if connection.ops.spatial_version < (3, 1):
+            extra_context['function'] = 'ST_SNAPTOGRID'
+        return self.as_sql(compiler, connection, **extra_context)
+
+
+class GeographyDWithin(Func):
+    """ Geometries within a distance in meters, measured on the spheroid. Can not use geometry indexes """
+    function = 'ST_DWITHIN'
+    output_field = BooleanField()
+
+    def __init__(self, expression, geometry, distance, **extra):
+        geography = GeometryField(geography=True)
+        super().__init__(Cast(expression, geography),
+                         Cast(Value(geometry, output_field=GeometryField(srid=geometry.srid)), geography),
+                         Value(distance), **extra)
+
+
+class GeographyDistance(Func):
+    """ Distance in meters between geometries, measured on the spheroid """
+    function = 'ST_DISTANCE'
+    output_field = FloatField()
+
+    def __init__(self, expression, geometry, **extra):
+        geography = GeometryField(geography=True)
+        super().__init__(Cast(expression, geography),
+                         Cast(Value(geometry, output_field=GeometryField(srid=geometry.srid)), geography),
+                         **extra)
+
+
+class PercentileCont(Aggregate):
+    """ Continuous percentile of values, fraction between 0 and 1 """
+    function = 'PERCENTILE_CONT'
+    template = '%(function)s(%(fraction)s) WITHIN GROUP (ORDER BY %(expressions)s)'
+    output_field = FloatField()
+
+    def __init__(self, expression, fraction, **extra):
+        super().__init__(expression, fraction=float(fraction), **extra)
+
+
+class GridCell(Func):
+    """
+    Center of the grid cell containing a point, as [x, y] array in point SRID units. Cells are squares
+    of size width, or pointy-top hexagons of size circumradius: the closest center between two rectangular
+    lattices. Computed with arithmetic, so it does not require ST_SquareGrid / ST_HexagonGrid (PostGIS 3.1)
+    """
+    output_field = ArrayField(FloatField())
+    cell = '(SELECT ST_X(point) AS x, ST_Y(point) AS y, size FROM (SELECT %(expressions)s) AS cell (point, size))'
+    templates = {
+        'square': (
+            '(SELECT ARRAY[(FLOOR(x / size) + 0.5) * size, (FLOOR(y / size) + 0.5) * size] '
+            f'FROM {cell} AS cell)'
+        ),
+        'hexagon': (
+            '(SELECT CASE WHEN (x - a_x) ^ 2 + (y - a_y) ^ 2 <= (x - b_x) ^ 2 + (y - b_y) ^ 2 '
+            'THEN ARRAY[a_x, a_y] ELSE ARRAY[b_x, b_y] END FROM ('
+            'SELECT x, y, ROUND(x / width) * width AS a_x, ROUND(y / height) * height AS a_y, '
+            '(FLOOR(x / width) + 0.5) * width AS b_x, (FLOOR(y / height) + 0.5) * height AS b_y FROM ('
+            f'SELECT x, y, SQRT(3) * size AS width, 3 * size AS height FROM {cell} AS cell'
+            ') AS cell) AS cell)'
+        ),
+    }
+
+    def __init__(self, point, size, shape='square', **extra):
+        super().__init__(point, Value(float(size)), template=self.templates[shape], **extra)
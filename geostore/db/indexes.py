@@ -0,0 +1,134 @@
+"""
+Partial expression indexes on feature properties of layers with a schema.
+
+Each sortable schema property gets a btree index on its typed value, restricted to layer features,
+used by ordering and range filters built with ``get_property_expression``. Searchable properties text
+gets a trigram index when fuzzy search is enabled and the pg_trgm extension is installed.
+
+Indexes are always built concurrently, out of transactions: on the layer partition, or the default one,
+once features table is partitioned.
+"""
+import logging
+from hashlib import md5
+
+from django.apps import apps
+from django.db import connection
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.db.models import BooleanField, Case, FloatField, Index, Q, Value, When
+from django.db.models.fields.json import KeyTextTransform, KeyTransform
+from django.db.models.functions import Cast
+from django.db.models.lookups import Exact
+
+from .functions import JSONBTypeOf
+from .partitioning import get_default_partition_name, get_layer_partition, is_feature_table_partitioned
+
+logger = logging.getLogger(__name__)
+
+# JSON schema types cast from their text value, and their jsonb type
+PROPERTY_CASTS = {
+    'integer': ('number', FloatField()),
+    'number': ('number', FloatField()),
+    'boolean': ('boolean', BooleanField()),
+}
+
+
+def get_property_expression(prop, prop_type):
+    """
+    Return typed value expression of a feature property, None if the JSON schema type is not sortable.
+    Values not matching the type are NULL, so casts never fail.
+    """
+    if prop_type == 'string':
+        return KeyTextTransform(prop, 'properties')
+
+    if prop_type not in PROPERTY_CASTS:
+        return None
+
+    json_type, output_field = PROPERTY_CASTS[prop_type]
+    return Case(
+        When(Exact(JSONBTypeOf(KeyTransform(prop, 'properties')), Value(json_type)),
+             then=Cast(KeyTextTransform(prop, 'properties'), output_field)),
+        output_field=output_field,
+    )
+
+
+def get_index_prefix(layer_id):
+    return f'gs_prop_{int(layer_id)}_'
+
+
+def has_trigram_extension():
+    """ pg_trgm is optional, fuzzy search needs it to be created in the database """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT EXISTS(SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+        return cursor.fetchone()[0]
+
+
+def get_layer_properties_indexes(layer):
+    """ Return indexes expected by the layer schema, by name """
+    indexes = {}
+    for prop in layer.schema.get('properties', {}):
+        prop_type = layer.get_property_type(prop)
+        expression = get_property_expression(prop, prop_type)
+        if expression is None:
+            continue
+        digest = md5(f'{prop}:{prop_type}'.encode()).hexdigest()[:8]
+        name = f'{get_index_prefix(layer.pk)}{digest}'
+        indexes[name] = Index(expression, name=name, condition=Q(layer_id=layer.pk))
+
+    search_text = layer.get_search_text()
+    if search_text is not None and layer.settings.get('search', {}).get('trigram') and has_trigram_extension():
+        digest = md5(f'trigram:{sorted(layer.get_search_properties())}'.encode()).hexdigest()[:8]
+        name = f'{get_index_prefix(layer.pk)}{digest}'
+        indexes[name] = GinIndex(OpClass(search_text, name='gin_trgm_ops'), name=name, condition=Q(layer_id=layer.pk))
+    return indexes
+
+
+def get_layer_features_table(layer_id):
+    """ Table holding layer features, concurrent index builds are not supported by partitioned tables """
+    if not is_feature_table_partitioned():
+        return apps.get_model('geostore', 'Feature')._meta.db_table
+    return get_layer_partition(layer_id) or get_default_partition_name()
+
+
+def get_existing_properties_indexes(layer_id, table=None):
+    """ Return names of layer properties indexes, on the table if set, else on any table """
+    prefix = get_index_prefix(layer_id).replace('_', r'\_')
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT indexname FROM pg_indexes
+            WHERE schemaname = current_schema() AND indexname LIKE %s AND (%s IS NULL OR tablename = %s)
+        """, [f'{prefix}%', table, table])
+        return {row[0] for row in cursor.fetchall()}
+
+
+def sync_properties_indexes(layer, expected=None):
+    """
+    Create missing and drop outdated properties indexes of a layer, concurrently without locking
+    features writes. Indexes are never built in a transaction, where they would lock features table:
+    nothing is done, and False is returned.
+    """
+    if connection.in_atomic_block:
+        logger.warning('Properties indexes of layer %s can not be built concurrently in a transaction', layer.pk)
+        return False
+
+    Feature = apps.get_model('geostore', 'Feature')
+    expected = get_layer_properties_indexes(layer) if expected is None else expected
+    existing = get_existing_properties_indexes(layer.pk)
+    if not existing and not expected:
+        return set(), set()
+    table = get_layer_features_table(layer.pk)
+    # indexes left on the default partition of layers moved into their own partition are built again
+    outdated = existing - get_existing_properties_indexes(layer.pk, table)
+
+    with connection.schema_editor(atomic=False) as schema_editor:
+        for name in (existing - expected.keys()) | outdated:
+            schema_editor.remove_index(Feature, Index(fields=['properties'], name=name), concurrently=True)
+        for name in expected.keys() - (existing - outdated):
+            statement = expected[name].create_sql(Feature, schema_editor, concurrently=True)
+            statement.rename_table_references(Feature._meta.db_table, table)
+            schema_editor.execute(statement)
+
+    return expected.keys() - existing, existing - expected.keys()
+
+
+def drop_properties_indexes(layer):
+    return sync_properties_indexes(layer, expected={})
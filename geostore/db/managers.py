@@ -1,9 +1,188 @@
-from django.db.models import QuerySet
+import json
+import operator
+from functools import reduce
+from math import cos, radians
+
+from django.apps import apps
+from django.contrib.gis.db.models import GeometryField
+from django.contrib.gis.db.models.functions import AsGeoJSON, GeometryDistance, Transform
+from django.contrib.gis.geos import GEOSGeometry, Polygon
+from django.db import connections
+from django.db.models import F, FloatField, Func, JSONField, Manager, Q, QuerySet, TextField, Value
+from django.db.models.functions import Cast, JSONObject
+
+from geostore import settings as app_settings
+from geostore.db.functions import GeographyDistance, GeographyDWithin, JSONBConcat, ReducePrecision
+from geostore.tiles.funcs import SimplifyPreserveTopology
+
+
+# meters by degree of latitude at equator (lowest), and of longitude at equator
+METERS_BY_LATITUDE_DEGREE = 110574
+METERS_BY_LONGITUDE_DEGREE = 111319.49
 
 
 class FeatureQuerySet(QuerySet):
 
-    def intersects(self, geometry):
-        return self.filter(
-            geom__intersects=geometry
-        )
+    def update(self, **kwargs):
+        if {'geom', 'properties', 'layer', 'layer_id'} & kwargs.keys():
+            self.outdate_layers_statistics()
+        if 'layer' in kwargs or 'layer_id' in kwargs:
+            # moved features change their new layer statistics too
+            layer = kwargs.get('layer', kwargs.get('layer_id'))
+            apps.get_model('geostore', 'LayerStatistics').mark_dirty([getattr(layer, 'pk', layer)])
+        if not {'properties', 'layer'} & kwargs.keys() or 'search_vector' in kwargs:
+            return super().update(**kwargs)
+
+        # search vectors are computed again with properties, as on save
+        Layer = apps.get_model('geostore', 'Layer')
+        layers = Layer.objects.filter(pk__in=[kwargs['layer']] if 'layer' in kwargs
+                                      else self.order_by().values('layer_id'))
+        searchable_layers = [layer for layer in layers if layer.is_searchable]
+        if not searchable_layers:
+            return super().update(**kwargs)
+
+        # updated features may not match filters anymore
+        pks = list(self.values_list('pk', flat=True))
+        count = super().update(**kwargs)
+        for layer in searchable_layers:
+            layer.refresh_search_vectors(self.model._base_manager.filter(pk__in=pks, layer=layer))
+        return count
+
+    update.alters_data = True
+
+    def delete(self):
+        self.outdate_layers_statistics()
+        apps.get_model('geostore', 'FeatureTombstone').record(self)
+        return super().delete()
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def outdate_layers_statistics(self):
+        """ Flag statistics of layers of these features to be computed again on next read """
+        LayerStatistics = apps.get_model('geostore', 'LayerStatistics')
+        LayerStatistics.mark_dirty(self.order_by().values('layer_id'))
+
+    def estimated_count(self, threshold=None):
+        """
+        Return (count, exact). The planner row estimate is returned when it reaches the threshold,
+        an exact count is made otherwise.
+        """
+        if threshold is None:
+            threshold = app_settings.GEOSTORE_ESTIMATED_COUNT_THRESHOLD
+        if not threshold:
+            return self.count(), True
+
+        sql, params = self.order_by().query.sql_with_params()
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        estimate = int(plan[0]['Plan']['Plan Rows'])
+        if estimate < threshold:
+            return self.count(), True
+        return estimate, False
+
+    def with_output_geometry(self, precision=None, tolerance=None, srid=None):
+        """
+        Annotate features with the geometry returned to clients as output_geom: transformed to srid,
+        simplified with tolerance (in srid units), then rounded to precision decimals.
+        Stored geometries are not loaded.
+        """
+        geometry = F('geom')
+        if srid:
+            geometry = Transform(geometry, srid)
+        if tolerance:
+            geometry = SimplifyPreserveTopology(geometry, tolerance)
+        if precision is not None:
+            geometry = ReducePrecision(geometry, 10 ** -precision)
+        return self.defer('geom').annotate(output_geom=geometry)
+
+    def annotate_geojson(self, name='geojson', properties=None, extra_properties=None, geometry='geom', precision=8):
+        """
+        Annotate each feature rendered as GeoJSON Feature text by PostgreSQL. Feature properties
+        (all of them, or the properties expression) are merged over extra_properties (name: value or expression).
+        """
+        properties = properties if properties is not None else F('properties')
+        if extra_properties:
+            properties = JSONBConcat(JSONObject(**{
+                key: value if hasattr(value, 'resolve_expression') else Value(value, output_field=JSONField())
+                for key, value in extra_properties.items()
+            }), properties)
+        return self.annotate(**{name: Cast(JSONObject(
+            type=Value('Feature'),
+            id=F('pk'),
+            geometry=Cast(AsGeoJSON(geometry, precision=precision), JSONField()),
+            properties=properties,
+        ), TextField())})
+
+    def is_geodetic(self):
+        return self.model._meta.get_field('geom').geodetic(connections[self.db])
+
+    def to_internal_srid(self, geometry):
+        if geometry.srid != app_settings.INTERNAL_GEOMETRY_SRID:
+            return geometry.transform(app_settings.INTERNAL_GEOMETRY_SRID, clone=True)
+        return geometry
+
+    def dwithin(self, geometry, distance):
+        """
+        Features at most at distance of the geometry, in meters for geographic geometries.
+        Distance is then measured on the spheroid, after an index filter on the geometry envelope
+        expanded by the distance in degrees.
+        """
+        geometry = self.to_internal_srid(geometry)
+        if not self.is_geodetic():
+            return self.filter(geom__dwithin=(geometry, distance))
+
+        xmin, ymin, xmax, ymax = geometry.extent
+        latitude_delta = distance / METERS_BY_LATITUDE_DEGREE
+        max_latitude = max(abs(ymin), abs(ymax)) + latitude_delta
+        query = Q(GeographyDWithin('geom', geometry, distance))
+        if max_latitude < 89:
+            longitude_delta = distance / (METERS_BY_LONGITUDE_DEGREE * cos(radians(max_latitude)))
+            envelope = Polygon.from_bbox((xmin - longitude_delta, ymin - latitude_delta,
+                                          xmax + longitude_delta, ymax + latitude_delta))
+            envelope.srid = geometry.srid
+            query = Q(geom__bboverlaps=envelope) & query
+        return self.filter(query)
+
+    def nearest(self, geometry, limit, max_distance=None, candidates_factor=4):
+        """
+        The limit features closest to the geometry, annotated and ordered by distance
+        (in meters for geographic geometries). Candidates are found with the index assisted
+        KNN operator <->, then ordered by their exact distance.
+        """
+        geometry = self.to_internal_srid(geometry)
+        candidates = self.dwithin(geometry, max_distance) if max_distance is not None else self
+        candidates = candidates.annotate(knn=GeometryDistance('geom', geometry)) \
+            .order_by('knn').values('pk')[:limit * candidates_factor]
+
+        if self.is_geodetic():
+            distance = GeographyDistance('geom', geometry)
+        else:
+            distance = Func('geom', Value(geometry, output_field=GeometryField(srid=geometry.srid)),
+                            function='ST_DISTANCE', output_field=FloatField())
+        return self.filter(pk__in=candidates).annotate(distance=distance).order_by('distance', 'pk')[:limit]
+
+    def intersects(self, geometry, max_vertices=None):
+        """
+        Features intersecting the geometry. Geometries having more than max_vertices are split
+        with ST_Subdivide, so each small part is matched with the geometry index
+        """
+        if not max_vertices or geometry.dims < 1 or geometry.num_coords <= max_vertices:
+            return self.filter(
+                geom__intersects=geometry
+            )
+
+        with connections[self.db].cursor() as cursor:
+            cursor.execute('SELECT ST_Subdivide(ST_GeomFromEWKB(%s), %s)', [bytes(geometry.ewkb), max_vertices])
+            parts = [GEOSGeometry(part) for part, in cursor.fetchall()]
+        return self.filter(reduce(operator.or_, [Q(geom__intersects=part) for part in parts], Q(pk__in=[])))
+
+
+class FeatureManager(Manager.from_queryset(FeatureQuerySet)):
+    def get_queryset(self):
+        # search vectors are only used in database queries
+        return super().get_queryset().defer('search_vector')
@@ -36,6 +36,19 @@ class LayerBasedModelMixin(BaseUpdatableModel):
             'features_filter': None,  # Json
             'properties_filter': None,  # Array of string
             'features_limit': 10000,
+            'stale_while_revalidate': False,  # Serve previous version tiles while rebuilding them
+            'max_stale': 3600,  # Seconds after a layer update while previous version tiles can be served
+            'heatmap_saturation': 100,  # Points count by pixel displayed with the hottest heatmap colour
+            'grid_shape': 'hexagon',  # Grid tiles cells, 'hexagon' or 'square'
+            'grid_cell_pixels': 32,  # Grid tiles cells width, in pixels
+            'grid_aggregates': None,  # Array of string, eg. ['sum:population', 'p90:income']
+        },
+        # Full-text search attributes
+        'search': {
+            'enabled': False,  # Full-text search of features, instead of properties icontains
+            'properties': None,  # Json, eg. {'name': 'A', 'description': 'C'}, schema string properties if not set
+            'config': 'simple',  # PostgreSQL text search configuration, eg. 'french'
+            'trigram': False,  # Index properties text for fuzzy search
         }
     }
     settings = JSONField(default=dict, blank=True)
@@ -69,11 +82,15 @@ class LayerBasedModelMixin(BaseUpdatableModel):
         the layer if the layer have no geom_type or the geom_type of the layer
         """
         if self.geom_type is None:
-            feature = self.features.first()
-            if feature:
-                return feature.geom.geom_typeid
+            return self.get_features_geom_type()
         return self.geom_type
 
+    def get_features_geom_type(self):
+        """ Return the geometry type of the first feature, None if there is no feature """
+        feature = self.features.first()
+        if feature:
+            return feature.geom.geom_typeid
+
     @cached_property
     def settings_with_default(self):
         return always_merger.merge(deepcopy(self.SETTINGS_DEFAULT), self.settings)
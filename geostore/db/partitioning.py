@@ -0,0 +1,271 @@
+"""
+Opt-in list partitioning of the features table by layer.
+
+Large layers get their own partition so their indexes stay small and they can be
+cleared with TRUNCATE, other layers stay in the default partition. Layers created once partitioned
+get their own partition before having features. The default partition is checked to contain only layers
+existing when partitioned, so attaching those new partitions does not scan it.
+
+PostgreSQL foreign keys can not reference features once partitioned, as the layer is part of their primary key.
+Foreign keys of Django models referencing features are replaced by triggers: referencing rows are checked at
+commit, and deleted with their features.
+"""
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.db import connection, models
+
+
+@contextmanager
+def ddl_cursor():
+    """
+    Check pending deferred constraints first, tables with pending trigger events can not be altered.
+    Constraints get back their declared mode after, PostgreSQL does not tell the mode set before.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        try:
+            yield cursor
+        finally:
+            cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+            cursor.execute("""
+                SELECT quote_ident(namespace.nspname) || '.' || quote_ident(constraint_.conname)
+                FROM pg_constraint AS constraint_
+                JOIN pg_namespace AS namespace ON namespace.oid = constraint_.connamespace
+                WHERE constraint_.condeferrable AND NOT constraint_.condeferred
+            """)
+            immediate = [row[0] for row in cursor.fetchall()]
+            if immediate:
+                cursor.execute(f'SET CONSTRAINTS {", ".join(immediate)} IMMEDIATE')
+
+
+def get_feature_table():
+    return apps.get_model('geostore', 'Feature')._meta.db_table
+
+
+def get_default_partition_name():
+    return f'{get_feature_table()}_default'
+
+
+def get_partition_name(layer_id):
+    return f'{get_feature_table()}_layer_{int(layer_id)}'
+
+
+def is_feature_table_partitioned():
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))
+        """, [get_feature_table()])
+        return cursor.fetchone()[0]
+
+
+def get_layer_partition(layer_id):
+    """ Return the name of the partition dedicated to the layer, None if it has not one """
+    partition = get_partition_name(layer_id)
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM pg_inherits
+                WHERE inhrelid = to_regclass(%s) AND inhparent = to_regclass(%s)
+            )
+        """, [partition, get_feature_table()])
+        return partition if cursor.fetchone()[0] else None
+
+
+def get_feature_references():
+    """ Columns of Django models referencing features with a cascading foreign key, as (table, column) """
+    return sorted(
+        (relation.related_model._meta.db_table, relation.field.column)
+        for relation in apps.get_model('geostore', 'Feature')._meta.related_objects
+        if (relation.many_to_one or relation.one_to_one) and relation.field.db_constraint and relation.on_delete is models.CASCADE
+    )
+
+
+def create_feature_reference_triggers(cursor, references):
+    """ Enforce references to features with triggers, instead of foreign keys """
+    table = get_feature_table()
+    # noinspection SqlResolve
+    cursor.execute(f"""
+        CREATE OR REPLACE FUNCTION {table}_reference_check() RETURNS trigger AS $$
+        DECLARE
+            feature_id bigint;
+        BEGIN
+            EXECUTE format('SELECT ($1).%I', TG_ARGV[0]) USING NEW INTO feature_id;
+            IF feature_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {table} WHERE id = feature_id) THEN
+                RAISE foreign_key_violation
+                USING MESSAGE = format('%s.%s = %s references no feature', TG_TABLE_NAME, TG_ARGV[0], feature_id);
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    cursor.execute(f"""
+        CREATE OR REPLACE FUNCTION {table}_reference_cascade() RETURNS trigger AS $$
+        BEGIN
+            -- features moved to another layer partition are deleted then inserted again
+            IF current_setting('geostore.moving_features', true) IS DISTINCT FROM 'on'
+                    AND NOT EXISTS (SELECT 1 FROM {table} WHERE id = OLD.id) THEN
+                EXECUTE format('DELETE FROM %I WHERE %I = $1', TG_ARGV[0], TG_ARGV[1]) USING OLD.id;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    for referencing_table, column in references:
+        # checked at commit, as Django deferred foreign keys
+        cursor.execute(f"""
+            CREATE CONSTRAINT TRIGGER "{referencing_table[:25]}_{column[:20]}_feature_check"
+            AFTER INSERT OR UPDATE OF "{column}" ON "{referencing_table}" DEFERRABLE INITIALLY DEFERRED
+            FOR EACH ROW EXECUTE FUNCTION {table}_reference_check('{column}')
+        """)
+        # also cloned to partitions created later
+        cursor.execute(f"""
+            CREATE TRIGGER "{referencing_table[:25]}_{column[:20]}_cascade"
+            AFTER DELETE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION {table}_reference_cascade('{referencing_table}', '{column}')
+        """)
+
+
+def partition_feature_table():
+    """
+    Convert the features table into a table partitioned by layer, existing features
+    are kept into its default partition. Nothing is done if it is already partitioned.
+
+    Foreign keys of Django models referencing features are replaced by triggers. ValueError is raised
+    if other foreign keys reference features, as their integrity could not be kept.
+    """
+    if is_feature_table_partitioned():
+        return False
+
+    table = get_feature_table()
+    default_partition = get_default_partition_name()
+    references = get_feature_references()
+    with ddl_cursor() as cursor:
+        cursor.execute("""
+            SELECT constraint_.conrelid::regclass::text, attribute.attname, constraint_.conname
+            FROM pg_constraint AS constraint_
+            JOIN pg_attribute AS attribute
+                ON attribute.attrelid = constraint_.conrelid AND attribute.attnum = constraint_.conkey[1]
+            WHERE constraint_.contype = 'f' AND constraint_.confrelid = to_regclass(%s)
+        """, [table])
+        foreign_keys = cursor.fetchall()
+        unknown = sorted(f'{referencing_table}.{column}' for referencing_table, column, constraint in foreign_keys
+                         if (referencing_table, column) not in references)
+        if unknown:
+            raise ValueError(f'Foreign keys referencing features can not be replaced by triggers: {", ".join(unknown)}')
+
+        for referencing_table, column, constraint in foreign_keys:
+            cursor.execute(f'ALTER TABLE {referencing_table} DROP CONSTRAINT "{constraint}"')
+
+        cursor.execute("""
+            SELECT indexname, indexdef FROM pg_indexes
+            WHERE schemaname = current_schema() AND tablename = %s AND indexname NOT IN (
+                SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype IN ('p', 'u')
+            )
+        """, [table, table])
+        indexes = cursor.fetchall()
+
+        cursor.execute(f'ALTER TABLE {table} RENAME TO {default_partition}')
+        # keep original index names on the partitioned table, so migrations still find them
+        for index, definition in indexes:
+            cursor.execute(f'ALTER INDEX "{index}" RENAME TO "{index[:54]}_default"')
+
+        cursor.execute(f'''
+            CREATE TABLE {table} (
+                LIKE {default_partition} INCLUDING DEFAULTS INCLUDING IDENTITY INCLUDING CONSTRAINTS INCLUDING STORAGE
+            ) PARTITION BY LIST (layer_id)
+        ''')
+        cursor.execute(f'ALTER TABLE {table} ADD PRIMARY KEY (id, layer_id)')
+        cursor.execute(f'''
+            ALTER TABLE {table} ADD FOREIGN KEY (layer_id) REFERENCES {apps.get_model('geostore', 'Layer')._meta.db_table} (id)
+            DEFERRABLE INITIALLY DEFERRED
+        ''')
+        # identity sequence of the new table continues the existing one
+        cursor.execute(f'''
+            SELECT setval(pg_get_serial_sequence(%s, 'id'), COALESCE(MAX(id), 0) + 1, false) FROM {default_partition}
+        ''', [table])
+        cursor.execute(f'ALTER TABLE {default_partition} ALTER COLUMN id DROP IDENTITY IF EXISTS')
+        # layers created later get their own partition
+        cursor.execute(f'''
+            ALTER TABLE {default_partition} ADD CONSTRAINT {default_partition}_layer_id_check
+            CHECK (layer_id <= {int(get_max_layer_id(cursor))})
+        ''')
+        cursor.execute(f'ALTER TABLE {table} ATTACH PARTITION {default_partition} DEFAULT')
+
+        for index, definition in indexes:
+            # definitions target the table name, now the partitioned one.
+            # Equivalent indexes of the default partition are attached, not built again
+            cursor.execute(definition)
+
+        create_feature_reference_triggers(cursor, references)
+    return True
+
+
+def get_max_layer_id(cursor):
+    cursor.execute(f'SELECT COALESCE(MAX(id), 0) FROM {apps.get_model("geostore", "Layer")._meta.db_table}')
+    return cursor.fetchone()[0]
+
+
+def create_layer_partition(layer_id, new_layer=False):
+    """
+    Create the partition dedicated to the layer and move its features from the default partition.
+
+    Partitions of new layers, created after partitioning and without features yet, are attached without
+    any scan. Others are moved with a scan of the default partition, which does not block its writes.
+    """
+    if get_layer_partition(layer_id):
+        return False
+
+    table = get_feature_table()
+    default_partition = get_default_partition_name()
+    partition = get_partition_name(layer_id)
+    layer_id = int(layer_id)
+    with ddl_cursor() as cursor:
+        cursor.execute(f'''
+            CREATE TABLE {partition} (
+                LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE,
+                CHECK (layer_id = {layer_id})
+            )
+        ''')
+        if new_layer:
+            # the default partition check excludes it already
+            cursor.execute(f'ALTER TABLE {table} ATTACH PARTITION {partition} FOR VALUES IN ({layer_id})')
+            return True
+
+        cursor.execute(f'INSERT INTO {partition} SELECT * FROM {default_partition} WHERE layer_id = %s', [layer_id])
+        # moved features keep rows referencing them
+        cursor.execute("SELECT set_config('geostore.moving_features', 'on', true)")
+        cursor.execute(f'DELETE FROM {default_partition} WHERE layer_id = %s', [layer_id])
+        cursor.execute("SELECT set_config('geostore.moving_features', 'off', true)")
+        # validated before attaching, without the exclusive lock attach would hold during its own scan
+        exclude_constraint = f'{default_partition}_layer_{layer_id}_check'
+        cursor.execute(f'''
+            ALTER TABLE {default_partition} ADD CONSTRAINT {exclude_constraint} CHECK (layer_id <> {layer_id}) NOT VALID
+        ''')
+        cursor.execute(f'ALTER TABLE {default_partition} VALIDATE CONSTRAINT {exclude_constraint}')
+        cursor.execute(f'ALTER TABLE {table} ATTACH PARTITION {partition} FOR VALUES IN ({layer_id})')
+        cursor.execute(f'ALTER TABLE {default_partition} DROP CONSTRAINT {exclude_constraint}')
+    return True
+
+
+def truncate_layer_partition(layer_id):
+    """ Empty the partition dedicated to the layer, return False if it has not one """
+    partition = get_layer_partition(layer_id)
+    if not partition:
+        return False
+
+    with ddl_cursor() as cursor:
+        cursor.execute(f'TRUNCATE {partition}')
+    return True
+
+
+def drop_layer_partition(layer_id):
+    """ Detach and drop the partition dedicated to the layer """
+    partition = get_layer_partition(layer_id)
+    if not partition:
+        return False
+
+    with ddl_cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {get_feature_table()} DETACH PARTITION {partition}')
+        cursor.execute(f'DROP TABLE {partition}')
+    return True
@@ -0,0 +1,64 @@
+"""
+Database router sending reads of read only geostore views to a replica.
+
+Add 'geostore.db.routers.ReadReplicaRouter' to DATABASE_ROUTERS and set GEOSTORE_READ_DATABASE
+to the replica alias. Views using geostore.views.mixins.ReadDatabaseMixin route their reads
+with read_database(), other reads and all writes stay on the default database. Migrations are not
+applied to the replica.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import DEFAULT_DB_ALIAS
+
+from .. import settings as app_settings
+
+_read_database = ContextVar('geostore_read_database', default=None)
+
+
+@contextmanager
+def read_database(alias):
+    """ Route geostore models reads to the alias in this context, None keeps the default routing """
+    token = _read_database.set(alias)
+    try:
+        yield
+    finally:
+        _read_database.reset(token)
+
+
+def get_read_database():
+    return _read_database.get()
+
+
+class ReadReplicaRouter:
+    def is_replica_instance(self, hints):
+        instance = hints.get('instance')
+        return instance is not None and app_settings.GEOSTORE_READ_DATABASE is not None \
+            and instance._state.db == app_settings.GEOSTORE_READ_DATABASE
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != 'geostore':
+            return None
+        alias = _read_database.get()
+        if alias:
+            return alias
+        # related objects of replica instances are read from the primary out of read only views
+        return DEFAULT_DB_ALIAS if self.is_replica_instance(hints) else None
+
+    def db_for_write(self, model, **hints):
+        # replica instances are saved to the primary
+        if model._meta.app_label == 'geostore' and self.is_replica_instance(hints):
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replica schema is replicated from the primary
+        if app_settings.GEOSTORE_READ_DATABASE is not None and db == app_settings.GEOSTORE_READ_DATABASE:
+            return False
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, app_settings.GEOSTORE_READ_DATABASE}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
@@ -3,15 +3,26 @@ try:
     from django.db.models import JSONField
 except ImportError:  # TODO Remove when dropping Django releases < 3.1
     from django.contrib.postgres.fields import JSONField
+from django.contrib.gis.gdal.error import GDALException
+from django.contrib.gis.geos import GEOSException, GEOSGeometry, Polygon
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramWordSimilarity
 from django.core.exceptions import FieldDoesNotExist
-from django.db.models import Q
+from django.db.models import F, FloatField, Q, Value
+from django.db.models.functions import Cast
+from django.utils.translation import gettext as _
+from rest_framework.exceptions import ValidationError
 from rest_framework.filters import BaseFilterBackend, OrderingFilter, SearchFilter
+from rest_framework.settings import api_settings
 from functools import reduce
 
+from .db.functions import TrigramWordSimilar
+from .db.indexes import has_trigram_extension
+
 
 class JSONFieldFilterBackend(BaseFilterBackend):
-    def filter_queryset(self, request, queryset, view):
-        query = Q()
+    def get_filter_params(self, request, queryset):
+        """ Query params filtering on a JSON field of the queryset model """
+        params = {}
         for param_name, param_value in request.query_params.items():
             try:
                 field = (queryset.model
@@ -21,15 +32,95 @@ class JSONFieldFilterBackend(BaseFilterBackend):
                 pass
             else:
                 if isinstance(field, JSONField):
-                    sub_query = Q(**{param_name: param_value})
-                    try:
-                        sub_query |= Q(**{param_name: int(param_value)})
-                    except ValueError:
-                        pass
-                    query &= sub_query
+                    params[param_name] = param_value
+        return params
+
+    def is_filtered(self, request, queryset):
+        return bool(self.get_filter_params(request, queryset))
+
+    def filter_queryset(self, request, queryset, view):
+        query = Q()
+        for param_name, param_value in self.get_filter_params(request, queryset).items():
+            sub_query = Q(**{param_name: param_value})
+            try:
+                sub_query |= Q(**{param_name: int(param_value)})
+            except ValueError:
+                pass
+            query &= sub_query
         return queryset.filter(query)
 
 
+class SpatialFilterBackend(BaseFilterBackend):
+    """
+    Filter features on their geometry, with GiST index friendly predicates:
+
+    * bbox=xmin,ymin,xmax,ymax : intersecting the bounding box, in WGS84
+    * intersects=<geometry> : intersecting the geometry
+    * within=<geometry> : within the geometry
+    * dwithin=<geometry>&distance=<meters> : at most at distance of the geometry
+
+    Geometries are GeoJSON, WKT or EWKT, WGS84 if SRID is not specified.
+    """
+    bbox_param = 'bbox'
+    intersects_param = 'intersects'
+    within_param = 'within'
+    dwithin_param = 'dwithin'
+    distance_param = 'distance'
+
+    def is_filtered(self, request, queryset):
+        params = request.query_params
+        return any(params.get(param)
+                   for param in (self.bbox_param, self.intersects_param, self.within_param, self.dwithin_param))
+
+    def filter_queryset(self, request, queryset, view):
+        params = request.query_params
+        query = Q()
+
+        if params.get(self.bbox_param):
+            query &= Q(geom__intersects=self.get_bbox(params[self.bbox_param]))
+
+        if params.get(self.intersects_param):
+            query &= Q(geom__intersects=self.get_geometry(self.intersects_param, params[self.intersects_param]))
+
+        if params.get(self.within_param):
+            query &= Q(geom__within=self.get_geometry(self.within_param, params[self.within_param]))
+
+        queryset = queryset.filter(query)
+
+        if params.get(self.dwithin_param):
+            geometry = self.get_geometry(self.dwithin_param, params[self.dwithin_param])
+            queryset = queryset.dwithin(geometry, self.get_distance(params.get(self.distance_param)))
+
+        return queryset
+
+    def get_bbox(self, value):
+        try:
+            bbox = Polygon.from_bbox([float(coordinate) for coordinate in value.split(',')])
+        except (ValueError, TypeError, GEOSException):
+            raise ValidationError({self.bbox_param: _('Bounding box should be xmin,ymin,xmax,ymax')})
+        bbox.srid = 4326
+        return bbox
+
+    @staticmethod
+    def get_geometry(param, value):
+        try:
+            geometry = GEOSGeometry(value)
+        except (GEOSException, GDALException, TypeError, ValueError):
+            raise ValidationError({param: _('Geometry is not valid')})
+        if not geometry.srid:
+            geometry.srid = 4326
+        return geometry
+
+    def get_distance(self, value):
+        try:
+            distance = float(value)
+            if not 0 <= distance < float('inf'):
+                raise ValueError
+        except (TypeError, ValueError):
+            raise ValidationError({self.distance_param: _('Distance in meters is required, as a positive number')})
+        return distance
+
+
 class JSONFieldOrderingFilter(OrderingFilter):
     def get_valid_fields(self, queryset, view, context={}):
         fields = super().get_valid_fields(queryset, view, context=context)
@@ -41,6 +132,25 @@ class JSONFieldOrderingFilter(OrderingFilter):
                 fields.append((f'properties__{prop}', layer.get_property_title(prop)))
         return fields
 
+    def filter_queryset(self, request, queryset, view):
+        ordering = self.get_ordering(request, queryset, view)
+
+        if ordering:
+            layer = view.get_layer()
+            return queryset.order_by(*[self.get_ordering_expression(layer, field) for field in ordering])
+
+        return queryset
+
+    @staticmethod
+    def get_ordering_expression(layer, field):
+        """ Order schema properties by their typed value, to use layer properties indexes """
+        name = field.lstrip('-')
+        if layer and name.startswith('properties__'):
+            expression = layer.get_property_expression(name[len('properties__'):])
+            if expression is not None:
+                return expression.desc() if field.startswith('-') else expression.asc()
+        return field
+
 
 class JSONSearchField(SearchFilter):
     def get_search_fields(self, view, request):
@@ -53,7 +163,27 @@ class JSONSearchField(SearchFilter):
                 fields.append(f'properties__{prop}')
         return fields
 
+    search_mode_param = 'search_mode'
+
     def filter_queryset(self, request, queryset, view):
+        """
+        Search features with layer search vectors if searchable, else properties containing the text.
+        Rank is a double precision, kept exactly by cursors of keyset pagination.
+        """
+        layer = view.get_layer()
+        search_text = request.query_params.get(self.search_param, '').strip()
+        if search_text and layer and layer.is_searchable:
+            if request.query_params.get(self.search_mode_param) == 'fuzzy':
+                if not has_trigram_extension():
+                    raise ValidationError({self.search_mode_param: _('Fuzzy search needs pg_trgm extension.')})
+                queryset = self.fuzzy_search(layer, queryset, search_text)
+            else:
+                queryset = self.full_text_search(layer, queryset, search_text)
+
+            if api_settings.ORDERING_PARAM not in request.query_params:
+                queryset = queryset.order_by('-search_rank', 'pk')
+            return queryset
+
         search_fields = self.get_search_fields(view, request)
         search_terms = self.get_search_terms(request)
         if search_terms:
@@ -64,3 +194,17 @@ class JSONSearchField(SearchFilter):
             return queryset.filter(reduce(operator.or_, filters))
         else:
             return queryset
+
+    @staticmethod
+    def full_text_search(layer, queryset, search_text):
+        """ Match layer search vectors with web search syntax ("quoted text", or, -excluded) """
+        query = SearchQuery(search_text, search_type='websearch', config=layer.get_search_config())
+        return queryset.filter(search_vector=query).annotate(
+            search_rank=Cast(SearchRank(F('search_vector'), query), FloatField()))
+
+    @staticmethod
+    def fuzzy_search(layer, queryset, search_text):
+        """ Match searchable properties text containing words similar to the searched text """
+        text = layer.get_search_text()
+        return queryset.filter(TrigramWordSimilar(text, Value(search_text))) \
+            .annotate(search_rank=Cast(TrigramWordSimilarity(search_text, text), FloatField()))
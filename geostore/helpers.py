@@ -1,7 +1,25 @@
 from django.db import transaction
 
+from geostore import settings as app_settings
 
-def execute_async_func(async_func, args=()):
+
+def execute_async_func(async_func, args=(), countdown=None):
     """ Celery worker can be out of transaction, and raise DoesNotExist """
-    async_func.delay(*args) if not transaction.get_connection().in_atomic_block else transaction.on_commit(
-        lambda: async_func.delay(*args))
+    def delay():
+        return async_func.delay(*args) if countdown is None else async_func.apply_async(args, countdown=countdown)
+
+    delay() if not transaction.get_connection().in_atomic_block else transaction.on_commit(delay)
+
+
+def stream_json_array(items, prefix='[', suffix=']'):
+    """ Stream JSON texts as an array between prefix and suffix, GEOSTORE_GEOJSON_CHUNK_SIZE items at once """
+    yield prefix
+    chunk, separator = [], ''
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= app_settings.GEOSTORE_GEOJSON_CHUNK_SIZE:
+            yield separator + ', '.join(chunk)
+            chunk, separator = [], ', '
+    if chunk:
+        yield separator + ', '.join(chunk)
+    yield suffix
@@ -15,7 +15,7 @@ from geostore.renderers import KMLRenderer
 
 class LayerExportMixin:
     def to_geojson(self):
-        if not self.features.count():
+        if not self.features.exists():
             return
         return serialize('geojson',
                          self.features.all(),
@@ -24,7 +24,7 @@ class LayerExportMixin:
                          properties_field='properties')
 
     def to_shapefile(self):
-        if not self.features.count():
+        if not self.features.exists():
             return
         with TemporaryDirectory() as shape_folder:
             shapes = {}
@@ -71,6 +71,6 @@ class LayerExportMixin:
 
     def to_kml(self):
         from geostore.serializers import FeatureSerializer
-        if not self.features.count():
+        if not self.features.exists():
             return
         return KMLRenderer().render(FeatureSerializer(self.features.all(), many=True).data)
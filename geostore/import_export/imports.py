@@ -91,7 +91,7 @@ class LayerImportMixin:
                 f'{ACCEPTED_PROJECTIONS}')
 
         if update:
-            self.features.all().delete()
+            self.clear_features()
         for feature in geojson.get('features', []):
             properties = feature.get('properties', {})
             identifier = properties.get(id_field, uuid.uuid4())
@@ -103,7 +103,7 @@ class Command(BaseCommand):
         layer = Layer.objects.get_or_create(name=layer_name)[0]
 
         if options['bulk']:
-            layer.features.all().delete()
+            layer.clear_features()
 
         operations = None
         if options['operations']:
@@ -82,7 +82,7 @@ class Command(LayerCommandMixin, BaseCommand):
         if pk or name:
             layer = self._get_layer_by_pk(pk) if pk else self._get_layer_by_name(name)
             if clear_output:
-                layer.features.all().delete()
+                layer.clear_features()
         else:
             layer = Layer.objects.create()
             if verbosity >= 1:
@@ -119,6 +119,7 @@ class Command(LayerCommandMixin, BaseCommand):
             self._sql(sql, layer_ins, layer_out)
         elif options.get('make_valid'):
             self._processing_make_valid(layer_ins, layer_out)
+        layer_out.refresh_statistics()
         if dryrun:
             transaction.savepoint_rollback(sp)
         else:
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from geostore.db.indexes import sync_properties_indexes
+from geostore.db.partitioning import create_layer_partition, partition_feature_table
+from geostore.models import Layer
+
+
+class Command(BaseCommand):
+    help = 'Partition features table by layer, and move large layers into their own partition'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-pk', '--layer-pk',
+                            type=int,
+                            action='append',
+                            default=[],
+                            help="PKs of the layers to move into their own partition")
+        parser.add_argument('--min-features',
+                            type=int,
+                            default=None,
+                            help="Move layers with at least this number of features into their own partition")
+
+    def handle(self, *args, **options):
+        verbosity = options['verbosity']
+        moved_layers = []
+        with transaction.atomic():
+            try:
+                partitioned = partition_feature_table()
+            except ValueError as error:
+                raise CommandError(str(error))
+            if partitioned and verbosity >= 1:
+                self.stdout.write('Features table partitioned by layer')
+
+            min_features = options['min_features']
+            for layer in Layer.objects.all():
+                if layer.pk not in options['layer_pk'] and (
+                        min_features is None or layer.get_statistics().feature_count < min_features):
+                    continue
+                if create_layer_partition(layer.pk):
+                    moved_layers.append(layer)
+                    if verbosity >= 1:
+                        self.stdout.write(f'Partition created for {layer.name}')
+
+        # properties indexes of moved layers are built concurrently on their partition, after commit
+        for layer in moved_layers:
+            sync_properties_indexes(layer)
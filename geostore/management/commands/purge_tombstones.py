@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from geostore.models import FeatureTombstone
+
+
+class Command(BaseCommand):
+    help = 'Delete feature tombstones older than GEOSTORE_TOMBSTONES_RETENTION_DAYS'
+
+    def handle(self, *args, **options):
+        count = FeatureTombstone.purge()
+        if options['verbosity'] >= 1:
+            self.stdout.write(f'{count} feature tombstones deleted')
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from geostore.models import Layer
+
+
+class Command(BaseCommand):
+    help = 'Compute features search vectors of searchable layers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-pk', '--layer-pk',
+                            type=int,
+                            action='append',
+                            default=[],
+                            help="PKs of the layers to refresh, all layers if not set")
+
+    def handle(self, *args, **options):
+        layers = Layer.objects.all()
+        if options['layer_pk']:
+            layers = layers.filter(pk__in=options['layer_pk'])
+
+        for layer in layers:
+            if not layer.is_searchable:
+                continue
+            count = layer.refresh_search_vectors()
+            if options['verbosity'] >= 1:
+                self.stdout.write(f'{count} features search vectors computed for {layer.name}')
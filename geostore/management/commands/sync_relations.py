@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from geostore.models import LayerRelation
+
+
+class Command(BaseCommand):
+    help = 'Compute feature relations of automatic layer relations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-pk', '--relation-pk',
+                            type=int,
+                            action='append',
+                            default=[],
+                            help="PKs of the layer relations to compute, all automatic ones if not set")
+
+    def handle(self, *args, **options):
+        verbosity = options['verbosity']
+        relations = LayerRelation.objects.filter(relation_type__in=('intersects', 'distance'))
+        if options['relation_pk']:
+            relations = relations.filter(pk__in=options['relation_pk'])
+
+        for relation in relations:
+            def progress(done, total):
+                if verbosity >= 2:
+                    self.stdout.write(f'{relation.name}: {done}/{total} origin features')
+
+            created, deleted = relation.sync_features(progress)
+            if verbosity >= 1:
+                self.stdout.write(f'{relation.name}: {created} feature relations created, {deleted} deleted')
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from geostore import settings as app_settings
+from geostore.models import Layer
+from geostore.tiles.helpers import warm_hot_tiles
+
+
+class Command(BaseCommand):
+    help = 'Generate tiles cache of the most requested tiles of layers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-pk', '--layer-pk',
+                            type=int,
+                            action='append',
+                            default=[],
+                            help="PKs of the layers to warm, all layers if not set")
+        parser.add_argument('-n', '--count',
+                            type=int,
+                            default=app_settings.GEOSTORE_TILES_WARM_COUNT,
+                            help="Number of tiles to warm by layer")
+
+    def handle(self, *args, **options):
+        layers = Layer.objects.all()
+        if options['layer_pk']:
+            layers = layers.filter(pk__in=options['layer_pk'])
+
+        for layer in layers:
+            count = warm_hot_tiles(layer, options['count'])
+            if options['verbosity'] >= 1:
+                self.stdout.write(f'{count} tiles warmed for {layer.name}')
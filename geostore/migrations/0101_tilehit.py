@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-18 22:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geostore', '0100_squashed_0047_alter_feature_properties'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TileHit',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('z', models.PositiveSmallIntegerField()),
+                ('x', models.PositiveIntegerField()),
+                ('y', models.PositiveIntegerField()),
+                ('hits', models.PositiveBigIntegerField(default=0)),
+                ('layer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tile_hits', to='geostore.layer', verbose_name='Layer')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['layer', '-hits'], name='geostore_ti_layer_i_187f21_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='tilehit',
+            constraint=models.UniqueConstraint(fields=('layer', 'z', 'x', 'y'), name='tile_hit_unique'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-18 23:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geostore', '0101_tilehit'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LayerStatistics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('feature_count', models.PositiveBigIntegerField(default=0)),
+                ('geom_type', models.IntegerField(choices=[(0, 'Point'), (1, 'LineString'), (3, 'Polygon'), (4, 'MultiPoint'), (5, 'MultiLineString'), (6, 'MultiPolygon'), (7, 'GeometryCollection')], null=True)),
+                ('properties', models.JSONField(blank=True, default=dict)),
+                ('xmin', models.FloatField(null=True)),
+                ('ymin', models.FloatField(null=True)),
+                ('xmax', models.FloatField(null=True)),
+                ('ymax', models.FloatField(null=True)),
+                ('dirty', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('layer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='statistics', to='geostore.layer', verbose_name='Layer')),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-18 23:07
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geostore', '0102_layerstatistics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feature',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='feature',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='search_vector_gin_index'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 23:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geostore', '0103_feature_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='layerstatistics',
+            name='facets',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 23:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geostore', '0104_layerstatistics_facets'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeatureTombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('feature_id', models.IntegerField()),
+                ('identifier', models.CharField(max_length=255)),
+                ('deleted_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('layer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tombstones', to='geostore.layer', verbose_name='Layer')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['layer', 'deleted_at', 'id'], name='geostore_fe_layer_i_becc41_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-18 23:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geostore', '0105_featuretombstone'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingRelationFeature',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('feature_id', models.IntegerField()),
+                ('relation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pending_features', to='geostore.layerrelation', verbose_name='Relation')),
+            ],
+            options={
+                'unique_together': {('relation', 'feature_id')},
+            },
+        ),
+    ]
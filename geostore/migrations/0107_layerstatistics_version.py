@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 00:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geostore', '0106_pendingrelationfeature'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='layerstatistics',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -1,16 +1,17 @@
 import json
 import logging
+import operator
 import uuid
-from itertools import islice
+from datetime import timedelta
+from functools import reduce
 from django import VERSION as django_version
 from django.contrib.auth.models import Group
 from django.contrib.gis.db import models
 from django.contrib.gis.db.models.aggregates import Extent
 from django.contrib.gis.db.models import GeometryField
-from django.contrib.gis.db.models.functions import Transform
-from django.contrib.gis.geos import GEOSGeometry, WKBWriter
+from django.contrib.gis.geos import GEOSGeometry, MultiPoint, Point, WKBWriter
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db.models.functions import Cast
+from django.db.models.functions import Cast, Coalesce, Greatest, Least
 
 from .import_export.exports import LayerExportMixin
 from .import_export.imports import LayerImportMixin
@@ -20,24 +21,36 @@ try:
 except ImportError:  # TODO Remove when dropping Django releases < 3.1
     from django.contrib.postgres.fields import JSONField
 from django.contrib.postgres.indexes import GistIndex, GinIndex
-from django.db import connection, transaction
-from django.db.models import Manager
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db import DEFAULT_DB_ALIAS, connection, transaction
+from django.db.models import Case, Count, F, Value, When
+from django.db.models.fields.json import KeyTextTransform, KeyTransform
 from django.utils.functional import cached_property
 from django.utils.text import slugify
+from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 
-from . import settings as app_settings
-from .db.managers import FeatureQuerySet
+from . import GeometryTypes, settings as app_settings
+from .db.functions import ConcatWords, JSONBConcat
+from .db.managers import METERS_BY_LATITUDE_DEGREE, METERS_BY_LONGITUDE_DEGREE, FeatureManager
 from .db.mixins import BaseUpdatableModel, LayerBasedModelMixin
+from .db.indexes import get_property_expression
+from .db.partitioning import get_layer_partition, truncate_layer_partition
 from .routing.mixins import PgRoutingMixin, UpdateRoutingMixin
-
-from .tiles.funcs import HausdorffDistance
+from .tiles.helpers import schedule_tiles_warming
 from .validators import (validate_geom_type, validate_json_schema,
                          validate_json_schema_data)
 
 logger = logging.getLogger(__name__)
 
 
+def get_search_value(value):
+    """ Text of a property value, as its JSON text expression in database """
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, cls=DjangoJSONEncoder)
+
+
 class Layer(LayerBasedModelMixin, LayerImportMixin, LayerExportMixin, UpdateRoutingMixin):
     name = models.CharField(max_length=256, unique=True, default=uuid.uuid4, verbose_name=_("Name"))
     schema = JSONField(default=dict, blank=True, validators=[validate_json_schema], verbose_name=_("Schema"))
@@ -46,23 +59,65 @@ class Layer(LayerBasedModelMixin, LayerImportMixin, LayerExportMixin, UpdateRout
 
     @transaction.atomic
     def update_geometries(self, features):
-        modified = self.features.none()
+        """
+        Replace properties of the layer features nearest to the given GeoJSON features, in one query.
+        Nearest feature is the one with the smallest Hausdorff distance among bounding box overlapping ones,
+        the last given feature wins if many match the same layer feature.
+        """
+        geometries, properties = [], []
         for new_feature in features:
-            geometry = GEOSGeometry(json.dumps(new_feature['geometry']))
-            nearest_feature = (
-                self.features
-                    .filter(geom__bboverlaps=geometry)  # Bounding Box Overlap
-                    .annotate(hausdorff=HausdorffDistance('geom',
-                                                          geometry))
-                    .order_by('hausdorff')
-                    .first()
-            )
-            feature = self.features.filter(pk=nearest_feature.pk)
-            feature.update(properties=new_feature.get('properties', {}))
-            modified |= feature
+            geometries.append(GEOSGeometry(json.dumps(new_feature['geometry'])).hexewkb.decode())
+            properties.append(json.dumps(new_feature.get('properties', {}), cls=DjangoJSONEncoder))
 
+        feature_table = Feature._meta.db_table
+        with connection.cursor() as cursor:
+            # noinspection SqlResolve
+            cursor.execute(f"""
+                WITH incoming AS (
+                    SELECT ordinality, ST_Transform(geom::geometry, %s) AS geom, properties::jsonb
+                    FROM unnest(%s::text[], %s::text[]) WITH ORDINALITY AS t(geom, properties, ordinality)
+                ),
+                matches AS (
+                    SELECT DISTINCT ON (nearest.id) nearest.id, incoming.properties
+                    FROM incoming
+                    CROSS JOIN LATERAL (
+                        SELECT id FROM {feature_table}
+                        WHERE layer_id = %s AND geom && incoming.geom
+                        ORDER BY ST_HausdorffDistance(geom, incoming.geom)
+                        LIMIT 1
+                    ) AS nearest
+                    ORDER BY nearest.id, incoming.ordinality DESC
+                )
+                UPDATE {feature_table} AS feature
+                SET properties = matches.properties, updated_at = NOW()
+                FROM matches
+                WHERE feature.id = matches.id
+                RETURNING feature.id
+            """, [app_settings.INTERNAL_GEOMETRY_SRID, geometries, properties, self.pk])
+            modified = [row[0] for row in cursor.fetchall()]
+
+        LayerStatistics.mark_dirty([self.pk])
+        modified = self.features.filter(pk__in=modified)
+        if self.is_searchable:
+            self.refresh_search_vectors(modified)
+        schedule_tiles_warming(self.pk)
         return modified
 
+    @transaction.atomic
+    def clear_features(self):
+        """ Delete all layer features, truncating the layer partition if it has its own """
+        if not app_settings.GEOSTORE_FEATURE_PARTITIONING or not get_layer_partition(self.pk):
+            self.features.all().delete()
+            return
+
+        # truncate does not fire delete triggers, rows referencing features are deleted in the same transaction
+        for relation in Feature._meta.related_objects:
+            if relation.many_to_one or relation.one_to_one:
+                relation.related_model._base_manager.filter(**{f'{relation.field.name}__layer': self}).delete()
+        FeatureTombstone.record(self.features.all())
+        truncate_layer_partition(self.pk)
+        LayerStatistics.mark_dirty([self.pk])
+
     @cached_property
     def layer_properties(self):
         """
@@ -72,11 +127,52 @@ class Layer(LayerBasedModelMixin, LayerImportMixin, LayerExportMixin, UpdateRout
             results = list(self.schema.get('properties', {}).keys())
 
         else:
-            feature_table = Feature._meta.db_table
+            results = sorted(self.get_statistics().properties)
+
+        return {
+            prop: 'str'
+            for prop in results
+        }
+
+    def get_features_geom_type(self):
+        return self.get_statistics().geom_type
+
+    def get_statistics(self):
+        """ Return layer features statistics, computed again if missing or outdated """
+        try:
+            statistics = self.statistics
+        except LayerStatistics.DoesNotExist:
+            statistics = None
+
+        if statistics is None or statistics.dirty:
+            statistics = self.refresh_statistics()
+        return statistics
+
+    def get_features_version(self):
+        """
+        Version of layer features, changed by each of their writes. Statistics are created if missing,
+        without being computed, so that writes are counted.
+        """
+        statistics, created = LayerStatistics.objects.using(DEFAULT_DB_ALIAS).get_or_create(
+            layer_id=self.pk, defaults={'dirty': True}
+        )
+        return statistics.version
+
+    def refresh_statistics(self):
+        """
+        Compute layer features statistics in bulk and store them. Always run on the default database,
+        read only views using a replica write them there too.
+        """
+        features = Feature.objects.using(DEFAULT_DB_ALIAS).filter(layer_id=self.pk)
+        aggregates = features.aggregate(feature_count=Count('pk'), extent=Extent('geom'))
+        xmin, ymin, xmax, ymax = aggregates['extent'] or (None, None, None, None)
+        first_geom = features.values_list('geom', flat=True).first()
+
+        feature_table = Feature._meta.db_table
 
-            layer_field = Feature._meta.get_field('layer').get_attname_column()[1]
+        layer_field = Feature._meta.get_field('layer').get_attname_column()[1]
 
-            cursor = connection.cursor()
+        with connection.cursor() as cursor:
             # noinspection SqlResolve
             raw_query = f"""
                 SELECT
@@ -88,12 +184,30 @@ class Layer(LayerBasedModelMixin, LayerImportMixin, LayerExportMixin, UpdateRout
                 """
 
             cursor.execute(raw_query, [self.pk, ])
-            results = [x[0] for x in cursor.fetchall()]
+            properties = {x[0]: True for x in cursor.fetchall()}
 
-        return {
-            prop: 'str'
-            for prop in results
-        }
+            # concurrent reads may create statistics at the same time
+            # noinspection SqlResolve
+            cursor.execute(f"""
+                INSERT INTO {LayerStatistics._meta.db_table}
+                    (layer_id, feature_count, geom_type, properties, xmin, ymin, xmax, ymax, facets, dirty, version,
+                     updated_at)
+                VALUES (%s, %s, %s, %s::jsonb, %s, %s, %s, %s, NULL, false, 0, NOW())
+                ON CONFLICT (layer_id) DO UPDATE SET
+                    feature_count = EXCLUDED.feature_count, geom_type = EXCLUDED.geom_type,
+                    properties = EXCLUDED.properties, xmin = EXCLUDED.xmin, ymin = EXCLUDED.ymin,
+                    xmax = EXCLUDED.xmax, ymax = EXCLUDED.ymax, facets = NULL, dirty = false,
+                    version = {LayerStatistics._meta.db_table}.version + 1, updated_at = EXCLUDED.updated_at
+            """, [self.pk, aggregates['feature_count'], first_geom.geom_typeid if first_geom else None,
+                  json.dumps(properties), xmin, ymin, xmax, ymax])
+
+        statistics = LayerStatistics.objects.using(DEFAULT_DB_ALIAS).get(layer_id=self.pk)
+        self.statistics = statistics
+
+        # Drop values computed from previous statistics
+        for cached in ('layer_properties', 'layer_geometry'):
+            self.__dict__.pop(cached, None)
+        return statistics
 
     def get_property_title(self, prop):
         """ Get json property title with its name. Return its name if not defined. """
@@ -117,18 +231,87 @@ class Layer(LayerBasedModelMixin, LayerImportMixin, LayerExportMixin, UpdateRout
 
         return prop_type
 
+    def get_search_properties(self):
+        """
+        Return searchable properties with their weight, none if full-text search is not enabled.
+        Defaults to schema string properties, required ones weighted 'A' and others 'B'
+        """
+        if not self.settings.get('search', {}).get('enabled'):
+            return {}
+        properties = self.settings.get('search', {}).get('properties')
+        if properties is None:
+            required = self.schema.get('required', [])
+            properties = {
+                prop: 'A' if prop in required else 'B'
+                for prop, definition in self.schema.get('properties', {}).items()
+                if definition.get('type') == 'string'
+            }
+        return properties
+
+    def get_search_config(self):
+        return self.settings.get('search', {}).get('config', self.SETTINGS_DEFAULT['search']['config'])
+
+    def update_search_definition(self):
+        """ Return True if searchable properties or config changed since layer load or previous call """
+        definition = sorted(self.get_search_properties().items()), self.get_search_config()
+        changed = definition != getattr(self, '_search_definition', None)
+        self._search_definition = definition
+        return changed
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        layer = super().from_db(db, field_names, values)
+        layer.update_search_definition()
+        return layer
+
+    @property
+    def is_searchable(self):
+        return bool(self.get_search_properties())
+
+    def get_search_vector(self, properties=None):
+        """
+        Weighted search vector expression of feature properties, or of the given properties values
+        of a feature being saved. None if layer is not searchable
+        """
+        config = self.get_search_config()
+        vectors = [
+            SearchVector(KeyTextTransform(prop, 'properties') if properties is None
+                         else Value(get_search_value(properties.get(prop)), output_field=models.TextField()),
+                         weight=weight, config=config)
+            for prop, weight in sorted(self.get_search_properties().items())
+        ]
+        return reduce(operator.add, vectors) if vectors else None
+
+    def get_search_text(self):
+        """ Searchable properties text expression, used for fuzzy search """
+        texts = [Coalesce(KeyTextTransform(prop, 'properties'), Value(''))
+                 for prop in sorted(self.get_search_properties())]
+        return ConcatWords(*texts) if texts else None
+
+    def refresh_search_vectors(self, features=None):
+        """ Compute search vectors of layer features, in one query """
+        features = self.features.all() if features is None else features
+        return features.update(search_vector=self.get_search_vector())
+
+    def get_property_expression(self, prop):
+        """ Typed value expression of a schema property, matching its index. None if not indexed """
+        if prop not in self.schema.get('properties', {}):
+            return None
+        return get_property_expression(prop, self.get_property_type(prop))
+
     def get_extent(self, srid=3857):
-        geom_field = 'geom'
-        features = self.features.all()
+        extent = self.get_statistics().extent
 
-        if srid != app_settings.INTERNAL_GEOMETRY_SRID:
-            # transform if needed
-            features = features.annotate(geom_transformed=Transform('geom', srid))
-            geom_field = 'geom_transformed'
+        if extent and srid != app_settings.INTERNAL_GEOMETRY_SRID:
+            # transform bounding box corners if needed
+            xmin, ymin, xmax, ymax = extent
+            corners = MultiPoint(Point(xmin, ymin), Point(xmin, ymax), Point(xmax, ymin), Point(xmax, ymax),
+                                 srid=app_settings.INTERNAL_GEOMETRY_SRID)
+            extent = corners.transform(srid, clone=True).extent
 
-        return features.aggregate(
-            extent=Extent(geom_field)
-        )
+        return {
+            'extent': extent
+        }
 
     def get_property_values(self, property_to_list):
         property_field = f'properties__{property_to_list}'
@@ -139,6 +322,33 @@ class Layer(LayerBasedModelMixin, LayerImportMixin, LayerExportMixin, UpdateRout
             .distinct(property_field)
         )
 
+    def get_property_facets(self, properties, limit=10, features=None):
+        """
+        Most frequent values of properties with their count, as {property: [{'value': value, 'count': count}]}.
+        Counts of all layer features are read from statistics when maintained, filtered features are grouped.
+        """
+        statistics = self.get_statistics() if features is None else None
+        facets = statistics.get_facets() if statistics else {}
+        features = self.features.all() if features is None else features
+
+        results = {}
+        for prop in properties:
+            if prop in facets:
+                counts = [(json.loads(value), value, count) for value, count in facets[prop].items()]
+                missing = statistics.feature_count - sum(count for value, key, count in counts)
+                if missing:
+                    counts.append((None, 'null', missing))
+                counts = sorted(counts, key=lambda value_count: (-value_count[2], value_count[1]))[:limit]
+                results[prop] = [{'value': value, 'count': count} for value, key, count in counts]
+            else:
+                # missing properties and JSON null values are counted together
+                value = Coalesce(KeyTransform(prop, 'properties'), Cast(Value('null'), JSONField()))
+                results[prop] = list(
+                    features.order_by().annotate(value=value).values('value')
+                    .annotate(count=Count('pk')).order_by('-count', 'value')[:limit]
+                )
+        return results
+
     def __str__(self):
         return f"{self.name}"
 
@@ -151,6 +361,125 @@ class Layer(LayerBasedModelMixin, LayerImportMixin, LayerExportMixin, UpdateRout
         )
 
 
+class LayerStatistics(models.Model):
+    """ Layer features statistics, updated on features writes instead of scanning them on each read """
+    layer = models.OneToOneField(Layer,
+                                 on_delete=models.CASCADE,
+                                 related_name='statistics',
+                                 verbose_name=_("Layer"))
+    feature_count = models.PositiveBigIntegerField(default=0)
+    # Geometry type of the first feature
+    geom_type = models.IntegerField(choices=GeometryTypes.choices, null=True)
+    # Property names used by features, as keys
+    properties = JSONField(default=dict, blank=True)
+    # Features bounding box, in internal SRID
+    xmin = models.FloatField(null=True)
+    ymin = models.FloatField(null=True)
+    xmax = models.FloatField(null=True)
+    ymax = models.FloatField(null=True)
+    # Count of features by property value, as {property: {JSON value: count}}, for low cardinality properties.
+    # Computed on first facets read
+    facets = JSONField(null=True, blank=True)
+    # Outdated statistics, to compute again on next read
+    dirty = models.BooleanField(default=False)
+    # Incremented by each features write, to invalidate caches of layer features
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def extent(self):
+        if self.xmin is None:
+            return None
+        return self.xmin, self.ymin, self.xmax, self.ymax
+
+    @classmethod
+    def add_feature(cls, feature):
+        """ Include a created feature into its layer statistics, in one query """
+        geom = feature.geom
+        if geom.srid and geom.srid != app_settings.INTERNAL_GEOMETRY_SRID:
+            geom = geom.transform(app_settings.INTERNAL_GEOMETRY_SRID, clone=True)
+        xmin, ymin, xmax, ymax = geom.extent
+
+        values = {
+            'feature_count': F('feature_count') + 1,
+            'geom_type': Coalesce('geom_type', Value(geom.geom_typeid)),
+            'xmin': Least('xmin', Value(xmin)),
+            'ymin': Least('ymin', Value(ymin)),
+            'xmax': Greatest('xmax', Value(xmax)),
+            'ymax': Greatest('ymax', Value(ymax)),
+        }
+        if feature.properties:
+            keys = {key: True for key in feature.properties}
+            values['properties'] = JSONBConcat('properties', Cast(Value(json.dumps(keys)), JSONField()))
+
+        # Missing statistics are computed on next read
+        values = {field: Case(When(dirty=False, then=value), default=F(field), output_field=cls._meta.get_field(field))
+                  for field, value in values.items()}
+        cls.objects.filter(layer_id=feature.layer_id).update(version=F('version') + 1, **values)
+
+        if feature.properties:
+            with connection.cursor() as cursor:
+                # properties getting more than GEOSTORE_FACETS_MAX_CARDINALITY values are dropped from facets
+                # noinspection SqlResolve
+                cursor.execute(f"""
+                    UPDATE {cls._meta.db_table} SET facets = (
+                        SELECT (facets - COALESCE(array_agg(key), '{{}}'::text[]))
+                            || COALESCE(jsonb_object_agg(key, counts) FILTER (WHERE cardinality <= %s), '{{}}'::jsonb)
+                        FROM (
+                            SELECT key, counts, (SELECT COUNT(*) FROM jsonb_object_keys(counts)) AS cardinality
+                            FROM (
+                                SELECT key, (facets -> key) || jsonb_build_object(
+                                    value::text, COALESCE((facets -> key ->> value::text)::bigint, 0) + 1
+                                ) AS counts
+                                FROM jsonb_each(%s::jsonb)
+                                WHERE facets ? key AND jsonb_typeof(value) <> 'null'
+                            ) AS added_counts
+                        ) AS added
+                    )
+                    WHERE layer_id = %s AND NOT dirty AND facets IS NOT NULL
+                """, [app_settings.GEOSTORE_FACETS_MAX_CARDINALITY,
+                      json.dumps(feature.properties, cls=DjangoJSONEncoder), feature.layer_id])
+
+    def get_facets(self):
+        """ Count of features by property value, for properties with at most GEOSTORE_FACETS_MAX_CARDINALITY values """
+        if self.facets is None:
+            self.refresh_facets()
+        return self.facets
+
+    def refresh_facets(self):
+        feature_table = Feature._meta.db_table
+        layer_field = Feature._meta.get_field('layer').get_attname_column()[1]
+
+        with connection.cursor() as cursor:
+            # noinspection SqlResolve
+            cursor.execute(f"""
+                UPDATE {self._meta.db_table} SET facets = COALESCE((
+                    SELECT jsonb_object_agg(key, counts) FROM (
+                        SELECT key, jsonb_object_agg(value, count) AS counts FROM (
+                            SELECT
+                                key, value::text AS value, COUNT(*) AS count,
+                                COUNT(*) OVER (PARTITION BY key) AS cardinality
+                            FROM {feature_table}, jsonb_each(properties)
+                            WHERE {layer_field} = %s AND jsonb_typeof(value) <> 'null'
+                            GROUP BY key, value
+                        ) AS counts_by_value
+                        WHERE cardinality <= %s
+                        GROUP BY key
+                    ) AS counts_by_key
+                ), '{{}}'::jsonb)
+                WHERE id = %s
+                RETURNING facets
+            """, [self.layer_id, app_settings.GEOSTORE_FACETS_MAX_CARDINALITY, self.pk])
+            facets = cursor.fetchone()[0]
+
+        self.facets = json.loads(facets) if isinstance(facets, str) else facets
+
+    @classmethod
+    def mark_dirty(cls, layer_ids):
+        """ Flag statistics of layers to be computed again on next read """
+        cls.objects.filter(layer_id__in=layer_ids).update(dirty=True, version=F('version') + 1)
+
+
 class LayerGroup(BaseUpdatableModel):
     name = models.CharField(max_length=256,
                             unique=True,
@@ -183,12 +512,41 @@ class Feature(BaseUpdatableModel, PgRoutingMixin):
                               db_index=False,
                               verbose_name=_("Layer"))
 
-    objects = Manager.from_queryset(FeatureQuerySet)()
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = FeatureManager()
 
     def save(self, *args, **kwargs):
+        created = self._state.adding
         if self.geom.hasz:
             self.geom = GEOSGeometry(WKBWriter().write(self.geom))
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or {'properties', 'layer'} & set(update_fields):
+            # search vector is written with properties
+            self.search_vector = self.layer.get_search_vector(self.properties)
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'search_vector'}
         super(Feature, self).save(*args, **kwargs)
+        if hasattr(self.search_vector, 'resolve_expression'):
+            # computed vector is loaded again if needed
+            del self.search_vector
+        if created:
+            LayerStatistics.add_feature(self)
+        elif update_fields is None or {'geom', 'properties', 'layer'} & set(update_fields):
+            # a moved feature changes its previous layer statistics too
+            LayerStatistics.mark_dirty({self.layer_id, getattr(self, '_loaded_layer_id', None) or self.layer_id})
+        self._loaded_layer_id = self.layer_id
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        feature = super().from_db(db, field_names, values)
+        feature._loaded_layer_id = feature.__dict__.get('layer_id')
+        return feature
+
+    def delete(self, *args, **kwargs):
+        LayerStatistics.mark_dirty([self.layer_id])
+        FeatureTombstone.objects.create(layer_id=self.layer_id, feature_id=self.pk, identifier=self.identifier)
+        return super().delete(*args, **kwargs)
 
     def get_bounding_box(self):
         return self.geom.extent
@@ -234,29 +592,12 @@ class Feature(BaseUpdatableModel, PgRoutingMixin):
     def sync_relations(self, layer_relation=None):
         """ replace feature relations for automatic layer relations """
         logger.info("Feature relation synchronisation")
-        layer_relations = self.layer.relations_as_origin.exclude(relation_type__isnull=True)
+        layer_relations = self.layer.relations_as_origin.filter(relation_type__in=('intersects', 'distance'))
         layer_relations = layer_relations.filter(pk__in=[layer_relation]) if layer_relation else layer_relations
         for rel in layer_relations:
             logger.info(f"relation {rel}")
-            qs = self.get_computed_relation_qs(rel)
-            # cache this query because it is evaluated multiple times, this avoids re-executing it as it is costly
-            id_list = list(qs.values_list("id", flat=True))
-            # find relation to delete (in stored relation but not in qs result)
-            to_delete = self.relations_as_origin.filter(relation=rel).exclude(destination_id__in=id_list)
-
-            to_delete.delete()
-
-            # find relation to add (not in stored relation but in qs
-            qs = Feature.objects.filter(id__in=id_list).exclude(pk__in=self.relations_as_origin.filter(relation=rel)
-                                                                .values_list('destination_id', flat=True))
-            # batch creation
-            batch_size = 100
-            objs = (FeatureRelation(origin=self, destination=feature_rel, relation=rel) for feature_rel in qs.all())
-            while True:
-                batch = list(islice(objs, batch_size))
-                if not batch:
-                    break
-                FeatureRelation.objects.bulk_create(batch, batch_size)
+            with transaction.atomic():
+                rel.sync_feature_relations('origin.id = %s', 'stored.origin_id = %s', [self.pk])
 
     @cached_property
     def relations(self):
@@ -285,6 +626,7 @@ class Feature(BaseUpdatableModel, PgRoutingMixin):
             models.Index(fields=['source', 'target', 'layer']),
             GistIndex(fields=['geom']),
             GinIndex(name='properties_gin_index', fields=['properties']),
+            GinIndex(name='search_vector_gin_index', fields=['search_vector']),
         ]
         constraints = [
             # geometry should be valid
@@ -321,6 +663,169 @@ class LayerRelation(models.Model):
     def __str__(self):
         return self.name
 
+    @property
+    def is_automatic(self):
+        """ Feature relations of intersects and distance relations are computed """
+        return self.relation_type in ('intersects', 'distance')
+
+    def get_destination_features(self):
+        """ Destination layer features, without excluded ones """
+        features = self.destination.features.all()
+        return features.exclude(**self.exclude) if self.exclude else features
+
+    def get_join_condition_sql(self):
+        """ SQL condition on related origin and destination features, and its params """
+        if self.relation_type == 'intersects':
+            return 'ST_Intersects(origin.geom, destination.geom)', []
+
+        distance = self.settings.get('distance')
+        if distance is None:
+            return 'FALSE', []
+        condition = 'ST_DWithin(origin.geom::geography, destination.geom::geography, %s)'
+        if not Feature._meta.get_field('geom').geodetic(connection):
+            return condition, [distance]
+
+        # index filter on the origin envelope expanded by the distance in degrees, as FeatureQuerySet.dwithin
+        latitude_delta = distance / METERS_BY_LATITUDE_DEGREE
+        max_latitude = 'GREATEST(ABS(ST_YMin(origin.geom)), ABS(ST_YMax(origin.geom))) + %s'
+        return f"""
+            destination.geom && ST_Expand(
+                origin.geom,
+                CASE WHEN {max_latitude} < 89
+                THEN %s / ({METERS_BY_LONGITUDE_DEGREE} * COS(RADIANS({max_latitude})))
+                ELSE 360 END,
+                %s
+            ) AND {condition}
+        """, [latitude_delta, distance, latitude_delta, latitude_delta, distance]
+
+    def sync_feature_relations(self, computed_condition, stored_condition, params):
+        """
+        Replace stored feature relations matching stored_condition (on stored relation) by the computed ones
+        matching computed_condition (on origin and destination features), in one statement.
+        Return created and deleted relations counts.
+        """
+        destinations, destinations_params = self.get_destination_features().values('pk').order_by() \
+            .query.sql_with_params()
+        join_condition, join_params = self.get_join_condition_sql()
+        feature_table = Feature._meta.db_table
+        relation_table = FeatureRelation._meta.db_table
+
+        with connection.cursor() as cursor:
+            # noinspection SqlResolve
+            cursor.execute(f"""
+                WITH computed AS (
+                    SELECT origin.id AS origin_id, destination.id AS destination_id
+                    FROM {feature_table} AS origin
+                    JOIN {feature_table} AS destination ON {join_condition}
+                    WHERE origin.layer_id = %s AND {computed_condition}
+                    AND destination.layer_id = %s AND destination.id IN ({destinations})
+                ),
+                deleted AS (
+                    DELETE FROM {relation_table} AS stored
+                    WHERE stored.relation_id = %s AND {stored_condition} AND NOT EXISTS (
+                        SELECT 1 FROM computed
+                        WHERE computed.origin_id = stored.origin_id AND computed.destination_id = stored.destination_id
+                    )
+                    RETURNING 1
+                ),
+                created AS (
+                    INSERT INTO {relation_table} (origin_id, destination_id, relation_id, properties)
+                    SELECT origin_id, destination_id, %s, '{{}}'::jsonb FROM computed
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM {relation_table} AS stored
+                        WHERE stored.relation_id = %s AND stored.origin_id = computed.origin_id
+                        AND stored.destination_id = computed.destination_id
+                    )
+                    RETURNING 1
+                )
+                SELECT (SELECT COUNT(*) FROM created), (SELECT COUNT(*) FROM deleted)
+            """, [*join_params, self.origin_id, *params, self.destination_id, *destinations_params,
+                  self.pk, *params, self.pk, self.pk])
+            return cursor.fetchone()
+
+    def sync_features(self, progress=None):
+        """
+        Compute all feature relations in the database, by batches of GEOSTORE_RELATION_SYNC_BATCH_SIZE
+        origin features, each one synchronized in its own transaction.
+        progress(done, total) is called after each batch. Return created and deleted relations counts.
+        """
+        created = deleted = 0
+        if not self.is_automatic:
+            return created, deleted
+
+        origin_ids = self.origin.features.order_by('pk').values_list('pk', flat=True)
+        total = origin_ids.count()
+        batch_size = app_settings.GEOSTORE_RELATION_SYNC_BATCH_SIZE
+        done, lower = 0, 0
+        while True:
+            # batches are origin features primary keys ranges, the last one is open
+            bounds = list(origin_ids.filter(pk__gt=lower)[batch_size - 1:batch_size])
+            upper = bounds[0] if bounds else None
+            condition = 'origin.id > %s' + (' AND origin.id <= %s' if upper else '')
+            params = [lower, upper] if upper else [lower]
+            with transaction.atomic():
+                batch_created, batch_deleted = self.sync_feature_relations(
+                    condition, condition.replace('origin.id', 'stored.origin_id'), params
+                )
+            created, deleted = created + batch_created, deleted + batch_deleted
+            done = min(done + batch_size, total)
+            if progress:
+                progress(done, total)
+            if upper is None:
+                return created, deleted
+            lower = upper
+
+    def sync_changed_features(self, feature_ids):
+        """
+        Compute feature relations of changed origin or destination features only, by batches of
+        GEOSTORE_RELATION_SYNC_BATCH_SIZE features, each one in its own transaction.
+        Relations stored for their old geometry are deleted if they do not match their new one anymore.
+        Return created and deleted relations counts.
+        """
+        created = deleted = 0
+        if not self.is_automatic:
+            return created, deleted
+
+        feature_ids = sorted(set(feature_ids))
+        batch_size = app_settings.GEOSTORE_RELATION_SYNC_BATCH_SIZE
+        for i in range(0, len(feature_ids), batch_size):
+            batch = feature_ids[i:i + batch_size]
+            with transaction.atomic():
+                for side in ('origin', 'destination'):
+                    batch_created, batch_deleted = self.sync_feature_relations(
+                        f'{side}.id = ANY(%s)', f'stored.{side}_id = ANY(%s)', [batch]
+                    )
+                    created, deleted = created + batch_created, deleted + batch_deleted
+        return created, deleted
+
+    @property
+    def pending_sync_cache_key(self):
+        return f'relation-sync-pending-{self.pk}'
+
+    def sync_pending_features(self):
+        """
+        Compute feature relations of pending changed features, claimed by batches of GEOSTORE_RELATION_SYNC_BATCH_SIZE.
+        Each batch is claimed and synchronized in the same transaction, so it stays pending on failure.
+        Return created and deleted relations counts.
+        """
+        created = deleted = 0
+        table = PendingRelationFeature._meta.db_table
+        while True:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    # noinspection SqlResolve
+                    cursor.execute(f"""
+                        DELETE FROM {table} WHERE id IN (
+                            SELECT id FROM {table} WHERE relation_id = %s ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING feature_id
+                    """, [self.pk, app_settings.GEOSTORE_RELATION_SYNC_BATCH_SIZE])
+                    feature_ids = [feature_id for feature_id, in cursor.fetchall()]
+                if not feature_ids:
+                    return created, deleted
+                batch_created, batch_deleted = self.sync_changed_features(feature_ids)
+            created, deleted = created + batch_created, deleted + batch_deleted
+
     class Meta:
         ordering = ['id']
         unique_together = (
@@ -328,6 +833,20 @@ class LayerRelation(models.Model):
         )
 
 
+class PendingRelationFeature(models.Model):
+    """ Changed feature whose relations are updated by the next relation_sync_pending_features task """
+    relation = models.ForeignKey(LayerRelation,
+                                 on_delete=models.CASCADE,
+                                 related_name='pending_features',
+                                 verbose_name=_("Relation"))
+    feature_id = models.IntegerField()
+
+    class Meta:
+        unique_together = (
+            ('relation', 'feature_id'),
+        )
+
+
 class FeatureRelation(models.Model):
     origin = models.ForeignKey(Feature,
                                on_delete=models.CASCADE,
@@ -349,6 +868,88 @@ class FeatureRelation(models.Model):
         ordering = ['id']
 
 
+class TileHit(models.Model):
+    """ Sampled count of requested tiles by layer, used to warm the most requested ones """
+    layer = models.ForeignKey(Layer,
+                              on_delete=models.CASCADE,
+                              related_name='tile_hits',
+                              verbose_name=_("Layer"))
+    z = models.PositiveSmallIntegerField()
+    x = models.PositiveIntegerField()
+    y = models.PositiveIntegerField()
+    hits = models.PositiveBigIntegerField(default=0)
+
+    @classmethod
+    def record(cls, layer_ids, tiles, hits=1):
+        """ Add hits to (z, x, y) tiles of each layer, in one query """
+        values = [(layer_id, z, x, y, hits) for layer_id in layer_ids for z, x, y in tiles]
+        if not values:
+            return
+
+        table = cls._meta.db_table
+        placeholders = ', '.join(['(%s, %s, %s, %s, %s)'] * len(values))
+        with connection.cursor() as cursor:
+            # noinspection SqlResolve
+            cursor.execute(f"""
+                INSERT INTO {table} (layer_id, z, x, y, hits)
+                VALUES {placeholders}
+                ON CONFLICT (layer_id, z, x, y) DO UPDATE SET hits = {table}.hits + EXCLUDED.hits
+            """, [value for row in values for value in row])
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['layer', '-hits']),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['layer', 'z', 'x', 'y'], name='tile_hit_unique'),
+        ]
+
+
+class FeatureTombstone(models.Model):
+    """ Deleted feature, kept so layer change feeds can return deletions """
+    layer = models.ForeignKey(Layer,
+                              on_delete=models.CASCADE,
+                              related_name='tombstones',
+                              verbose_name=_("Layer"))
+    feature_id = models.IntegerField()
+    identifier = models.CharField(max_length=255)
+    deleted_at = models.DateTimeField(default=now)
+
+    @classmethod
+    def record(cls, features):
+        """
+        Add tombstones of features (a queryset) about to be deleted, in one query.
+        Deletion time is the application one, as updated_at, not the transaction start
+        """
+        features_query, args = features.order_by().values_list('layer_id', 'pk', 'identifier').query.sql_with_params()
+        with connection.cursor() as cursor:
+            # noinspection SqlResolve
+            cursor.execute(f"""
+                INSERT INTO {cls._meta.db_table} (layer_id, feature_id, identifier, deleted_at)
+                SELECT *, %s FROM ({features_query}) AS features
+            """, (now(), *args))
+
+    @classmethod
+    def get_retention_limit(cls):
+        """ Tombstones deleted before are purged, None if they are kept """
+        if app_settings.GEOSTORE_TOMBSTONES_RETENTION_DAYS is None:
+            return None
+        return now() - timedelta(days=app_settings.GEOSTORE_TOMBSTONES_RETENTION_DAYS)
+
+    @classmethod
+    def purge(cls):
+        """ Delete tombstones older than GEOSTORE_TOMBSTONES_RETENTION_DAYS, return their count """
+        limit = cls.get_retention_limit()
+        if limit is None:
+            return 0
+        return cls.objects.filter(deleted_at__lt=limit).delete()[0]
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['layer', 'deleted_at', 'id']),
+        ]
+
+
 class LayerExtraGeom(LayerBasedModelMixin):
     layer = models.ForeignKey(Layer,
                               on_delete=models.CASCADE,
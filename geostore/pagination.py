@@ -0,0 +1,230 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from datetime import datetime
+
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.db.models import F, OrderBy, Q
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class EstimatedCountPage(Page):
+    has_more = False
+
+    def has_next(self):
+        if self.paginator.count_exact:
+            return super().has_next()
+        return self.has_more
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator counting with the planner estimate for large feature querysets.
+    With an estimated count, pages are not bounded by it and next page is detected with one more row.
+    """
+    count_exact = True
+
+    @cached_property
+    def count(self):
+        if hasattr(self.object_list, 'estimated_count'):
+            count, self.count_exact = self.object_list.estimated_count()
+            return count
+        return super().count
+
+    def page(self, number):
+        if self.count_exact:
+            return super().page(number)
+
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(_('That page number is not an integer'))
+        if number < 1:
+            raise EmptyPage(_('That page number is less than 1'))
+
+        bottom = (number - 1) * self.per_page
+        object_list = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not object_list and number > 1:
+            raise EmptyPage(_('That page contains no results'))
+        page = self._get_page(object_list[:self.per_page], number, self)
+        page.has_more = len(object_list) > self.per_page
+        return page
+
+    def _get_page(self, *args, **kwargs):
+        return EstimatedCountPage(*args, **kwargs)
+
+
+class FeatureEstimatedCountPagination(PageNumberPagination):
+    """
+    Page number pagination whose count is a planner estimate above GEOSTORE_ESTIMATED_COUNT_THRESHOLD.
+    Responses tell if the count is exact with `count_exact`.
+    """
+    django_paginator_class = EstimatedCountPaginator
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('count', self.page.paginator.count),
+            ('count_exact', self.page.paginator.count_exact),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema['properties']['count_exact'] = {'type': 'boolean', 'example': True}
+        return response_schema
+
+
+class FeatureCursorPagination(BasePagination):
+    """
+    Keyset pagination on the active queryset ordering, with the primary key as tie-breaker.
+
+    Each page is fetched with a filter on the ordering values of the previous page boundary,
+    so all pages cost the same and no count is made. Cursors are opaque.
+    """
+    cursor_query_param = 'cursor'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    invalid_cursor_message = _('Invalid cursor')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        values, self.reverse = self.decode_cursor(request)
+        self.has_cursor = values is not None
+
+        ordering = self.get_ordering(queryset)
+        if self.reverse:
+            ordering = [order_by.copy().reverse_ordering() for order_by in ordering]
+
+        # ordering values are annotated to be read from the page boundaries
+        queryset = queryset.annotate(**{f'cursor_{i}': order_by.expression for i, order_by in enumerate(ordering)})
+        if values is not None:
+            if len(values) != len(ordering):
+                raise NotFound(self.invalid_cursor_message)
+            queryset = queryset.filter(self.get_after_filter(ordering, values))
+        queryset = queryset.order_by(*[self.get_annotation_ordering(i, order_by)
+                                       for i, order_by in enumerate(ordering)])
+
+        results = list(queryset[:self.page_size + 1])
+        self.has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        self.ordering_count = len(ordering)
+        if self.reverse:
+            self.page.reverse()
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    @staticmethod
+    def get_ordering(queryset):
+        """ Active ordering as OrderBy expressions, ending with the primary key """
+        ordering = []
+        for field in queryset.query.order_by or queryset.model._meta.ordering:
+            if isinstance(field, str):
+                if field == '?':
+                    continue
+                field = F(field[1:]).desc() if field.startswith('-') else F(field).asc()
+            elif not isinstance(field, OrderBy):
+                field = field.asc()
+            ordering.append(field)
+
+        if not any(isinstance(order_by.expression, F) and order_by.expression.name in ('pk', 'id')
+                   for order_by in ordering):
+            ordering.append(F('pk').asc())
+        return ordering
+
+    @staticmethod
+    def get_annotation_ordering(i, order_by):
+        return OrderBy(F(f'cursor_{i}'), descending=order_by.descending,
+                       nulls_first=order_by.nulls_first, nulls_last=order_by.nulls_last)
+
+    @staticmethod
+    def get_after_filter(ordering, values):
+        """ Rows after the boundary values, following PostgreSQL NULLs position """
+        after = Q(pk__in=[])
+        equal = Q()
+        for i, (order_by, value) in enumerate(zip(ordering, values)):
+            name = f'cursor_{i}'
+            nulls_last = order_by.nulls_last or (not order_by.nulls_first and not order_by.descending)
+            if value is None:
+                if not nulls_last:
+                    after |= equal & Q(**{f'{name}__isnull': False})
+                equal &= Q(**{f'{name}__isnull': True})
+            else:
+                greater = Q(**{f'{name}__lt' if order_by.descending else f'{name}__gt': value})
+                if nulls_last:
+                    greater |= Q(**{f'{name}__isnull': True})
+                after |= equal & greater
+                equal &= Q(**{name: value})
+        return after
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+
+        try:
+            cursor = json.loads(urlsafe_b64decode(encoded.encode('ascii')))
+            values = [parse_datetime(value['datetime']) if isinstance(value, dict) else value
+                      for value in cursor['values']]
+            return values, bool(cursor.get('reverse'))
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, instance, reverse=False):
+        values = [getattr(instance, f'cursor_{i}') for i in range(self.ordering_count)]
+        cursor = {
+            'values': [{'datetime': value.isoformat()} if isinstance(value, datetime) else value for value in values],
+            'reverse': reverse,
+        }
+        encoded = urlsafe_b64encode(json.dumps(cursor).encode()).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.page or (not self.reverse and not self.has_more):
+            return None
+        return self.encode_cursor(self.page[-1])
+
+    def get_previous_link(self):
+        if not self.page:
+            if self.has_cursor:
+                return remove_query_param(self.base_url, self.cursor_query_param)
+            return None
+        if (self.reverse and not self.has_more) or (not self.reverse and not self.has_cursor):
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
@@ -0,0 +1,64 @@
+"""
+Coalesced dispatch of feature relations updates.
+
+Features changed in a transaction are collected, and after its commit they are added once to the pending
+features of each automatic relation of their layers. One relation_sync_pending_features task by relation
+is then enqueued for all changes of the next GEOSTORE_RELATION_SYNC_DELAY seconds.
+"""
+from collections import defaultdict
+from threading import local
+from weakref import ref
+
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Q
+
+from . import settings as app_settings
+from .models import Feature, LayerRelation, PendingRelationFeature
+from .tasks import relation_sync_pending_features
+
+# Changes collected in the current transaction of each database, as {alias: (dispatch callback ref, changes)}
+_pending = local()
+
+
+def collect_changed_feature(layer_id, feature_id, using=DEFAULT_DB_ALIAS):
+    """ Collect a changed feature, its relations are updated after the current transaction commit """
+    registry = _pending.__dict__.setdefault('registry', {})
+    dispatch_ref, changes = registry.get(using, (None, None))
+    # Django releases the callback of a rolled back transaction or savepoint, with its changes
+    if dispatch_ref is not None and dispatch_ref() is not None:
+        changes[layer_id].add(feature_id)
+        return
+
+    # first change of the transaction, or out of transactions
+    changes = defaultdict(set)
+    changes[layer_id].add(feature_id)
+
+    def dispatch():
+        if registry.get(using, (None, None))[1] is changes:
+            del registry[using]
+        dispatch_changed_features(changes)
+
+    registry[using] = ref(dispatch), changes
+    transaction.on_commit(dispatch, using=using)
+
+
+def dispatch_changed_features(changes):
+    """ Add changed features ({layer_id: feature_ids}) to their relations pending features, and schedule their sync """
+    # features created in a rolled back savepoint are skipped
+    existing = set(Feature.objects.filter(pk__in=set().union(*changes.values())).values_list('pk', flat=True))
+    relations = LayerRelation.objects.filter(
+        Q(origin_id__in=changes) | Q(destination_id__in=changes),
+        relation_type__in=('intersects', 'distance'),
+    )
+    for relation in relations:
+        feature_ids = (changes.get(relation.origin_id, set()) | changes.get(relation.destination_id, set())) & existing
+        PendingRelationFeature.objects.bulk_create(
+            [PendingRelationFeature(relation=relation, feature_id=feature_id) for feature_id in feature_ids],
+            batch_size=app_settings.GEOSTORE_RELATION_SYNC_BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+        # group all changes of the delay in one task, launched after it
+        if feature_ids and cache.add(relation.pending_sync_cache_key, True, app_settings.GEOSTORE_RELATION_SYNC_DELAY):
+            relation_sync_pending_features.apply_async((relation.pk,),
+                                                       countdown=app_settings.GEOSTORE_RELATION_SYNC_DELAY)
@@ -1,9 +1,11 @@
 from django.contrib.auth.models import Group
+from django.utils.http import RFC3986_SUBDELIMS
 from rest_framework import serializers
 from rest_framework.fields import empty
 from rest_framework.reverse import reverse
 from rest_framework_gis.serializers import GeometryField
-from urllib.parse import unquote
+from urllib.parse import quote, unquote
+from uuid import uuid4
 
 from geostore import settings as app_settings
 from geostore.models import (Feature, FeatureExtraGeom, FeatureRelation, Layer,
@@ -12,48 +14,81 @@ from geostore.validators import (validate_json_schema_data,
                                  validate_json_schema, validate_geom_type, validate_geom)
 
 
-class GeometryFileSerializer(serializers.Serializer):
-    GeoJSON = serializers.SerializerMethodField()
-    KML = serializers.SerializerMethodField()
-    GPX = serializers.SerializerMethodField()
-
-    def get_GeoJSON(self, obj):
-        return reverse('feature-detail',
-                       kwargs={'layer': obj.layer_id, 'identifier': obj.identifier, 'format': 'geojson', })
+class FeatureGeometryField(GeometryField):
+    """ Geometry computed in database when features are queried with FeatureQuerySet.with_output_geometry """
 
-    def get_KML(self, obj):
-        return reverse('feature-detail',
-                       kwargs={'layer': obj.layer_id, 'identifier': obj.identifier, 'format': 'kml', })
-
-    def get_GPX(self, obj):
-        return reverse('feature-detail',
-                       kwargs={'layer': obj.layer_id, 'identifier': obj.identifier, 'format': 'gpx', })
+    def get_attribute(self, instance):
+        if hasattr(instance, 'output_geom'):
+            return instance.output_geom
+        return super().get_attribute(instance)
 
 
 class FeatureSerializer(serializers.ModelSerializer):
-    geom = GeometryField(validators=[validate_geom])
+    # identifier placeholder of URL templates, matching feature lookup pattern.
+    # Unpredictable, as it is also replaced in features rendered by database
+    IDENTIFIER_PLACEHOLDER = f'__identifier_{uuid4().hex}__'
+    GEOMETRY_FILES_FORMATS = (('GeoJSON', 'geojson'), ('KML', 'kml'), ('GPX', 'gpx'))
+
+    geom = FeatureGeometryField(validators=[validate_geom])
     properties = serializers.JSONField(required=False)
     relations = serializers.SerializerMethodField()
     geometry_files = serializers.SerializerMethodField()
 
     def get_geometry_files(self, obj):
-        serializer = GeometryFileSerializer(obj)
-        return serializer.data
+        return {
+            name: self.format_url(template, obj.identifier)
+            for name, template in self.get_url_templates(obj.layer_id)['geometry_files'].items()
+        }
 
     def get_relations(self, obj):
         return {
-            relation.name: reverse('feature-relation',
-                                   args=(obj.layer_id, obj.identifier, relation.pk))
-            for relation in obj.layer.relations_as_origin.all()
+            name: self.format_url(template, obj.identifier)
+            for name, template in self.get_url_templates(obj.layer_id)['relations'].items()
         }
 
     def __init__(self, instance=None, data=empty, **kwargs):
         super().__init__(instance=instance, data=data, **kwargs)
         self.layer = None
+        self.url_templates = {}
+
+    def get_url_templates(self, layer_id):
+        """
+        URLs of layer features, with an identifier placeholder. Computed once per layer,
+        instead of resolving URLs and querying relations for each feature.
+        """
+        if layer_id not in self.url_templates:
+            layer = self.context.get('layer')
+            if layer and layer.pk == layer_id:
+                relations = layer.relations_as_origin.all()
+            else:
+                relations = LayerRelation.objects.filter(origin_id=layer_id)
+
+            self.url_templates[layer_id] = {
+                'geometry_files': {
+                    name: reverse('feature-detail', kwargs={'layer': layer_id,
+                                                            'identifier': self.IDENTIFIER_PLACEHOLDER,
+                                                            'format': file_format})
+                    for name, file_format in self.GEOMETRY_FILES_FORMATS
+                },
+                'relations': {
+                    relation.name: reverse('feature-relation',
+                                           args=(layer_id, self.IDENTIFIER_PLACEHOLDER, relation.pk))
+                    for relation in relations.only('pk', 'name')
+                },
+            }
+        return self.url_templates[layer_id]
+
+    def format_url(self, template, identifier):
+        # quoted as reverse() does
+        return template.replace(self.IDENTIFIER_PLACEHOLDER,
+                                quote(str(identifier), safe=RFC3986_SUBDELIMS + '/~:@'))
 
     def get_layer(self):
+        layer = self.context.get('layer')
         if self.instance:
-            self.layer = self.instance.layer
+            self.layer = layer if layer and layer.pk == self.instance.layer_id else self.instance.layer
+        if not self.layer and layer:
+            self.layer = layer
         if not self.layer and self.context.get('layer_pk'):
             self.layer = Layer.objects.get(pk=self.context.get('layer_pk'))
         return self.layer
@@ -80,6 +115,13 @@ class FeatureSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'layer')
 
 
+class NearestFeatureSerializer(FeatureSerializer):
+    distance = serializers.FloatField(read_only=True)
+
+    class Meta(FeatureSerializer.Meta):
+        fields = FeatureSerializer.Meta.fields + ('distance', )
+
+
 class GroupSerializer(serializers.ModelSerializer):
     tilejson = serializers.SerializerMethodField()
     group_tiles = serializers.SerializerMethodField()
@@ -10,6 +10,9 @@ class Serializer(basegeojson.Serializer):
     def handle_field(self, obj, field):
         if field.name == self.properties_field:
             self._current = field.value_from_object(obj)
+        elif field.name == self.geometry_field and hasattr(obj, 'output_geom'):
+            # geometry computed in database with FeatureQuerySet.with_output_geometry
+            self._geometry = obj.output_geom
         else:
             super().handle_field(obj, field)
 
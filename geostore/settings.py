@@ -7,6 +7,10 @@ MIN_TILE_ZOOM = getattr(settings, 'MIN_TILE_ZOOM', 0)
 
 INTERNAL_GEOMETRY_SRID = getattr(settings, 'INTERNAL_GEOMETRY_SRID', 4326)
 GEOSTORE_RELATION_CELERY_ASYNC = getattr(settings, 'GEOSTORE_RELATION_CELERY_ASYNC', False)
+# Layer relations are computed by batches of this number of origin features, each one in a transaction
+GEOSTORE_RELATION_SYNC_BATCH_SIZE = getattr(settings, 'GEOSTORE_RELATION_SYNC_BATCH_SIZE', 10000)
+# Feature relations of features changed during this number of seconds are updated together, by one task by relation
+GEOSTORE_RELATION_SYNC_DELAY = getattr(settings, 'GEOSTORE_RELATION_SYNC_DELAY', 10)
 
 # LayerViewSet can be override by a subclass
 GEOSTORE_LAYER_VIEWSSET = getattr(settings, 'GEOSTORE_LAYER_VIEWSSET', 'geostore.views.LayerViewSet')
@@ -14,3 +18,42 @@ GEOSTORE_LAYER_VIEWSSET = getattr(settings, 'GEOSTORE_LAYER_VIEWSSET', 'geostore
 GEOSTORE_LAYER_SERIALIZER = getattr(settings, 'GEOSTORE_LAYER_SERIALIZER', 'geostore.serializers.LayerSerializer')
 
 GEOSTORE_EXPORT_CELERY_ASYNC = getattr(settings, 'GEOSTORE_EXPORT_CELERY_ASYNC', False)
+
+# FeatureViewSet pagination class, DRF DEFAULT_PAGINATION_CLASS if not set. eg. 'geostore.pagination.FeatureCursorPagination'
+GEOSTORE_FEATURE_PAGINATION_CLASS = getattr(settings, 'GEOSTORE_FEATURE_PAGINATION_CLASS', None)
+# Feature listings above this planner row estimate return the estimate instead of an exact count, 0 to disable
+GEOSTORE_ESTIMATED_COUNT_THRESHOLD = getattr(settings, 'GEOSTORE_ESTIMATED_COUNT_THRESHOLD', 100000)
+# Render FeatureViewSet GeoJSON listings in database, streamed by chunks of GEOSTORE_GEOJSON_CHUNK_SIZE rows when not paginated
+GEOSTORE_GEOJSON_DB_RENDERING = getattr(settings, 'GEOSTORE_GEOJSON_DB_RENDERING', True)
+GEOSTORE_GEOJSON_CHUNK_SIZE = getattr(settings, 'GEOSTORE_GEOJSON_CHUNK_SIZE', 2000)
+# Layer intersects geometries having more vertices are split into parts of this size with ST_Subdivide, 0 to disable
+GEOSTORE_INTERSECTS_SUBDIVIDE_VERTICES = getattr(settings, 'GEOSTORE_INTERSECTS_SUBDIVIDE_VERTICES', 256)
+# Value counts of layer properties with at most this number of distinct values are stored and maintained for facets
+GEOSTORE_FACETS_MAX_CARDINALITY = getattr(settings, 'GEOSTORE_FACETS_MAX_CARDINALITY', 100)
+# Maximum number of groups returned by layer aggregate endpoint
+GEOSTORE_AGGREGATE_MAX_GROUPS = getattr(settings, 'GEOSTORE_AGGREGATE_MAX_GROUPS', 10000)
+# Layer changes feeds return changes older than this delay (seconds), so that pending transactions are not skipped
+GEOSTORE_CHANGES_FEED_DELAY = getattr(settings, 'GEOSTORE_CHANGES_FEED_DELAY', 5)
+# Days feature tombstones are kept by purge_tombstones, older changes feed cursors are expired. None to keep them
+GEOSTORE_TOMBSTONES_RETENTION_DAYS = getattr(settings, 'GEOSTORE_TOMBSTONES_RETENTION_DAYS', 30)
+# Database alias of a read replica, used by read only views with geostore.db.routers.ReadReplicaRouter
+GEOSTORE_READ_DATABASE = getattr(settings, 'GEOSTORE_READ_DATABASE', None)
+# Users read from the default database during this number of seconds after their writes, 0 to disable
+GEOSTORE_READ_DATABASE_STICKINESS = getattr(settings, 'GEOSTORE_READ_DATABASE_STICKINESS', 10)
+
+# Maximum number of tiles returned by a single tiles batch request
+GEOSTORE_TILES_BATCH_MAX_TILES = getattr(settings, 'GEOSTORE_TILES_BATCH_MAX_TILES', 64)
+
+# Record 1 out of GEOSTORE_TILES_HITS_SAMPLING tile requests, 0 to disable
+GEOSTORE_TILES_HITS_SAMPLING = getattr(settings, 'GEOSTORE_TILES_HITS_SAMPLING', 0)
+# Number of most requested tiles regenerated after a layer update
+GEOSTORE_TILES_WARM_COUNT = getattr(settings, 'GEOSTORE_TILES_WARM_COUNT', 100)
+# Warm most requested tiles with celery after features updates, grouping updates of GEOSTORE_TILES_WARM_DELAY seconds
+GEOSTORE_TILES_WARM_CELERY_ASYNC = getattr(settings, 'GEOSTORE_TILES_WARM_CELERY_ASYNC', False)
+GEOSTORE_TILES_WARM_DELAY = getattr(settings, 'GEOSTORE_TILES_WARM_DELAY', 60)
+
+# Give each new layer its own partition of the features table, once partitioned with partition_features command
+GEOSTORE_FEATURE_PARTITIONING = getattr(settings, 'GEOSTORE_FEATURE_PARTITIONING', False)
+
+# Build layer properties indexes with celery after schema changes, instead of during layer save
+GEOSTORE_PROPERTIES_INDEXES_CELERY_ASYNC = getattr(settings, 'GEOSTORE_PROPERTIES_INDEXES_CELERY_ASYNC', False)
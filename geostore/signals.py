@@ -1,19 +1,66 @@
-from django.db.models.signals import post_save
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
 from geostore import settings as app_settings
+from geostore.db.indexes import drop_properties_indexes
+from geostore.db.partitioning import create_layer_partition, drop_layer_partition, is_feature_table_partitioned
 from geostore.helpers import execute_async_func
-from geostore.models import Feature, LayerRelation
-from geostore.tasks import feature_update_relations_destinations, layer_relations_set_destinations
+from geostore.models import Feature, Layer, LayerRelation
+from geostore.relations import collect_changed_feature
+from geostore.tasks import layer_relations_set_destinations, layer_sync_properties_indexes
+from geostore.tiles.helpers import schedule_tiles_warming
 
 
 @receiver(post_save, sender=Feature)
-def save_feature(sender, instance, **kwargs):
+def save_feature(sender, instance, using, **kwargs):
+    # relations of all features changed in the transaction are updated together after commit
     if app_settings.GEOSTORE_RELATION_CELERY_ASYNC:
-        execute_async_func(feature_update_relations_destinations, (instance.pk,))
+        collect_changed_feature(instance.layer_id, instance.pk, using=using)
+
+
+@receiver(post_save, sender=Feature)
+def schedule_layer_tiles_warming(sender, instance, **kwargs):
+    # group all layer updates of the delay in one warming, launched after it
+    schedule_tiles_warming(instance.layer_id)
 
 
 @receiver(post_save, sender=LayerRelation)
 def save_layer_relation(sender, instance, **kwargs):
     if app_settings.GEOSTORE_RELATION_CELERY_ASYNC:
         execute_async_func(layer_relations_set_destinations, (instance.pk,))
+
+
+@receiver(post_save, sender=Layer)
+def create_layer_features_partition(sender, instance, created, **kwargs):
+    if app_settings.GEOSTORE_FEATURE_PARTITIONING and created and is_feature_table_partitioned():
+        create_layer_partition(instance.pk, new_layer=True)
+
+
+@receiver(post_delete, sender=Layer)
+def drop_layer_features_partition(sender, instance, **kwargs):
+    if app_settings.GEOSTORE_FEATURE_PARTITIONING:
+        drop_layer_partition(instance.pk)
+
+
+@receiver(post_save, sender=Layer)
+def sync_layer_properties_indexes(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and not {'schema', 'settings'} & set(update_fields):
+        return
+
+    refresh_search_vectors = instance.update_search_definition() and not created
+    if created and not instance.schema and not instance.settings.get('search'):
+        return
+
+    # indexes are built concurrently, after commit
+    if app_settings.GEOSTORE_PROPERTIES_INDEXES_CELERY_ASYNC:
+        execute_async_func(layer_sync_properties_indexes, (instance.pk, refresh_search_vectors))
+    else:
+        transaction.on_commit(partial(layer_sync_properties_indexes, instance.pk, refresh_search_vectors))
+
+
+@receiver(post_delete, sender=Layer)
+def drop_layer_properties_indexes(sender, instance, **kwargs):
+    transaction.on_commit(partial(drop_properties_indexes, instance))
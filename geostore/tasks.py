@@ -1,8 +1,14 @@
 from celery import shared_task
+from django.apps import apps
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 
+from geostore import settings as app_settings
+from geostore.db.indexes import sync_properties_indexes
+from geostore.db.routers import read_database
 from geostore.import_export.helpers import save_generated_file, send_mail_export
-from geostore.models import Feature, LayerRelation, Layer
+from geostore.models import Feature, FeatureTombstone, LayerRelation, Layer
+from geostore.tiles.helpers import VectorTile, warm_hot_tiles
 
 
 @shared_task
@@ -15,12 +21,72 @@ def feature_update_relations_destinations(feature_id, relation_id=None):
 
 
 @shared_task
-def layer_relations_set_destinations(relation_id):
-    """ Update all feature layer as origin for a relation """
+def relation_sync_changed_features(relation_id, feature_ids):
+    """ Update feature relations of changed origin or destination features of a relation """
     relation = LayerRelation.objects.get(pk=relation_id)
+    relation.sync_changed_features(feature_ids)
 
-    for feature_id in relation.origin.features.values_list('pk', flat=True):
-        feature_update_relations_destinations.delay(feature_id, relation_id)
+    return True
+
+
+@shared_task
+def relation_sync_pending_features(relation_id):
+    """ Update feature relations of pending changed features of a relation """
+    relation = LayerRelation.objects.get(pk=relation_id)
+    # features changed from now schedule a new task
+    cache.delete(relation.pending_sync_cache_key)
+    relation.sync_pending_features()
+
+    return True
+
+
+@shared_task
+def purge_feature_tombstones():
+    """ Delete feature tombstones older than GEOSTORE_TOMBSTONES_RETENTION_DAYS, to schedule periodically """
+    return FeatureTombstone.purge()
+
+
+@shared_task(bind=True)
+def layer_relations_set_destinations(self, relation_id):
+    """ Update all feature layer as origin for a relation, reporting progress as task state """
+    relation = LayerRelation.objects.get(pk=relation_id)
+
+    def progress(done, total):
+        if self.request.id:
+            self.update_state(state='PROGRESS', meta={'done': done, 'total': total})
+
+    relation.sync_features(progress)
+
+    return True
+
+
+@shared_task
+def layer_sync_properties_indexes(layer_id, refresh_search_vectors=False):
+    """ Create and drop layer properties indexes according to its schema, and refresh its search vectors """
+    layer = Layer.objects.get(pk=layer_id)
+    sync_properties_indexes(layer)
+    if refresh_search_vectors:
+        layer.refresh_search_vectors()
+
+    return True
+
+
+@shared_task
+def refresh_tile(model_label, layer_id, x, y, z, cache_key=None, name=None):
+    """ Rebuild a tile served stale, and cache it for the current layer version """
+    layer = apps.get_model(model_label).objects.get(pk=layer_id)
+    vtile = VectorTile(layer, cache_key)
+    count, tile = vtile.generate_tile(x, y, z, name)
+    vtile.set_cached_tiles({(z, x, y): (count, bytes(tile))})
+
+    return True
+
+
+@shared_task
+def warm_layer_tiles(layer_id, count=None):
+    """ Regenerate the most requested tiles of a layer """
+    layer = Layer.objects.get(pk=layer_id)
+    warm_hot_tiles(layer, count or app_settings.GEOSTORE_TILES_WARM_COUNT)
 
     return True
 
@@ -29,7 +95,8 @@ def layer_relations_set_destinations(relation_id):
 def generate_shapefile_async(layer_id, user_id):
     layer = Layer.objects.get(pk=layer_id)
     user = get_user_model().objects.get(pk=user_id)
-    file = layer.to_shapefile()
+    with read_database(app_settings.GEOSTORE_READ_DATABASE):
+        file = layer.to_shapefile()
 
     path = save_generated_file(user_id, layer.name, 'zip', file.getvalue()) if file else None
     send_mail_export(user, path)
@@ -40,7 +107,8 @@ def generate_geojson_async(layer_id, user_id):
     layer = Layer.objects.get(pk=layer_id)
     user = get_user_model().objects.get(pk=user_id)
 
-    file = layer.to_geojson()
+    with read_database(app_settings.GEOSTORE_READ_DATABASE):
+        file = layer.to_geojson()
 
     path = save_generated_file(user_id, layer.name, 'geojson', file) if file else None
     send_mail_export(user, path)
@@ -51,6 +119,7 @@ def generate_kml_async(layer_id, user_id):
     layer = Layer.objects.get(pk=layer_id)
     user = get_user_model().objects.get(pk=user_id)
 
-    file = layer.to_kml()
+    with read_database(app_settings.GEOSTORE_READ_DATABASE):
+        file = layer.to_kml()
     path = save_generated_file(user_id, layer.name, 'kml', file) if file else None
     send_mail_export(user, path)
@@ -0,0 +1,118 @@
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase
+
+from geostore.db.partitioning import (ddl_cursor, get_default_partition_name, get_layer_partition,
+                                      is_feature_table_partitioned)
+from geostore.models import Feature, FeatureRelation, LayerRelation
+from geostore.tests.factories import FeatureFactory, LayerFactory
+
+
+class PartitionFeaturesTestCase(TestCase):
+    def setUp(self):
+        self.layer = LayerFactory(add_features=3)
+        self.other_layer = LayerFactory(add_features=2)
+
+    def test_partition_layer(self):
+        call_command('partition_features', f'--layer-pk={self.layer.pk}', stdout=StringIO())
+
+        self.assertTrue(is_feature_table_partitioned())
+        self.assertIsNotNone(get_layer_partition(self.layer.pk))
+        self.assertIsNone(get_layer_partition(self.other_layer.pk))
+        self.assertEqual(self.layer.features.count(), 3)
+        self.assertEqual(self.other_layer.features.count(), 2)
+
+        # exclusion checks of moved layers are dropped once attached
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype = 'c' "
+                           "AND conname LIKE '%%layer%%'",
+                           [get_default_partition_name()])
+            constraints = [name for name, in cursor.fetchall()]
+        self.assertListEqual(constraints, [f'{get_default_partition_name()}_layer_id_check'])
+
+    def test_partition_large_layers(self):
+        call_command('partition_features', '--min-features=3', stdout=StringIO())
+
+        self.assertIsNotNone(get_layer_partition(self.layer.pk))
+        self.assertIsNone(get_layer_partition(self.other_layer.pk))
+
+    @patch('geostore.settings.GEOSTORE_FEATURE_PARTITIONING', True)
+    def test_partition_created_with_layer(self):
+        call_command('partition_features', stdout=StringIO())
+        layer = LayerFactory()
+        self.assertIsNotNone(get_layer_partition(layer.pk))
+
+        feature = FeatureFactory(layer=layer)
+        self.assertEqual(Feature.objects.get(pk=feature.pk).layer, layer)
+
+        layer.clear_features()
+        layer.delete()
+        self.assertIsNone(get_layer_partition(layer.pk))
+
+    @patch('geostore.settings.GEOSTORE_FEATURE_PARTITIONING', True)
+    def test_clear_features(self):
+        relation = LayerRelation.objects.create(name='relation', origin=self.other_layer, destination=self.layer)
+        FeatureRelation.objects.create(origin=self.other_layer.features.first(),
+                                       destination=self.layer.features.first(),
+                                       relation=relation)
+        call_command('partition_features', f'--layer-pk={self.layer.pk}', stdout=StringIO())
+
+        self.layer.clear_features()
+        self.assertEqual(self.layer.features.count(), 0)
+        self.assertEqual(self.other_layer.features.count(), 2)
+        self.assertFalse(FeatureRelation.objects.exists())
+        self.assertEqual(self.layer.get_statistics().feature_count, 0)
+
+        # layers without their own partition are cleared too
+        self.other_layer.clear_features()
+        self.assertEqual(self.other_layer.features.count(), 0)
+
+    def test_ddl_cursor_keeps_constraints_mode(self):
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TEMPORARY TABLE ddl_parent (id integer PRIMARY KEY)')
+            cursor.execute('CREATE TEMPORARY TABLE ddl_child '
+                           '(parent_id integer REFERENCES ddl_parent DEFERRABLE INITIALLY IMMEDIATE)')
+        with ddl_cursor():
+            pass
+
+        # initially immediate constraints are still checked on each statement
+        with self.assertRaises(IntegrityError), transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('INSERT INTO ddl_child VALUES (1)')
+
+        # and Django deferred foreign keys at commit
+        with transaction.atomic():
+            FeatureRelation.objects.create(origin_id=0, destination_id=0,
+                                           relation=LayerRelation.objects.create(origin=self.layer,
+                                                                                 destination=self.layer))
+            FeatureRelation.objects.all().delete()
+
+    def test_feature_references_enforced(self):
+        relation = LayerRelation.objects.create(name='relation', origin=self.layer, destination=self.other_layer)
+        feature = self.layer.features.first()
+        FeatureRelation.objects.create(origin=feature, destination=self.other_layer.features.first(),
+                                       relation=relation)
+        call_command('partition_features', f'--layer-pk={self.layer.pk}', stdout=StringIO())
+        # moved features keep their relations
+        self.assertEqual(FeatureRelation.objects.count(), 1)
+
+        # deleted features cascade, even out of Django
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {Feature._meta.db_table} WHERE id = %s', [feature.pk])
+        self.assertFalse(FeatureRelation.objects.exists())
+
+        # references to missing features are refused
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            FeatureRelation.objects.create(origin_id=feature.pk, destination=self.other_layer.features.first(),
+                                           relation=relation)
+            connection.check_constraints()
+
+    def test_unknown_feature_references_refused(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'CREATE TABLE unknown_reference (feature_id integer REFERENCES {Feature._meta.db_table})')
+
+        with self.assertRaisesRegex(CommandError, 'unknown_reference.feature_id'):
+            call_command('partition_features', stdout=StringIO())
+        self.assertFalse(is_feature_table_partitioned())
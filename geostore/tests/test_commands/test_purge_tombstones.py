@@ -0,0 +1,30 @@
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils.timezone import now
+
+from geostore.models import FeatureTombstone
+from geostore.tests.factories import FeatureFactory, LayerFactory
+
+
+class PurgeTombstonesTestCase(TestCase):
+    def setUp(self):
+        layer = LayerFactory()
+        FeatureFactory(layer=layer, identifier='old').delete()
+        FeatureFactory(layer=layer, identifier='recent').delete()
+        FeatureTombstone.objects.filter(identifier='old').update(deleted_at=now() - timedelta(days=31))
+
+    def test_purge_tombstones(self):
+        out = StringIO()
+        call_command('purge_tombstones', stdout=out)
+
+        self.assertListEqual(list(FeatureTombstone.objects.values_list('identifier', flat=True)), ['recent'])
+        self.assertEqual(out.getvalue(), '1 feature tombstones deleted\n')
+
+    @patch('geostore.settings.GEOSTORE_TOMBSTONES_RETENTION_DAYS', None)
+    def test_tombstones_kept(self):
+        call_command('purge_tombstones', stdout=StringIO())
+        self.assertEqual(FeatureTombstone.objects.count(), 2)
@@ -0,0 +1,27 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from geostore import GeometryTypes
+from geostore.models import LayerRelation
+from geostore.tests.factories import FeatureFactory, LayerSchemaFactory
+
+
+class SyncRelationsTestCase(TestCase):
+    def setUp(self):
+        self.layer_trek = LayerSchemaFactory(geom_type=GeometryTypes.LineString)
+        self.layer_city = LayerSchemaFactory(geom_type=GeometryTypes.Polygon)
+        self.trek = FeatureFactory(layer=self.layer_trek, geom='LINESTRING(0 0, 1 1, 2 2, 3 3)')
+        self.city = FeatureFactory(layer=self.layer_city, geom='POLYGON((0 0, 0 3, 3 3, 3 0, 0 0))')
+        self.relation = LayerRelation.objects.create(name='cities', relation_type='intersects',
+                                                     origin=self.layer_trek, destination=self.layer_city)
+
+    def test_sync_relations(self):
+        out = StringIO()
+        call_command('sync_relations', f'--relation-pk={self.relation.pk}', verbosity=2, stdout=out)
+
+        self.assertListEqual(list(self.trek.relations_as_origin.values_list('destination_id', flat=True)),
+                             [self.city.pk])
+        self.assertEqual(out.getvalue(), 'cities: 1/1 origin features\n'
+                                         'cities: 1 feature relations created, 0 deleted\n')
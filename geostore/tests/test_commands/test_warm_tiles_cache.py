@@ -0,0 +1,73 @@
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from geostore.models import TileHit
+from geostore.tests.factories import FeatureFactory, LayerFactory
+from geostore.tiles.helpers import VectorTile
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+    }})
+class WarmTilesCacheTestCase(TestCase):
+    def setUp(self):
+        self.layer = LayerFactory(name="layerPoint")
+        FeatureFactory(layer=self.layer, geom='POINT(1.37 43.60)')
+
+    @patch('geostore.settings.GEOSTORE_TILES_HITS_SAMPLING', 1)
+    def test_tile_hits_recorded(self):
+        for i in range(3):
+            self.client.get(reverse('layer-tiles', kwargs={'pk': self.layer.pk, 'z': 10, 'x': 515, 'y': 373}))
+        self.client.get(reverse('layer-tiles-batch', kwargs={'pk': self.layer.pk}),
+                        {'tiles': '10/515/373,10/516/373'})
+
+        self.assertListEqual(
+            list(self.layer.tile_hits.order_by('-hits').values_list('z', 'x', 'y', 'hits')),
+            [(10, 515, 373, 4), (10, 516, 373, 1)]
+        )
+
+    @patch('geostore.settings.GEOSTORE_TILES_HITS_SAMPLING', 1)
+    def test_invalid_tile_hits_not_recorded(self):
+        self.client.get(reverse('layer-tiles', kwargs={'pk': self.layer.pk, 'z': 10, 'x': 2 ** 31, 'y': 373}))
+        self.client.get(reverse('layer-tiles', kwargs={'pk': self.layer.pk, 'z': 30, 'x': 0, 'y': 0}))
+        self.assertFalse(TileHit.objects.exists())
+
+    def test_tile_hits_not_recorded_by_default(self):
+        self.client.get(reverse('layer-tiles', kwargs={'pk': self.layer.pk, 'z': 10, 'x': 515, 'y': 373}))
+        self.assertFalse(TileHit.objects.exists())
+
+    def test_hot_tiles_warmed(self):
+        TileHit.record([self.layer.pk], [(10, 515, 373), (10, 516, 373)], 10)
+        TileHit.record([self.layer.pk], [(10, 515, 374)], 1)
+        tile = VectorTile(self.layer)
+
+        call_command('warm_tiles_cache', '-n', 2, stdout=StringIO())
+
+        for x, y in ((515, 373), (516, 373)):
+            self.assertIsNotNone(cache.get(tile.get_tile_cache_key(x, y, 10), version=tile.cache_version))
+        self.assertIsNone(cache.get(tile.get_tile_cache_key(515, 374, 10), version=tile.cache_version))
+
+    @patch('geostore.settings.GEOSTORE_TILES_WARM_CELERY_ASYNC', True)
+    @patch('geostore.tiles.helpers.execute_async_func')
+    def test_warming_scheduled_once_after_updates(self, mock_async_func):
+        FeatureFactory(layer=self.layer)
+        FeatureFactory(layer=self.layer)
+        mock_async_func.assert_called_once()
+
+    @patch('geostore.settings.GEOSTORE_TILES_WARM_CELERY_ASYNC', True)
+    @patch('geostore.tiles.helpers.execute_async_func')
+    def test_warming_scheduled_after_bulk_updates(self, mock_async_func):
+        cache.clear()
+        self.layer.update_geometries([{
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [1.37, 43.60]},
+            'properties': {'name': 'Toulouse'},
+        }])
+        mock_async_func.assert_called_once()
+        self.assertEqual(mock_async_func.call_args.args[1], (self.layer.pk,))
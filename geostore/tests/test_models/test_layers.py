@@ -1,12 +1,20 @@
 import csv
 import json
 import tempfile
+from io import StringIO
+from unittest.mock import patch
 
 from django.contrib.gis.geos import GEOSException, GEOSGeometry, Point
-from django.test import TestCase
+from django.contrib.postgres.search import SearchVector
+from django.db import connection, transaction
+from django.db.models import Value
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from rest_framework.test import APIClient
 
-from geostore.models import Layer
+from geostore import GeometryTypes
+from geostore.db.indexes import get_existing_properties_indexes, get_layer_properties_indexes, sync_properties_indexes
+from geostore.models import Feature, Layer, LayerStatistics
 from geostore.tests.factories import (FeatureFactory, LayerFactory,
                                       LayerSchemaFactory, UserFactory)
 from geostore.tests.utils import get_files_tests
@@ -44,6 +52,284 @@ class LayerModelTestCase(TestCase):
         self.assertIsNone(self.layer_schema.get_property_type('unknown'))
 
 
+class LayerUpdateGeometriesTestCase(TestCase):
+    def setUp(self):
+        self.layer = LayerFactory()
+        self.feature_a = FeatureFactory(layer=self.layer, geom='LINESTRING(0 0, 1 1)', properties={'name': 'a'})
+        self.feature_b = FeatureFactory(layer=self.layer, geom='LINESTRING(0 0, 1 1.1)', properties={'name': 'b'})
+        self.feature_c = FeatureFactory(layer=self.layer, geom='POINT(10 10)', properties={'name': 'c'})
+
+    def get_feature(self, coordinates, **properties):
+        return {
+            'type': 'Feature',
+            'geometry': {'type': 'LineString', 'coordinates': coordinates},
+            'properties': properties,
+        }
+
+    def test_update_nearest_features(self):
+        modified = self.layer.update_geometries([
+            self.get_feature([[0, 0], [1, 1.09]], name='b2'),
+            self.get_feature([[0, 0], [1, 0.99]], name='a2'),
+            # no bounding box overlapping feature
+            self.get_feature([[50, 50], [51, 51]], name='d'),
+        ])
+
+        self.assertEqual(sorted(modified.values_list('pk', flat=True)), [self.feature_a.pk, self.feature_b.pk])
+        self.assertEqual(sorted(self.layer.features.values_list('properties__name', flat=True)), ['a2', 'b2', 'c'])
+
+    def test_last_feature_wins(self):
+        self.layer.update_geometries([
+            self.get_feature([[0, 0], [1, 1]], name='first'),
+            self.get_feature([[0, 0], [1, 1]], name='last'),
+        ])
+        self.feature_a.refresh_from_db()
+        self.assertEqual(self.feature_a.properties, {'name': 'last'})
+
+
+class LayerPropertiesIndexesTestCase(TransactionTestCase):
+    def setUp(self):
+        self.layer = LayerSchemaFactory()
+
+    def test_indexes_created_with_schema(self):
+        indexes = get_existing_properties_indexes(self.layer.pk)
+        self.assertEqual(len(indexes), 3)
+        self.assertSetEqual(indexes, set(get_layer_properties_indexes(self.layer)))
+
+    def test_indexes_follow_schema_changes(self):
+        indexes = get_existing_properties_indexes(self.layer.pk)
+        self.layer.schema = {
+            'type': 'object',
+            'properties': {
+                'name': {'type': 'string'},
+                'age': {'type': 'number'},
+                'tags': {'type': 'array'},
+            }
+        }
+        self.layer.save()
+
+        new_indexes = get_existing_properties_indexes(self.layer.pk)
+        self.assertEqual(len(new_indexes), 2)
+        # name index is kept, age one is replaced by its new type and country one is dropped
+        self.assertEqual(len(indexes & new_indexes), 1)
+
+        layer_pk = self.layer.pk
+        self.layer.delete()
+        self.assertSetEqual(get_existing_properties_indexes(layer_pk), set())
+
+    def test_indexes_not_built_in_transaction(self):
+        with transaction.atomic():
+            layer = LayerSchemaFactory()
+            # a non-concurrent build would lock features writes
+            with self.assertLogs('geostore.db.indexes', 'WARNING'):
+                self.assertFalse(sync_properties_indexes(layer))
+            self.assertSetEqual(get_existing_properties_indexes(layer.pk), set())
+        # built after commit
+        self.assertEqual(len(get_existing_properties_indexes(layer.pk)), 3)
+
+    def test_ordering_by_typed_value(self):
+        FeatureFactory(layer=self.layer, properties={'name': 'b', 'age': 10})
+        FeatureFactory(layer=self.layer, properties={'name': 'a', 'age': 9})
+        FeatureFactory(layer=self.layer, properties={'name': 'c', 'age': 'unknown'})
+
+        features = self.layer.features.order_by(self.layer.get_property_expression('age').asc(nulls_last=True))
+        self.assertListEqual([f.properties['name'] for f in features], ['a', 'b', 'c'])
+        self.assertIsNone(self.layer.get_property_expression('unknown'))
+
+
+class LayerSearchVectorsTestCase(TestCase):
+    def setUp(self):
+        self.layer = LayerSchemaFactory(settings={'search': {'enabled': True}})
+        self.feature = FeatureFactory(layer=self.layer, properties={'name': 'Cahors', 'country': 'France'})
+
+    def get_search_vector(self):
+        return Feature.objects.values_list('search_vector', flat=True).get(pk=self.feature.pk)
+
+    def test_search_vector_computed_on_save(self):
+        self.assertEqual(self.get_search_vector(), "'cahors':2A 'france':1B")
+
+        self.feature.properties = {'name': 'Toulouse'}
+        with CaptureQueriesContext(connection) as queries:
+            self.feature.save(update_fields=['properties'])
+        # vector is written with properties
+        self.assertEqual(len([query for query in queries.captured_queries
+                              if query['sql'].startswith(f'UPDATE "{Feature._meta.db_table}"')]), 1)
+        self.assertEqual(self.get_search_vector(), "'toulouse':1A")
+
+    def test_search_vector_computed_on_queryset_update(self):
+        Feature.objects.filter(properties__name='Cahors').update(properties={'name': 'Albi'})
+        self.assertEqual(self.get_search_vector(), "'albi':1A")
+
+    def test_search_vectors_computed_after_bulk_import(self):
+        Feature.objects.filter(pk=self.feature.pk).update(search_vector=SearchVector(Value('kept'), config='simple'))
+        reader = csv.DictReader(StringIO('name,country,x,y\nAlbi,France,2.14,43.93\n'))
+        self.layer.from_csv_dictreader(reader=reader, pk_properties=['name'], options={'longitude': 'x', 'latitude': 'y'},
+                                       operations=[set_geometry_from_options], init=True)
+
+        self.assertEqual(Feature.objects.values_list('search_vector', flat=True).get(properties__name='Albi'),
+                         "'albi':2A 'france':1B")
+        # vectors of existing features are not written again
+        self.assertEqual(self.get_search_vector(), "'kept':1")
+
+    def test_search_disabled_by_default(self):
+        layer = LayerSchemaFactory()
+        feature = FeatureFactory(layer=layer, properties={'name': 'Cahors'})
+        self.assertFalse(layer.is_searchable)
+        self.assertIsNone(Feature.objects.values_list('search_vector', flat=True).get(pk=feature.pk))
+
+    def test_search_vectors_refreshed_with_search_settings(self):
+        layer = Layer.objects.get(pk=self.layer.pk)
+        layer.settings = {'search': {'enabled': True, 'properties': {'country': 'A'}}}
+        with self.captureOnCommitCallbacks(execute=True):
+            layer.save()
+        self.assertEqual(self.get_search_vector(), "'france':1A")
+
+        layer.settings = {'search': {'enabled': True, 'properties': {}}}
+        with self.captureOnCommitCallbacks(execute=True):
+            layer.save()
+        self.assertIsNone(self.get_search_vector())
+        self.assertFalse(layer.is_searchable)
+
+
+class LayerStatisticsTestCase(TestCase):
+    def setUp(self):
+        self.layer = LayerFactory()
+
+    def test_statistics_computed_on_read(self):
+        FeatureFactory(layer=self.layer, geom='POINT(1 2)', properties={'name': 'foo'})
+        FeatureFactory(layer=self.layer, geom='POINT(3 4)', properties={'age': 5})
+        self.assertFalse(LayerStatistics.objects.filter(layer=self.layer).exists())
+
+        statistics = self.layer.get_statistics()
+        self.assertEqual(statistics.feature_count, 2)
+        self.assertEqual(statistics.geom_type, GeometryTypes.Point)
+        self.assertEqual(statistics.extent, (1, 2, 3, 4))
+        self.assertEqual(self.layer.layer_properties, {'age': 'str', 'name': 'str'})
+
+    def test_statistics_updated_on_feature_creation(self):
+        FeatureFactory(layer=self.layer, geom='POINT(1 2)', properties={'name': 'foo'})
+        self.layer.refresh_statistics()
+
+        FeatureFactory(layer=self.layer, geom='LINESTRING(0 0, 5 1)', properties={'age': 5})
+        statistics = LayerStatistics.objects.get(layer=self.layer)
+        self.assertFalse(statistics.dirty)
+        self.assertEqual(statistics.feature_count, 2)
+        self.assertEqual(statistics.geom_type, GeometryTypes.Point)
+        self.assertEqual(statistics.extent, (0, 0, 5, 2))
+        self.assertEqual(statistics.properties, {'age': True, 'name': True})
+
+    def test_statistics_outdated_on_feature_changes(self):
+        feature = FeatureFactory(layer=self.layer, geom='POINT(1 2)', properties={'name': 'foo'})
+        FeatureFactory(layer=self.layer, geom='POINT(3 4)')
+        self.layer.refresh_statistics()
+
+        feature.properties = {}
+        feature.save()
+        self.assertTrue(LayerStatistics.objects.get(layer=self.layer).dirty)
+        self.assertEqual(Layer.objects.get(pk=self.layer.pk).layer_properties, {})
+
+        self.layer.features.filter(pk=feature.pk).delete()
+        layer = Layer.objects.get(pk=self.layer.pk)
+        self.assertEqual(layer.get_statistics().feature_count, 1)
+        self.assertEqual(layer.get_extent(srid=4326)['extent'], (3, 4, 3, 4))
+
+    def test_statistics_outdated_on_feature_move(self):
+        other_layer = LayerFactory()
+        FeatureFactory(layer=self.layer)
+        self.layer.refresh_statistics()
+        other_layer.refresh_statistics()
+
+        feature = Feature.objects.get(layer=self.layer)
+        feature.layer = other_layer
+        feature.save()
+        self.assertEqual(Layer.objects.get(pk=self.layer.pk).get_statistics().feature_count, 0)
+        self.assertEqual(Layer.objects.get(pk=other_layer.pk).get_statistics().feature_count, 1)
+
+    def test_statistics_outdated_on_queryset_move(self):
+        other_layer = LayerFactory()
+        FeatureFactory(layer=self.layer)
+        self.layer.refresh_statistics()
+        other_layer.refresh_statistics()
+
+        self.layer.features.update(layer=other_layer)
+        self.assertEqual(Layer.objects.get(pk=self.layer.pk).get_statistics().feature_count, 0)
+        self.assertEqual(Layer.objects.get(pk=other_layer.pk).get_statistics().feature_count, 1)
+
+    def test_statistics_refresh_existing(self):
+        statistics = self.layer.refresh_statistics()
+        FeatureFactory(layer=self.layer)
+        LayerStatistics.mark_dirty([self.layer.pk])
+        # statistics row is updated in place
+        self.assertEqual(self.layer.refresh_statistics().pk, statistics.pk)
+        self.assertEqual(LayerStatistics.objects.get(layer=self.layer).feature_count, 1)
+
+    def test_statistics_refreshed_after_import(self):
+        self.layer.from_geojson(json.dumps({
+            "type": "FeatureCollection",
+            "features": [{
+                "type": "Feature",
+                "properties": {"foo": "bar"},
+                "geometry": {"type": "Point", "coordinates": [1, 2]},
+            }]
+        }))
+        statistics = LayerStatistics.objects.get(layer=self.layer)
+        self.assertFalse(statistics.dirty)
+        self.assertEqual(statistics.feature_count, 1)
+        self.assertEqual(statistics.properties, {'foo': True})
+
+    def test_facets_maintained_on_feature_creation(self):
+        FeatureFactory(layer=self.layer, properties={'country': 'France', 'code': 1})
+        FeatureFactory(layer=self.layer, properties={'country': 'France', 'code': 2})
+        self.assertEqual(self.layer.get_statistics().get_facets(), {
+            'country': {'"France"': 2},
+            'code': {'1': 1, '2': 1},
+        })
+
+        FeatureFactory(layer=self.layer, properties={'country': 'Canada', 'code': None})
+        FeatureFactory(layer=self.layer, properties={})
+        statistics = LayerStatistics.objects.get(layer=self.layer)
+        self.assertEqual(statistics.facets, {
+            'country': {'"France"': 2, '"Canada"': 1},
+            'code': {'1': 1, '2': 1},
+        })
+        self.assertEqual(self.layer.get_property_facets(['country', 'code'], limit=2), {
+            'country': [{'value': 'France', 'count': 2}, {'value': 'Canada', 'count': 1}],
+            'code': [{'value': None, 'count': 2}, {'value': 1, 'count': 1}],
+        })
+
+    @patch('geostore.settings.GEOSTORE_FACETS_MAX_CARDINALITY', 1)
+    def test_facets_high_cardinality(self):
+        FeatureFactory(layer=self.layer, properties={'country': 'France', 'code': 1})
+        FeatureFactory(layer=self.layer, properties={'country': 'France', 'code': 2})
+        self.assertEqual(self.layer.get_statistics().get_facets(), {'country': {'"France"': 2}})
+        self.assertEqual(self.layer.get_property_facets(['code']), {
+            'code': [{'value': 1, 'count': 1}, {'value': 2, 'count': 1}],
+        })
+
+    @patch('geostore.settings.GEOSTORE_FACETS_MAX_CARDINALITY', 1)
+    def test_facets_cardinality_growth(self):
+        FeatureFactory(layer=self.layer, properties={'country': 'France', 'code': 1})
+        self.assertEqual(self.layer.get_statistics().get_facets(), {'country': {'"France"': 1}, 'code': {'1': 1}})
+
+        FeatureFactory(layer=self.layer, properties={'country': 'France', 'code': 2})
+        statistics = LayerStatistics.objects.get(layer=self.layer)
+        self.assertEqual(statistics.facets, {'country': {'"France"': 2}})
+        self.assertEqual(self.layer.get_property_facets(['code']), {
+            'code': [{'value': 1, 'count': 1}, {'value': 2, 'count': 1}],
+        })
+
+    def test_extent_transformed(self):
+        FeatureFactory(layer=self.layer, geom='POINT(0 0)')
+        FeatureFactory(layer=self.layer, geom='POINT(1 1)')
+        xmin, ymin, xmax, ymax = self.layer.get_extent()['extent']
+        self.assertAlmostEqual(xmin, 0)
+        self.assertAlmostEqual(ymin, 0)
+        self.assertAlmostEqual(xmax, 111319.49, places=1)
+        self.assertAlmostEqual(ymax, 111325.14, places=1)
+
+    def test_empty_layer_extent(self):
+        self.assertEqual(self.layer.get_extent(), {'extent': None})
+
+
 class LayerFromCSVDictReaderTestCase(TestCase):
     def setUp(self):
         self.layer = Layer.objects.create(name='fake layer')
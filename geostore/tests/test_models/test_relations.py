@@ -1,6 +1,11 @@
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.db import transaction
 from django.test import TestCase
 from geostore import GeometryTypes
-from geostore.models import LayerRelation
+from geostore.models import FeatureRelation, LayerRelation, PendingRelationFeature
+from geostore.tasks import relation_sync_pending_features
 
 from geostore.tests.factories import LayerSchemaFactory, FeatureFactory
 
@@ -70,3 +75,134 @@ class LayerRelationTestCase(TestCase):
 
     def test_relation_property(self):
         self.assertEqual(self.trek.relations, {})
+
+    def get_relations(self, relation):
+        return set(FeatureRelation.objects.filter(relation=relation).values_list('origin_id', 'destination_id'))
+
+    def test_sync_features_intersects(self):
+        relation = LayerRelation.objects.create(relation_type='intersects', origin=self.layer_trek,
+                                                destination=self.layer_city)
+        self.assertEqual(relation.sync_features(), (1, 0))
+        self.assertSetEqual(self.get_relations(relation), {(self.trek.pk, self.city_cover.pk)})
+
+        # stored relations are kept, outdated ones deleted
+        self.city_uncover.geom = 'POLYGON((2 2, 2 7, 7 7, 7 2, 2 2))'
+        self.city_uncover.save()
+        self.city_cover.geom = 'POLYGON((8 8, 8 9, 9 9, 9 8, 8 8))'
+        self.city_cover.save()
+        self.assertEqual(relation.sync_features(), (1, 1))
+        self.assertSetEqual(self.get_relations(relation), {(self.trek.pk, self.city_uncover.pk)})
+        self.assertEqual(relation.sync_features(), (0, 0))
+
+    def test_sync_features_distance(self):
+        relation = LayerRelation.objects.create(relation_type='distance', origin=self.layer_trek,
+                                                destination=self.layer_city, settings={'distance': 1000})
+        near_city = FeatureFactory(layer=self.layer_city, geom='POLYGON((3.005 3, 3.005 4, 4 4, 4 3, 3.005 3))')
+        relation.sync_features()
+        self.assertSetEqual(self.get_relations(relation),
+                            {(self.trek.pk, self.city_cover.pk), (self.trek.pk, near_city.pk)})
+
+    def test_sync_features_exclude(self):
+        relation = LayerRelation.objects.create(relation_type='intersects', origin=self.layer_trek,
+                                                destination=self.layer_city,
+                                                exclude={'pk__in': [self.city_cover.pk]})
+        relation.sync_features()
+        self.assertSetEqual(self.get_relations(relation), set())
+
+    @patch('geostore.settings.GEOSTORE_RELATION_SYNC_BATCH_SIZE', 1)
+    def test_sync_features_batches(self):
+        relation = LayerRelation.objects.create(relation_type='intersects', origin=self.layer_city,
+                                                destination=self.layer_trek)
+        progress = []
+        self.assertEqual(relation.sync_features(lambda done, total: progress.append((done, total))), (1, 0))
+        self.assertListEqual(progress, [(1, 2), (2, 2), (2, 2)])
+        self.assertSetEqual(self.get_relations(relation), {(self.city_cover.pk, self.trek.pk)})
+
+    def test_sync_features_manual(self):
+        relation = LayerRelation.objects.create(origin=self.layer_trek, destination=self.layer_city)
+        FeatureRelation.objects.create(origin=self.trek, destination=self.city_uncover, relation=relation)
+        self.assertEqual(relation.sync_features(), (0, 0))
+        self.assertSetEqual(self.get_relations(relation), {(self.trek.pk, self.city_uncover.pk)})
+
+    def test_sync_changed_destination_features(self):
+        relation = LayerRelation.objects.create(relation_type='intersects', origin=self.layer_trek,
+                                                destination=self.layer_city)
+        relation.sync_features()
+        other_trek = FeatureFactory(layer=self.layer_trek, geom='LINESTRING(5 5, 6 6)')
+
+        self.city_cover.geom = 'POLYGON((8 8, 8 9, 9 9, 9 8, 8 8))'
+        self.city_cover.save()
+        # not synchronized origin features are synchronized with their changed destinations
+        self.assertEqual(relation.sync_changed_features([self.city_cover.pk, self.city_uncover.pk]), (1, 1))
+        self.assertSetEqual(self.get_relations(relation), {(other_trek.pk, self.city_uncover.pk)})
+
+    def test_sync_changed_origin_features(self):
+        relation = LayerRelation.objects.create(relation_type='distance', origin=self.layer_trek,
+                                                destination=self.layer_city, settings={'distance': 1000})
+        relation.sync_features()
+
+        self.trek.geom = 'LINESTRING(4.5 4.5, 5 5)'
+        self.trek.save()
+        self.assertEqual(relation.sync_changed_features([self.trek.pk]), (1, 1))
+        self.assertSetEqual(self.get_relations(relation), {(self.trek.pk, self.city_uncover.pk)})
+
+    @patch('geostore.settings.GEOSTORE_RELATION_SYNC_BATCH_SIZE', 1)
+    def test_sync_changed_features_batches(self):
+        relation = LayerRelation.objects.create(relation_type='intersects', origin=self.layer_city,
+                                                destination=self.layer_city)
+        self.assertEqual(relation.sync_changed_features([self.city_uncover.pk, self.city_cover.pk,
+                                                         self.city_cover.pk]), (2, 0))
+        self.assertSetEqual(self.get_relations(relation), {(self.city_cover.pk, self.city_cover.pk),
+                                                           (self.city_uncover.pk, self.city_uncover.pk)})
+
+    @patch('geostore.settings.GEOSTORE_RELATION_CELERY_ASYNC', True)
+    @patch('geostore.relations.relation_sync_pending_features')
+    def test_changed_features_dispatch(self, mock_task):
+        cache.clear()
+        relation = LayerRelation.objects.create(relation_type='intersects', origin=self.layer_trek,
+                                                destination=self.layer_city)
+        manual_relation = LayerRelation.objects.create(origin=self.layer_trek, destination=self.layer_city)
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            for feature in (self.city_cover, self.city_cover, self.city_uncover, self.trek):
+                feature.save()
+        # changes are collected by transaction, and dispatched by relation once
+        self.assertEqual(len(callbacks), 1)
+        mock_task.apply_async.assert_called_once_with((relation.pk,), countdown=10)
+        self.assertSetEqual(set(relation.pending_features.values_list('feature_id', flat=True)),
+                            {self.city_cover.pk, self.city_uncover.pk, self.trek.pk})
+        self.assertFalse(manual_relation.pending_features.exists())
+
+    @patch('geostore.settings.GEOSTORE_RELATION_CELERY_ASYNC', True)
+    @patch('geostore.relations.relation_sync_pending_features')
+    def test_changed_features_savepoint_rollback(self, mock_task):
+        cache.clear()
+        relation = LayerRelation.objects.create(relation_type='intersects', origin=self.layer_trek,
+                                                destination=self.layer_city)
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            # first collected feature is discarded with its savepoint
+            with self.assertRaises(ValueError), transaction.atomic():
+                FeatureFactory(layer=self.layer_city, geom='POINT(0 0)')
+                raise ValueError
+            self.city_cover.save()
+            # and discarded from the transaction changes when collected later
+            with self.assertRaises(ValueError), transaction.atomic():
+                FeatureFactory(layer=self.layer_city, geom='POINT(0 0)')
+                raise ValueError
+        self.assertEqual(len(callbacks), 1)
+        self.assertSetEqual(set(relation.pending_features.values_list('feature_id', flat=True)),
+                            {self.city_cover.pk})
+
+    @patch('geostore.settings.GEOSTORE_RELATION_SYNC_BATCH_SIZE', 1)
+    def test_sync_pending_features(self):
+        relation = LayerRelation.objects.create(relation_type='intersects', origin=self.layer_trek,
+                                                destination=self.layer_city)
+        cache.set(relation.pending_sync_cache_key, True)
+        for feature in (self.city_cover, self.city_uncover):
+            PendingRelationFeature.objects.create(relation=relation, feature_id=feature.pk)
+
+        relation_sync_pending_features(relation.pk)
+        self.assertSetEqual(self.get_relations(relation), {(self.trek.pk, self.city_cover.pk)})
+        self.assertFalse(PendingRelationFeature.objects.exists())
+        self.assertIsNone(cache.get(relation.pending_sync_cache_key))
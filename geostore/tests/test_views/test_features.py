@@ -1,5 +1,9 @@
+import json
+from datetime import timedelta
 from unittest.mock import patch, PropertyMock
 
+from django.db import connection
+from django.db.models import F
 from django.test import TestCase, override_settings
 from django.urls import reverse
 from rest_framework import status
@@ -7,7 +11,8 @@ from rest_framework.pagination import PageNumberPagination
 from rest_framework.test import APITestCase
 
 from geostore import GeometryTypes
-from geostore.models import LayerRelation
+from geostore.models import Feature, LayerRelation
+from geostore.pagination import FeatureCursorPagination, FeatureEstimatedCountPagination
 from geostore.tests.factories import (FeatureFactory, LayerFactory, LayerSchemaFactory, UserFactory)
 
 
@@ -67,6 +72,26 @@ class FeaturesListViewTest(TestCase):
     def setUp(self):
         self.layer = LayerFactory.create(add_features=5)
 
+    def test_features_list_urls(self):
+        other_layer = LayerFactory()
+        relation = LayerRelation.objects.create(name='relation', origin=self.layer, destination=other_layer)
+        FeatureFactory(layer=self.layer, identifier='with space:é')
+
+        response = self.client.get(reverse('feature-list', kwargs={'layer': self.layer.pk}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        features = response.json()
+        self.assertEqual(len(features), 6)
+        for feature in features:
+            self.assertDictEqual(feature['geometry_files'], {
+                name: reverse('feature-detail', kwargs={'layer': self.layer.pk,
+                                                        'identifier': feature['identifier'],
+                                                        'format': file_format})
+                for name, file_format in (('GeoJSON', 'geojson'), ('KML', 'kml'), ('GPX', 'gpx'))
+            })
+            self.assertDictEqual(feature['relations'], {
+                'relation': reverse('feature-relation', args=(self.layer.pk, feature['identifier'], relation.pk))
+            })
+
     def test_features_filter_by_properties(self):
         layer = LayerFactory()
         FeatureFactory(
@@ -166,6 +191,45 @@ class FeaturesListViewTest(TestCase):
         json_response = response.json()
         self.assertEqual(len(json_response), 2)
 
+    def test_features_ordering_by_schema_property(self):
+        layer = LayerSchemaFactory()
+        for name, age in (('b', 10), ('a', 9), ('c', 100)):
+            FeatureFactory(layer=layer, geom=self.fake_geometry, properties={'name': name, 'age': age})
+
+        response = self.client.get(
+            reverse('feature-list', kwargs={'layer': layer.pk}),
+            {'ordering': '-properties__age'},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertListEqual([feature['properties']['name'] for feature in response.json()], ['c', 'b', 'a'])
+
+    def test_features_full_text_search(self):
+        layer = LayerSchemaFactory(settings={'search': {'enabled': True, 'config': 'english'}})
+        for name, country in (('Cahors', 'France'), ('Rivers of France', 'Spain'), ('Bilbao', 'Spain')):
+            FeatureFactory(layer=layer, geom=self.fake_geometry, properties={'name': name, 'country': country})
+
+        response = self.client.get(reverse('feature-list', kwargs={'layer': layer.pk}), {'search': 'france'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # required name property weights more than country
+        self.assertListEqual([feature['properties']['name'] for feature in response.json()],
+                             ['Rivers of France', 'Cahors'])
+
+        response = self.client.get(reverse('feature-list', kwargs={'layer': layer.pk}),
+                                   {'search': 'river -cahors', 'ordering': 'id'})
+        self.assertListEqual([feature['properties']['name'] for feature in response.json()], ['Rivers of France'])
+
+    def test_features_fuzzy_search(self):
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        layer = LayerSchemaFactory(settings={'search': {'enabled': True, 'trigram': True}})
+        FeatureFactory(layer=layer, geom=self.fake_geometry, properties={'name': 'Toulouse'})
+        FeatureFactory(layer=layer, geom=self.fake_geometry, properties={'name': 'Bordeaux'})
+
+        response = self.client.get(reverse('feature-list', kwargs={'layer': layer.pk}),
+                                   {'search': 'Tolouse', 'search_mode': 'fuzzy'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertListEqual([feature['properties']['name'] for feature in response.json()], ['Toulouse'])
+
     def test_feature_from_layer_name(self):
         layer = LayerFactory()
         feature = FeatureFactory(
@@ -196,11 +260,37 @@ class FeaturesListViewTest(TestCase):
             reverse('feature-list', kwargs={'layer': self.layer.pk, 'format': 'geojson'})
         )
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        data = response.json()
+        data = json.loads(b''.join(response.streaming_content))
         self.assertListEqual(sorted(list(('features', 'type'))), sorted(list(data.keys())))
         self.assertEqual(data['type'], "FeatureCollection")
         self.assertEqual(len(data['features']), self.layer.features.count())
 
+    @patch('geostore.settings.GEOSTORE_GEOJSON_CHUNK_SIZE', 2)
+    def test_geojson_db_rendering(self):
+        feature = FeatureFactory(layer=self.layer, geom=self.fake_geometry, identifier='with space',
+                                 properties={'name': 'test'})
+        url = reverse('feature-list', kwargs={'layer': self.layer.pk, 'format': 'geojson'})
+        response = self.client.get(url, {'ordering': '-id'})
+        self.assertTrue(response.streaming)
+        features = json.loads(b''.join(response.streaming_content))['features']
+        self.assertEqual(len(features), 6)
+
+        with patch('geostore.settings.GEOSTORE_GEOJSON_DB_RENDERING', False):
+            expected = self.client.get(url, {'ordering': '-id'}).json()['features']
+        self.assertEqual(features[0]['id'], feature.pk)
+        self.assertDictEqual(features[0]['properties'], expected[0]['properties'])
+        self.assertDictEqual(features[0]['geometry'], {'type': 'Point', 'coordinates': [2.0, 45.0]})
+        self.assertListEqual([feature['id'] for feature in features], [feature['id'] for feature in expected])
+
+    @patch('geostore.views.FeatureViewSet.pagination_class', PageNumberPagination)
+    @patch('rest_framework.pagination.PageNumberPagination.page_size', 2)
+    def test_geojson_db_rendering_paginated(self):
+        response = self.client.get(reverse('feature-list', kwargs={'layer': self.layer.pk, 'format': 'geojson'}))
+        data = response.json()
+        self.assertEqual(data['count'], 5)
+        self.assertEqual(data['results']['type'], 'FeatureCollection')
+        self.assertEqual(len(data['results']['features']), 2)
+
 
 @override_settings(GEOSTORE_RELATION_CELERY_ASYNC=True)
 class FeatureDetailTestCase(APITestCase):
@@ -223,6 +313,44 @@ class FeatureDetailTestCase(APITestCase):
         response = self.client.get(self.detail_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_feature_detail_geometry_output(self):
+        response = self.client.get(self.detail_url, {'simplify': 1, 'precision': 0, 'srid': 3857})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        coordinates = response.json()['geom']['coordinates'][0]
+        self.assertEqual(len(coordinates), 5)
+        self.assertTrue(all(coordinate == round(coordinate) for point in coordinates for coordinate in point))
+
+    def test_feature_detail_geometry_output_cache(self):
+        params = {'precision': 0}
+        response = self.client.get(self.detail_url, params)
+        self.assertEqual(response.json()['geom']['coordinates'][0][0], [4.0, 4.0])
+
+        # cached for the layer version
+        Feature.objects.filter(pk=self.city_uncover.pk).update(geom='POLYGON((5 5, 5 7, 7 7, 7 5, 5 5))')
+        response = self.client.get(self.detail_url, params)
+        self.assertEqual(response.json()['geom']['coordinates'][0][0], [4.0, 4.0])
+
+        # new layer version
+        Feature.objects.filter(pk=self.city_uncover.pk).update(updated_at=F('updated_at') + timedelta(seconds=1))
+        response = self.client.get(self.detail_url, params)
+        self.assertEqual(response.json()['geom']['coordinates'][0][0], [5.0, 5.0])
+
+    def test_feature_list_geometry_output(self):
+        url = reverse('feature-list', args=(self.layer_trek.pk, ))
+        response = self.client.get(url, {'simplify': 0.5, 'precision': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()[0]['geom']['coordinates'], [[0.0, 0.0], [3.0, 3.0]])
+
+        url = reverse('feature-list', kwargs={'layer': self.layer_trek.pk, 'format': 'geojson'})
+        response = self.client.get(url, {'simplify': 0.5})
+        features = json.loads(b''.join(response.streaming_content))['features']
+        self.assertEqual(features[0]['geometry']['coordinates'], [[0.0, 0.0], [3.0, 3.0]])
+
+    def test_feature_geometry_output_invalid(self):
+        response = self.client.get(self.detail_url, {'simplify': -1, 'precision': 'a', 'srid': 1})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertSetEqual(set(response.json()), {'simplify', 'precision', 'srid'})
+
     def test_feature_patch_keep_properties(self):
         response = self.client.patch(self.detail_url, data={"properties": {"name": "Divona"}})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -340,3 +468,145 @@ class FeatureDetailTestCase(APITestCase):
         data = response.json()
         self.assertEqual(len(data['results']), 1, data)
         self.assertTrue(mock_view.called)
+
+
+@patch('geostore.views.FeatureViewSet.pagination_class', FeatureCursorPagination)
+class FeatureCursorPaginationTestCase(APITestCase):
+    def setUp(self):
+        self.layer = LayerSchemaFactory()
+        self.features = [
+            FeatureFactory(layer=self.layer, properties={'name': name, 'age': age})
+            for name, age in (('a', 30), ('b', None), ('c', 10), ('d', 30), ('e', 20))
+        ]
+        self.url = reverse('feature-list', kwargs={'layer': self.layer.pk})
+
+    def crawl(self, params):
+        names, url, params = [], self.url, dict(params, page_size=2)
+        while url:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            data = response.json()
+            self.assertLessEqual(len(data['results']), 2)
+            names += [feature['properties']['name'] for feature in data['results']]
+            url, params = data['next'], {}
+        return names
+
+    def test_crawl_by_id(self):
+        self.assertListEqual(self.crawl({}), ['a', 'b', 'c', 'd', 'e'])
+
+    def test_crawl_by_updated_at(self):
+        self.features[0].save()
+        self.assertListEqual(self.crawl({'ordering': '-updated_at'}), ['a', 'e', 'd', 'c', 'b'])
+
+    def test_crawl_by_schema_property(self):
+        self.assertListEqual(self.crawl({'ordering': 'properties__age'}), ['c', 'e', 'a', 'd', 'b'])
+        self.assertListEqual(self.crawl({'ordering': '-properties__age'}), ['b', 'a', 'd', 'e', 'c'])
+
+    def test_previous_page(self):
+        response = self.client.get(self.url, {'page_size': 2, 'ordering': 'properties__age'})
+        self.assertIsNone(response.json()['previous'])
+        response = self.client.get(response.json()['next'])
+        response = self.client.get(response.json()['previous'])
+        data = response.json()
+        self.assertListEqual([feature['properties']['name'] for feature in data['results']], ['c', 'e'])
+        self.assertIsNone(data['previous'])
+
+    def test_crawl_by_search_rank(self):
+        layer = LayerSchemaFactory(settings={'search': {'enabled': True}})
+        for name in ('river a', 'river b', 'lake', 'river c', 'river d', 'river e'):
+            FeatureFactory(layer=layer, properties={'name': name})
+        self.url = reverse('feature-list', kwargs={'layer': layer.pk})
+        # equal ranks are neither skipped nor repeated between pages
+        self.assertListEqual(self.crawl({'search': 'river'}), ['river a', 'river b', 'river c', 'river d', 'river e'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'cursor': 'invalid'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@patch('geostore.views.FeatureViewSet.pagination_class', FeatureEstimatedCountPagination)
+class FeatureEstimatedCountPaginationTestCase(APITestCase):
+    def setUp(self):
+        self.layer = LayerFactory(add_features=5)
+        self.url = reverse('feature-list', kwargs={'layer': self.layer.pk})
+
+    @patch('geostore.settings.GEOSTORE_ESTIMATED_COUNT_THRESHOLD', 1000)
+    def test_exact_count(self):
+        response = self.client.get(self.url, {'page_size': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(data['count'], 5)
+        self.assertTrue(data['count_exact'])
+        self.assertEqual(len(data['results']), 2)
+        self.assertIsNotNone(data['next'])
+
+    @patch('geostore.settings.GEOSTORE_ESTIMATED_COUNT_THRESHOLD', 1)
+    def test_estimated_count(self):
+        response = self.client.get(self.url, {'page_size': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertFalse(data['count_exact'])
+        self.assertGreaterEqual(data['count'], 1)
+        self.assertEqual(len(data['results']), 3)
+
+        # pages are not bounded by the estimate
+        response = self.client.get(data['next'])
+        data = response.json()
+        self.assertEqual(len(data['results']), 2)
+        self.assertIsNone(data['next'])
+
+    def test_estimated_count_queryset(self):
+        features = Feature.objects.filter(layer=self.layer)
+        self.assertEqual(features.estimated_count(threshold=0), (5, True))
+        self.assertEqual(features.estimated_count(threshold=10 ** 9), (5, True))
+
+
+class FeatureSpatialFilterTestCase(APITestCase):
+    def setUp(self):
+        self.layer = LayerFactory()
+        self.origin = FeatureFactory(layer=self.layer, geom='POINT(0 0)', properties={'name': 'origin'})
+        self.near = FeatureFactory(layer=self.layer, geom='POINT(1 1)', properties={'name': 'near'})
+        self.far = FeatureFactory(layer=self.layer, geom='POINT(10 10)', properties={'name': 'far'})
+        self.url = reverse('feature-list', kwargs={'layer': self.layer.pk})
+
+    def get_identifiers(self, params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        return {feature['identifier'] for feature in data.get('results', data)}
+
+    def test_bbox(self):
+        self.assertSetEqual(self.get_identifiers({'bbox': '-0.5,-0.5,1.5,1.5'}),
+                            {self.origin.identifier, self.near.identifier})
+
+    def test_intersects_within(self):
+        polygon = json.dumps({'type': 'Polygon', 'coordinates': [[[0.5, 0.5], [0.5, 20], [20, 20], [20, 0.5], [0.5, 0.5]]]})
+        self.assertSetEqual(self.get_identifiers({'intersects': polygon}), {self.near.identifier, self.far.identifier})
+        self.assertSetEqual(self.get_identifiers({'within': 'POLYGON((9 9, 9 11, 11 11, 11 9, 9 9))'}),
+                            {self.far.identifier})
+
+    def test_dwithin(self):
+        # (1, 1) is about 157 km away from (0, 0)
+        self.assertSetEqual(self.get_identifiers({'dwithin': 'POINT(0 0)', 'distance': 100000}),
+                            {self.origin.identifier})
+        self.assertSetEqual(self.get_identifiers({'dwithin': 'POINT(0 0)', 'distance': 160000}),
+                            {self.origin.identifier, self.near.identifier})
+        self.assertSetEqual(self.get_identifiers({'dwithin': 'SRID=3857;POINT(0 0)', 'distance': 160000}),
+                            {self.origin.identifier, self.near.identifier})
+
+    def test_combined_with_properties_filter(self):
+        self.assertSetEqual(self.get_identifiers({'bbox': '-0.5,-0.5,1.5,1.5', 'properties__name': 'near'}),
+                            {self.near.identifier})
+
+    @patch('geostore.views.FeatureViewSet.pagination_class', FeatureCursorPagination)
+    def test_keyset_pagination(self):
+        response = self.client.get(self.url, {'bbox': '-1,-1,11,11', 'page_size': 2})
+        data = response.json()
+        self.assertEqual(len(data['results']), 2)
+        data = self.client.get(data['next']).json()
+        self.assertListEqual([feature['identifier'] for feature in data['results']], [self.far.identifier])
+
+    def test_invalid_params(self):
+        for params in ({'bbox': '1,2,3'}, {'intersects': 'invalid'}, {'dwithin': 'POINT(0 0)'}):
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, params)
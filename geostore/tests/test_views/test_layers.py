@@ -1,24 +1,30 @@
 import json
 import factory.random
+from datetime import timedelta
 from io import BytesIO
 from tempfile import TemporaryDirectory
 from unittest import skipIf
+from unittest.mock import patch
 from zipfile import ZipFile
 
 from django.contrib.auth.models import Permission
 from django.contrib.gis.geos import GEOSGeometry
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import override_settings
 from django.urls import reverse
+from django.utils.timezone import now
+from rest_framework.pagination import PageNumberPagination
 from rest_framework.status import (HTTP_200_OK, HTTP_201_CREATED,
                                    HTTP_204_NO_CONTENT, HTTP_400_BAD_REQUEST,
-                                   HTTP_403_FORBIDDEN)
-from rest_framework.test import APITestCase
+                                   HTTP_403_FORBIDDEN, HTTP_404_NOT_FOUND)
+from rest_framework.test import APITestCase, APITransactionTestCase
 
 from geostore import GeometryTypes
 from geostore import settings as app_settings
 from geostore.import_export.helpers import get_serialized_properties
-from geostore.models import Feature, LayerGroup
+from geostore.models import Feature, Layer, LayerGroup
 from geostore.tests.factories import (FeatureFactory, LayerFactory, SuperUserFactory,
                                       UserFactory)
 from geostore.tests.utils import get_files_tests
@@ -47,6 +53,55 @@ class LayerLineIntersectionTestCase(APITestCase):
         self.assertEqual(HTTP_400_BAD_REQUEST, response.status_code)
 
 
+class LayerIntersectGeometryOutputTestCase(APITestCase):
+    def setUp(self):
+        self.layer = LayerFactory()
+        FeatureFactory(layer=self.layer, geom='POINT(1.123456 2.654321)', properties={'name': 'a', 'number': 1})
+        FeatureFactory(layer=self.layer, geom='POINT(2 2)', properties={'name': 'b', 'number': 2})
+        FeatureFactory(layer=self.layer, geom='POINT(10 10)', properties={'name': 'c', 'number': 3})
+        self.url = reverse('layer-intersects', kwargs={'pk': self.layer.pk})
+        self.user = UserFactory()
+        self.client.force_authenticate(user=self.user)
+
+    def get_features(self, response):
+        self.assertEqual(response.status_code, HTTP_200_OK)
+        return json.loads(b''.join(response.streaming_content))['results']['features']
+
+    def test_intersects_precision_srid(self):
+        response = self.client.post(f'{self.url}?precision=2', {'geom': 'POLYGON((1 2.5, 1 3, 1.5 3, 1.5 2.5, 1 2.5))'})
+        self.assertEqual(self.get_features(response)[0]['geometry']['coordinates'], [1.12, 2.65])
+
+        response = self.client.post(f'{self.url}?srid=3857&precision=0', {'geom': 'POLYGON((1 2.5, 1 3, 1.5 3, 1.5 2.5, 1 2.5))'})
+        self.assertEqual(self.get_features(response)[0]['geometry']['coordinates'], [125063.0, 295583.0])
+
+    def test_intersects_properties(self):
+        response = self.client.post(f'{self.url}?properties=name', {'geom': 'POLYGON((0 0, 0 3, 3 3, 3 0, 0 0))'})
+        self.assertEqual(sorted([feature['properties'] for feature in self.get_features(response)],
+                                key=lambda properties: properties['name']),
+                         [{'name': 'a'}, {'name': 'b'}])
+
+    @patch('geostore.settings.GEOSTORE_INTERSECTS_SUBDIVIDE_VERTICES', 8)
+    def test_intersects_subdivided_geometry(self):
+        circle = GEOSGeometry('POINT(1.5 2.5)', srid=4326).buffer(1.5, quadsegs=32)
+        response = self.client.post(self.url, {'geom': circle.ewkt})
+        self.assertEqual(len(self.get_features(response)), 2)
+
+    @patch('geostore.views.LayerViewSet.pagination_class', PageNumberPagination)
+    def test_intersects_streamed_with_pagination_class(self):
+        self.assertEqual(len(self.get_features(self.client.post(self.url, {'geom': 'POINT(2 2)'}))), 1)
+
+    @patch('geostore.views.LayerViewSet.intersects_pagination_class', PageNumberPagination)
+    @patch('rest_framework.pagination.PageNumberPagination.page_size', 1)
+    def test_intersects_paginated(self):
+        response = self.client.post(self.url, {'geom': 'POLYGON((0 0, 0 3, 3 3, 3 0, 0 0))'})
+        self.assertEqual(response.status_code, HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(data['count'], 2)
+        self.assertIsNotNone(data['next'])
+        self.assertEqual(data['request']['callbackid'], None)
+        self.assertEqual(len(data['results']['features']), 1)
+
+
 class LayerPolygonIntersectTestCase(APITestCase):
     def setUp(self):
         # from http://wiki.geojson.org/GeoJSON_draft_version_6#Polygon
@@ -105,7 +160,7 @@ class LayerPolygonIntersectTestCase(APITestCase):
             format='json',
         )
         self.assertEqual(HTTP_200_OK, response.status_code)
-        json_response = response.json()
+        json_response = json.loads(b''.join(response.streaming_content))
         self.assertEqual(
             2,
             len(json_response['results']['features'])
@@ -194,7 +249,7 @@ class LayerFeatureIntersectionTest(APITestCase):
         )
 
         self.assertEqual(HTTP_200_OK, response.status_code)
-        response = response.json().get('results', {})
+        response = json.loads(b''.join(response.streaming_content)).get('results', {})
         self.assertEqual(
             1,
             len(response.get('features'))
@@ -214,7 +269,7 @@ class LayerFeatureIntersectionTest(APITestCase):
 
         self.assertEqual(HTTP_200_OK, response.status_code)
 
-        response = response.json().get('results', {})
+        response = json.loads(b''.join(response.streaming_content)).get('results', {})
         self.assertEqual(0, len(response.get('features')))
 
         """Tests that the intersects view throw an error if geometry is
@@ -560,3 +615,262 @@ class LayerPropertyValuesTest(APITestCase):
         )
 
         self.assertEqual(HTTP_400_BAD_REQUEST, response.status_code)
+
+
+class LayerFacetsTestCase(APITestCase):
+    def setUp(self):
+        self.layer = LayerFactory()
+        FeatureFactory(layer=self.layer, geom='POINT(0 0)', properties={'country': 'France', 'type': 'city'})
+        FeatureFactory(layer=self.layer, geom='POINT(1 1)', properties={'country': 'France', 'type': 'town'})
+        FeatureFactory(layer=self.layer, geom='POINT(10 10)', properties={'country': 'Canada', 'type': 'city'})
+        self.url = reverse('layer-facets', args=[self.layer.pk])
+
+    def test_facets(self):
+        response = self.client.get(self.url, {'property': 'country,type', 'limit': 1})
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertEqual(response.json(), {
+            'country': [{'value': 'France', 'count': 2}],
+            'type': [{'value': 'city', 'count': 2}],
+        })
+
+    def test_facets_filtered(self):
+        response = self.client.get(self.url, {
+            'property': 'type',
+            'bbox': '-1,-1,2,2',
+            'properties__country': 'France',
+        })
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertEqual(response.json(), {
+            'type': [{'value': 'city', 'count': 1}, {'value': 'town', 'count': 1}],
+        })
+
+    def test_facets_cached(self):
+        cache.clear()
+        with patch.object(Layer, 'get_property_facets', autospec=True,
+                          side_effect=Layer.get_property_facets) as get_property_facets:
+            for params in ({'property': 'country'}, {'property': 'country'},
+                           {'property': 'country', 'properties__type': 'city'}):
+                response = self.client.get(self.url, params)
+                self.assertEqual(HTTP_200_OK, response.status_code)
+        # unfiltered counts are cached too
+        self.assertEqual(get_property_facets.call_count, 2)
+        self.assertIsNone(get_property_facets.call_args_list[0].kwargs['features'])
+
+    def test_facets_cache_invalidated_by_deletes(self):
+        cache.clear()
+        params = ({'property': 'country'}, {'property': 'country', 'properties__type': 'city'})
+        for param in params:
+            self.client.get(self.url, param)
+
+        # in the same second as cached facets
+        self.layer.features.filter(properties__country='Canada').delete()
+        for param, count in zip(params, (2, 1)):
+            response = self.client.get(self.url, param)
+            self.assertEqual(response.json(), {'country': [{'value': 'France', 'count': count}]})
+
+    def test_facets_invalid_params(self):
+        response = self.client.get(self.url)
+        self.assertEqual(HTTP_400_BAD_REQUEST, response.status_code)
+
+        response = self.client.get(self.url, {'property': 'type', 'limit': 0})
+        self.assertEqual(HTTP_400_BAD_REQUEST, response.status_code)
+
+
+class LayerAggregateTestCase(APITestCase):
+    def setUp(self):
+        self.layer = LayerFactory()
+        FeatureFactory(layer=self.layer, geom='POINT(0.5 0.5)', properties={'type': 'a', 'population': 10})
+        FeatureFactory(layer=self.layer, geom='POINT(0.7 0.2)', properties={'type': 'a', 'population': 30})
+        FeatureFactory(layer=self.layer, geom='POINT(1.5 0.5)', properties={'type': 'b', 'population': 'unknown'})
+        self.url = reverse('layer-aggregate', args=[self.layer.pk])
+
+    def test_aggregate_properties(self):
+        response = self.client.get(self.url, {'group_by': 'type', 'metrics': 'count,sum:population,p50:population'})
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertEqual(response.json(), {
+            'columns': ['type', 'count', 'sum:population', 'p50:population'],
+            'rows': [['a', 2, 40.0, 20.0], ['b', 1, None, None]],
+            'truncated': False,
+        })
+
+    def test_aggregate_cache_invalidated_by_deletes(self):
+        cache.clear()
+        params = {'metrics': 'count'}
+        self.assertEqual(self.client.get(self.url, params).json()['rows'], [[3]])
+
+        self.layer.features.filter(properties__type='b').delete()
+        self.assertEqual(self.client.get(self.url, params).json()['rows'], [[2]])
+
+    def test_aggregate_without_groups(self):
+        response = self.client.get(self.url, {'metrics': 'count,max:population', 'properties__type': 'a'})
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertEqual(response.json()['rows'], [[2, 30.0]])
+
+    def test_aggregate_square_bins(self):
+        response = self.client.get(self.url, {'bin': 'square', 'size': 1, 'bin_srid': 4326})
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertEqual(response.json()['rows'], [[[0.5, 0.5], 2], [[1.5, 0.5], 1]])
+
+    def test_aggregate_hexagon_bins(self):
+        response = self.client.get(self.url, {'bin': 'hexagon', 'size': 1, 'bin_srid': 4326})
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        rows = response.json()['rows']
+        self.assertEqual([count for center, count in rows], [2, 1])
+        self.assertAlmostEqual(rows[1][0][0], 3 ** 0.5)
+        self.assertAlmostEqual(rows[1][0][1], 0)
+
+    def test_aggregate_layer_bins(self):
+        areas = LayerFactory()
+        FeatureFactory(layer=areas, geom='POLYGON((0 0, 1 0, 1 1, 0 1, 0 0))', properties={'name': 'west'})
+        FeatureFactory(layer=areas, geom='POLYGON((1 0, 2 0, 2 1, 1 1, 1 0))', properties={'name': 'east'})
+        response = self.client.get(self.url, {'bin': 'layer', 'bin_layer': areas.name, 'bin_property': 'name'})
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertEqual(response.json()['rows'], [['east', 1], ['west', 2]])
+
+    def test_aggregate_invalid_params(self):
+        response = self.client.get(self.url, {'metrics': 'median:population', 'bin': 'triangle'})
+        self.assertEqual(HTTP_400_BAD_REQUEST, response.status_code)
+        self.assertEqual(set(response.json()), {'metrics', 'bin'})
+
+
+class LayerNearestTestCase(APITestCase):
+    def setUp(self):
+        self.layer = LayerFactory()
+        self.origin = FeatureFactory(layer=self.layer, geom='POINT(0 0)')
+        self.near = FeatureFactory(layer=self.layer, geom='POINT(1 1)')
+        self.far = FeatureFactory(layer=self.layer, geom='POINT(10 10)')
+        self.url = reverse('layer-nearest', args=[self.layer.pk])
+
+    def test_nearest(self):
+        response = self.client.get(self.url, {'geom': 'POINT(0.1 0.1)', 'limit': 2})
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        data = response.json()
+        self.assertListEqual([feature['identifier'] for feature in data],
+                             [self.origin.identifier, self.near.identifier])
+        # distances in meters, on the spheroid
+        self.assertAlmostEqual(data[0]['distance'], 15690, delta=10)
+        self.assertLess(data[0]['distance'], data[1]['distance'])
+
+    def test_nearest_max_distance(self):
+        response = self.client.get(self.url, {'geom': 'POINT(0.1 0.1)', 'max_distance': 100000})
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertListEqual([feature['identifier'] for feature in response.json()], [self.origin.identifier])
+
+    def test_nearest_max_distance_zero(self):
+        # only touching features, not unlimited
+        for geom, identifiers in (('POINT(0.1 0.1)', []), ('POINT(0 0)', [self.origin.identifier])):
+            response = self.client.get(self.url, {'geom': geom, 'max_distance': 0})
+            self.assertEqual(HTTP_200_OK, response.status_code)
+            self.assertListEqual([feature['identifier'] for feature in response.json()], identifiers)
+
+    def test_nearest_invalid_params(self):
+        for params in ({}, {'geom': 'POINT(0 0)', 'limit': 0}, {'geom': 'POINT(0 0)', 'max_distance': 'far'}):
+            response = self.client.get(self.url, params)
+            self.assertEqual(HTTP_400_BAD_REQUEST, response.status_code, params)
+
+    def test_group_nearest(self):
+        other_layer = LayerFactory()
+        other = FeatureFactory(layer=other_layer, geom='POINT(0.2 0.2)')
+        group = LayerGroup.objects.create(name='nearest', slug='nearest')
+        group.layers.add(self.layer, other_layer)
+
+        response = self.client.get(reverse('group-nearest', args=[group.slug]), {'geom': 'POINT(0.1 0.1)', 'limit': 3})
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertListEqual([feature['identifier'] for feature in response.json()],
+                             [self.origin.identifier, other.identifier, self.near.identifier])
+
+
+@patch('geostore.settings.GEOSTORE_CHANGES_FEED_DELAY', 0)
+class LayerChangesTestCase(APITestCase):
+    def setUp(self):
+        self.layer = LayerFactory()
+        self.first = FeatureFactory(layer=self.layer, identifier='first')
+        self.second = FeatureFactory(layer=self.layer, identifier='second')
+        self.url = reverse('layer-changes', args=[self.layer.pk])
+
+    def get_streamed_changes(self, cursor=None):
+        response = self.client.get(self.url, {'cursor': cursor} if cursor else {})
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        return json.loads(b''.join(response.streaming_content))
+
+    def test_changes_streamed(self):
+        changes = self.get_streamed_changes()
+        self.assertEqual([feature['properties']['identifier'] for feature in changes['features']], ['first', 'second'])
+        self.assertEqual(changes['deleted'], [])
+
+        self.second.properties = {'name': 'updated'}
+        self.second.save()
+        self.first.delete()
+        FeatureFactory(layer=self.layer, identifier='third')
+        self.layer.features.filter(identifier='third').delete()
+
+        changes = self.get_streamed_changes(changes['next'])
+        self.assertEqual([feature['properties']['identifier'] for feature in changes['features']], ['second'])
+        self.assertEqual([deleted['identifier'] for deleted in changes['deleted']], ['first', 'third'])
+
+        changes = self.get_streamed_changes(changes['next'])
+        self.assertEqual(changes['features'], [])
+        self.assertEqual(changes['deleted'], [])
+
+    def test_changes_paginated(self):
+        response = self.client.get(self.url, {'page_size': 1})
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        data = response.json()
+        self.assertTrue(data['has_more'])
+        self.assertEqual([feature['properties']['identifier'] for feature in data['features']], ['first'])
+
+        response = self.client.get(self.url, {'page_size': 1, 'cursor': data['next']})
+        data = response.json()
+        self.assertEqual([feature['properties']['identifier'] for feature in data['features']], ['second'])
+
+        response = self.client.get(self.url, {'page_size': 1, 'cursor': data['next']})
+        data = response.json()
+        self.assertFalse(data['has_more'])
+        self.assertEqual(data['features'], [])
+
+    def test_changes_expired_cursor(self):
+        with patch('geostore.views.mixins.now', return_value=now() - timedelta(days=31)):
+            cursor = self.get_streamed_changes()['next']
+        self.assertEqual(self.client.get(self.url, {'cursor': cursor}).status_code, HTTP_404_NOT_FOUND)
+
+        with patch('geostore.settings.GEOSTORE_TOMBSTONES_RETENTION_DAYS', None):
+            self.get_streamed_changes(cursor)
+
+    def test_changes_invalid_params(self):
+        self.assertEqual(self.client.get(self.url, {'cursor': 'invalid'}).status_code, HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(self.url, {'page_size': 0}).status_code, HTTP_400_BAD_REQUEST)
+
+
+@patch('geostore.settings.GEOSTORE_CHANGES_FEED_DELAY', 0)
+class LayerChangesOpenTransactionTestCase(APITransactionTestCase):
+    def setUp(self):
+        self.layer = LayerFactory()
+        self.url = reverse('layer-changes', args=[self.layer.pk])
+
+    def get_changed_identifiers(self, cursor=None):
+        response = self.client.get(self.url, {'cursor': cursor, 'page_size': 10} if cursor else {'page_size': 10})
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        data = response.json()
+        return [feature['properties']['identifier'] for feature in data['features']], data['next']
+
+    def test_changes_of_open_transaction_not_skipped(self):
+        other_connection = connections.create_connection(DEFAULT_DB_ALIAS)
+        try:
+            other_connection.set_autocommit(False)
+            with other_connection.cursor() as cursor:
+                # noinspection SqlResolve
+                cursor.execute(f"""
+                    INSERT INTO {Feature._meta.db_table} (geom, identifier, properties, layer_id, created_at, updated_at)
+                    VALUES (ST_SetSRID(ST_MakePoint(0, 0), %s), 'long', '{{}}', %s, %s, %s)
+                """, [app_settings.INTERNAL_GEOMETRY_SRID, self.layer.pk, now(), now()])
+            FeatureFactory(layer=self.layer, identifier='short')
+
+            # changes after the open transaction start wait for it
+            identifiers, cursor = self.get_changed_identifiers()
+            self.assertEqual(identifiers, [])
+
+            other_connection.commit()
+            identifiers, cursor = self.get_changed_identifiers(cursor)
+            self.assertEqual(identifiers, ['long', 'short'])
+        finally:
+            other_connection.close()
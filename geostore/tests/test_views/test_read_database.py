@@ -0,0 +1,118 @@
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.db import connections
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.status import HTTP_200_OK
+from rest_framework.test import APIClient
+
+from geostore.db.routers import ReadReplicaRouter, read_database
+from geostore.models import Feature, Layer
+from geostore.tests.factories import FeatureFactory, LayerFactory, SuperUserFactory
+
+
+def replicate(*instances):
+    """ Copy rows to the replica test database, as replication would do """
+    for instance in instances:
+        model = type(instance)
+        model.objects.using('replica').bulk_create([model.objects.get(pk=instance.pk)])
+
+
+def get_write_queries(queries):
+    return [query['sql'] for query in queries.captured_queries
+            if query['sql'].split(' ', 1)[0] in ('INSERT', 'UPDATE', 'DELETE')]
+
+
+@patch('geostore.settings.GEOSTORE_READ_DATABASE', 'replica')
+class ReadReplicaRouterTestCase(TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        self.layer = LayerFactory()
+        replicate(self.layer)
+        self.router = ReadReplicaRouter()
+
+    def test_read_database_context(self):
+        self.assertIsNone(self.router.db_for_read(Feature))
+        with read_database('replica'):
+            self.assertEqual(self.router.db_for_read(Feature), 'replica')
+            self.assertEqual(Layer.objects.get(pk=self.layer.pk)._state.db, 'replica')
+        self.assertIsNone(self.router.db_for_read(Feature))
+
+    def test_replica_instances_saved_to_default(self):
+        with read_database('replica'):
+            layer = Layer.objects.get(pk=self.layer.pk)
+        self.assertEqual(self.router.db_for_read(Feature, instance=layer), 'default')
+
+        layer.name = 'renamed'
+        with CaptureQueriesContext(connections['replica']) as queries:
+            layer.save()
+        self.assertEqual(layer._state.db, 'default')
+        self.assertEqual(Layer.objects.get(pk=self.layer.pk).name, 'renamed')
+        # writes land only on the primary
+        self.assertListEqual(get_write_queries(queries), [])
+        self.assertEqual(Layer.objects.using('replica').get(pk=self.layer.pk).name, self.layer.name)
+
+    def test_replica_not_migrated(self):
+        self.assertIsNone(self.router.allow_migrate('default', 'geostore'))
+        self.assertFalse(self.router.allow_migrate('replica', 'geostore'))
+
+
+@patch('geostore.settings.GEOSTORE_READ_DATABASE', 'replica')
+class ReadDatabaseViewsTestCase(TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.layer = LayerFactory()
+        self.feature = FeatureFactory(layer=self.layer, geom='POINT(1.44 43.6)', properties={'name': 'Toulouse'})
+        replicate(self.layer, self.feature)
+        self.list_url = reverse('feature-list', kwargs={'layer': self.layer.pk})
+        self.detail_url = reverse('feature-detail', kwargs={'layer': self.layer.pk,
+                                                            'identifier': self.feature.identifier})
+
+    def assertReadFromReplica(self, url, replica=True):
+        with CaptureQueriesContext(connections['replica']) as queries:
+            response = self.client.get(url)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, HTTP_200_OK)
+        self.assertEqual(bool(queries.captured_queries), replica)
+        self.assertListEqual(get_write_queries(queries), [])
+        return response
+
+    def test_features_read_from_replica(self):
+        self.assertReadFromReplica(self.list_url)
+        self.assertReadFromReplica(self.detail_url)
+
+    def test_streamed_features_read_from_replica(self):
+        self.assertReadFromReplica(reverse('feature-list', kwargs={'layer': self.layer.pk, 'format': 'geojson'}))
+
+    def test_tiles_read_from_replica(self):
+        self.assertReadFromReplica(reverse('layer-tilejson', args=[self.layer.pk]))
+        self.assertReadFromReplica(reverse('layer-tiles', kwargs={'pk': self.layer.pk, 'z': 10, 'x': 515, 'y': 373}))
+
+    def test_other_actions_read_from_default(self):
+        self.assertReadFromReplica(reverse('layer-detail', args=[self.layer.pk]), replica=False)
+
+    def test_read_from_default_after_write(self):
+        self.client.force_authenticate(SuperUserFactory())
+        with CaptureQueriesContext(connections['replica']) as queries:
+            response = self.client.patch(self.detail_url, data={'properties': {'name': 'Tolosa'}})
+        self.assertEqual(response.status_code, HTTP_200_OK)
+        self.assertListEqual(queries.captured_queries, [])
+
+        response = self.assertReadFromReplica(self.detail_url, replica=False)
+        self.assertEqual(response.json()['properties']['name'], 'Tolosa')
+
+        # replica is read again after stickiness, here without replication of the update
+        cache.clear()
+        response = self.assertReadFromReplica(self.detail_url)
+        self.assertEqual(response.json()['properties']['name'], 'Toulouse')
+
+    @patch('geostore.settings.GEOSTORE_READ_DATABASE', None)
+    def test_replica_disabled(self):
+        self.assertReadFromReplica(self.list_url, replica=False)
@@ -1,12 +1,20 @@
 import json
+import struct
+import zlib
+from datetime import timedelta
 from unittest import skipIf
+from unittest.mock import patch
 from urllib.parse import unquote, urljoin
 
+import numpy
 from django.core.management import call_command
 from django.db import connection
-from django.contrib.gis.geos import LineString
+from django.contrib.gis.db.models import GeometryField
+from django.contrib.gis.geos import LineString, Point
+from django.db.models import Value
 from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils.timezone import now
 from rest_framework import status
 from rest_framework.status import HTTP_200_OK, HTTP_404_NOT_FOUND
 from rest_framework.test import APITestCase
@@ -16,9 +24,19 @@ from geostore import settings as app_settings
 from geostore.models import Layer, LayerGroup, LayerExtraGeom, LayerRelation, FeatureExtraGeom
 from geostore.tests.factories import FeatureFactory, LayerFactory, LayerSchemaFactory
 from geostore.tests.utils import get_files_tests
+from geostore.db.functions import GridCell
+from geostore.tiles import EPSG_3857
+from geostore.tiles.grid import GridTile, get_cell_template
 from geostore.tiles.helpers import VectorTile, guess_maxzoom, guess_minzoom
 
 
+def decode_png(content):
+    """ Decode RGBA PNG generated by heatmaps, without filters """
+    width, height = struct.unpack('>II', content[16:24])
+    data = zlib.decompress(content[41:content.index(b'IEND') - 8])
+    return numpy.frombuffer(data, dtype=numpy.uint8).reshape(height, width * 4 + 1)[:, 1:].reshape(height, width, 4)
+
+
 @override_settings(CACHES={
     'default': {
         'BACKEND': ('django.core.cache.backends'
@@ -313,6 +331,93 @@ class VectorTilesTestCase(TestCase):
         )
         self.assertGreater(len(tile), 0)
 
+    def test_vector_layer_tiles_batch_view(self):
+        tile = self.client.get(
+            reverse('layer-tiles', kwargs={'pk': self.layer.pk, 'z': 10, 'x': 515, 'y': 373})).content
+        response = self.client.get(
+            reverse('layer-tiles-batch', kwargs={'pk': self.layer.pk}),
+            {'tiles': '10/515/373,10/1/1'})
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertEqual(response['Content-Type'], 'application/vnd.geostore.mvt-batch')
+        self.assertEqual(
+            response.content,
+            struct.pack('>BIII', 10, 515, 373, len(tile)) + tile + struct.pack('>BIII', 10, 1, 1, 0)
+        )
+
+    def test_vector_group_tiles_batch_view_cached(self):
+        tiles = ['10/515/373', '10/516/373', '10/515/374']
+        response = self.client.post(
+            reverse('group-tiles-batch', kwargs={'slug': self.mygroup.slug}),
+            {'tiles': tiles}, content_type='application/json')
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        original_content = response.content
+        query_count = len(connection.queries)
+
+        # all tiles are read from cache at once
+        response = self.client.post(
+            reverse('group-tiles-batch', kwargs={'slug': self.mygroup.slug}),
+            {'tiles': tiles}, content_type='application/json')
+        self.assertEqual(original_content, response.content)
+        self.assertFalse([query for query in connection.queries[query_count:] if 'ST_AsMVT' in query['sql']])
+
+    def test_vector_layer_tiles_batch_view_bbox(self):
+        response = self.client.get(
+            reverse('layer-tiles-batch', kwargs={'pk': self.layer.pk}),
+            {'bbox': '1.29,43.57,1.38,43.61', 'zoom': 10},
+            HTTP_ACCEPT='multipart/mixed')
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertTrue(response['Content-Type'].startswith('multipart/mixed; boundary='))
+        self.assertIn(b'X-Tile: 10/515/373', response.content)
+        self.assertIn(b'layerLine', response.content)
+
+    def test_vector_layer_tiles_batch_view_bad_parameters(self):
+        url = reverse('layer-tiles-batch', kwargs={'pk': self.layer.pk})
+        for params in ({}, {'tiles': '10/515'}, {'tiles': '2/5/1'}, {'tiles': 'a/b/c'}, {'tiles': '300/0/0'},
+                       {'bbox': '1.29,43.57', 'zoom': 10}, {'bbox': '1.29,43.57,1.38,43.61', 'zoom': 99}):
+            response = self.client.get(url, params)
+            self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code, params)
+
+    def test_vector_layer_tiles_batch_view_too_many_tiles(self):
+        with patch.object(app_settings, 'GEOSTORE_TILES_BATCH_MAX_TILES', 2):
+            response = self.client.get(
+                reverse('layer-tiles-batch', kwargs={'pk': self.layer.pk}),
+                {'tiles': '10/515/373,10/516/373,10/515/374'})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_vector_layer_tiles_batch_view_huge_bbox(self):
+        # world at zoom 22 has trillions of tiles, refused without listing them
+        response = self.client.get(
+            reverse('layer-tiles-batch', kwargs={'pk': self.layer.pk}),
+            {'bbox': '-180,-85,180,85', 'zoom': 22})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_vector_layer_heatmap_view(self):
+        response = self.client.get(
+            reverse('layer-heatmap', kwargs={'pk': self.layerPoint.pk, 'z': 10, 'x': 515, 'y': 373}))
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        pixels = decode_png(response.content)
+        self.assertEqual(pixels.shape, (256, 256, 4))
+        # only one pixel is coloured
+        self.assertEqual(numpy.count_nonzero(pixels[:, :, 3]), 1)
+
+        # verify counts are cached
+        query_count = len(connection.queries)
+        response = self.client.get(
+            reverse('layer-heatmap', kwargs={'pk': self.layerPoint.pk, 'z': 10, 'x': 515, 'y': 373}),
+            {'size': 512})
+        self.assertEqual(decode_png(response.content).shape, (512, 512, 4))
+        response = self.client.get(
+            reverse('layer-heatmap', kwargs={'pk': self.layerPoint.pk, 'z': 10, 'x': 515, 'y': 373}),
+            {'size': 512})
+        self.assertEqual(len([query for query in connection.queries[query_count:] if 'ST_SnapToGrid' in query['sql']]), 1)
+
+    def test_vector_group_heatmap_view_empty(self):
+        response = self.client.get(
+            reverse('group-heatmap', kwargs={'slug': self.yourgroup.slug, 'z': 10, 'x': 1, 'y': 1}))
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertFalse(decode_png(response.content)[:, :, 3].any())
+
     def test_guess_maxzoom(self):
         # guess_maxzoom returning -1 when TypeError is raised14)
         self.assertEqual(
@@ -421,3 +526,76 @@ class VectorTilesSpecialTestCase(TestCase):
         self.assertTrue(tilejson['description'] is None)
         self.assertGreater(len(tilejson['vector_layers']), 0)
         self.assertGreater(len(tilejson['vector_layers'][0]['fields']), 0)
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': ('django.core.cache.backends'
+                    '.locmem.LocMemCache')
+    }})
+class VectorTilesStaleWhileRevalidateTestCase(TestCase):
+    def setUp(self):
+        self.layer = LayerFactory(settings={'tiles': {'stale_while_revalidate': True, 'max_stale': 600}})
+        self.feature = FeatureFactory(layer=self.layer, geom='POINT(1.37 43.60)', properties={'name': 'old'})
+        self.layer.features.update(updated_at=now() - timedelta(minutes=5))
+        self.tile = VectorTile(self.layer).get_tile(515, 373, 10)
+
+    def update_feature(self):
+        self.feature.properties = {'name': 'new'}
+        self.feature.save()
+
+    @patch('geostore.tiles.helpers.execute_async_func')
+    def test_stale_tile_served_and_refreshed_once(self, mock_async_func):
+        self.update_feature()
+        self.assertEqual(VectorTile(self.layer).get_tile(515, 373, 10), self.tile)
+        self.assertEqual(VectorTile(self.layer).get_tile(515, 373, 10), self.tile)
+        mock_async_func.assert_called_once()
+
+        # background refresh stores tile for the new layer version
+        async_func, args = mock_async_func.call_args[0]
+        async_func(*args)
+        self.assertNotEqual(VectorTile(self.layer).get_tile(515, 373, 10), self.tile)
+
+    @patch('geostore.tiles.helpers.execute_async_func')
+    def test_stale_tile_too_old(self, mock_async_func):
+        self.layer.set_layer_settings('tiles', 'max_stale', 0)
+        self.layer.save()
+        self.update_feature()
+        self.layer.features.update(updated_at=now() - timedelta(minutes=1))
+        self.assertNotEqual(VectorTile(self.layer).get_tile(515, 373, 10), self.tile)
+        mock_async_func.assert_not_called()
+
+
+class GridTilesTestCase(APITestCase):
+    def setUp(self):
+        self.layer = LayerFactory(settings={'tiles': {'grid_aggregates': ['sum:population', 'p50:population']}})
+        FeatureFactory(layer=self.layer, geom='POINT(1.37 43.60)', properties={'population': 10})
+        FeatureFactory(layer=self.layer, geom='POINT(1.3701 43.6001)', properties={'population': 'unknown'})
+        FeatureFactory(layer=self.layer, geom='POINT(1.30 43.60)', properties={'population': 5})
+
+    def test_grid_tile_cells(self):
+        for shape in GridTile.SHAPES:
+            count, tile = GridTile(self.layer, shape=shape).get_tile(515, 373, 10)
+            self.assertEqual(count, 2, shape)
+            self.assertIn(b'sum:population', bytes(tile))
+
+    def test_grid_cells_are_aggregate_bins(self):
+        template = get_cell_template('hexagon', 100)
+        for x, y in ((0, 95), (80, 40), (-80, -40)):
+            point = Point(x, y, srid=EPSG_3857)
+            center = Layer.objects.annotate(
+                center=GridCell(Value(point, output_field=GeometryField(srid=EPSG_3857)), 100, shape='hexagon')
+            ).values_list('center', flat=True).first()
+            # point is in the cell drawn around the center of its aggregate bin
+            self.assertEqual([round(value) for value in center], [0, 0])
+            self.assertTrue(template.contains(point))
+
+    def test_grid_view(self):
+        url = reverse('layer-grid', kwargs={'pk': self.layer.pk, 'z': 10, 'x': 515, 'y': 373})
+        response = self.client.get(url, {'shape': 'square'})
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertEqual(response['Content-Type'], 'application/vnd.mapbox-vector-tile')
+        self.assertEqual(response.content, bytes(GridTile(self.layer, shape='square').get_tile(515, 373, 10)[1]))
+
+        response = self.client.get(url, {'shape': 'triangle'})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
@@ -1,10 +1,16 @@
-from geostore.tiles.helpers import guess_minzoom, guess_maxzoom
+from geostore.tiles.helpers import guess_minzoom, guess_maxzoom, schedule_tiles_warming
 
 
 def zoom_update(func):
     def wrapper(*args, **kargs):
         layer = args[0]
         response = func(*args, **kargs)
+        # imported features are computed in bulk
+        layer.refresh_statistics()
+        if layer.is_searchable:
+            # only features created in bulk miss their vector, others get it on save or update
+            layer.refresh_search_vectors(layer.features.filter(search_vector__isnull=True))
+        schedule_tiles_warming(layer.pk)
 
         try:
             minzoom = layer.layer_settings('tiles', 'minzoom')
@@ -0,0 +1,134 @@
+import re
+from hashlib import sha224
+from math import cos, pi, sin
+
+from django.contrib.gis.db.models.functions import Centroid, Transform
+from django.contrib.gis.geos import Polygon
+from django.db import connections
+from django.db.models import FloatField
+from django.db.models.expressions import RawSQL
+
+from . import EPSG_3857
+from .funcs import MakeEnvelope
+from .helpers import VectorTile
+from .. import settings as app_settings
+from ..db.aggregates import get_metric_aggregate
+from ..db.functions import GridCell
+from ..db.indexes import get_property_expression
+
+# Grid aggregates metrics are MVT properties names, quoted in SQL
+METRIC_PATTERN = re.compile(r'^(\w+):([^"%]+)$')
+
+
+def get_cell_template(shape, size):
+    """ Cell polygon of GridCell centered on origin: pointy-top hexagon of size circumradius, or square of size width """
+    if shape == 'hexagon':
+        coords = [(size * cos(pi / 6 + i * pi / 3), size * sin(pi / 6 + i * pi / 3)) for i in range(6)]
+        return Polygon([*coords, coords[0]], srid=EPSG_3857)
+    square = Polygon.from_bbox((-size / 2, -size / 2, size / 2, size / 2))
+    square.srid = EPSG_3857
+    return square
+
+
+class GridTile(VectorTile):
+    """
+    Vector tile of hexagon or square cells, grid_cell_pixels wide, with the count of features whose centroid
+    is in each cell and grid_aggregates metrics ("function:property") of their numeric properties.
+
+    Cells and metrics are the bins and metrics of the aggregate endpoint, computed from centroids on any PostGIS.
+    Grid tiles are never served stale, the stale tiles task rebuilds plain vector tiles.
+    """
+    SHAPES = ('hexagon', 'square')
+
+    def __init__(self, layer, cache_key=None, shape=None):
+        super().__init__(layer, cache_key)
+        self.shape = shape or self.layer.layer_settings_with_default('tiles', 'grid_shape')
+        self.cell_pixels = self.layer.layer_settings_with_default('tiles', 'grid_cell_pixels')
+        self.aggregates = [
+            metric for metric in self.layer.layer_settings_with_default('tiles', 'grid_aggregates') or []
+            if METRIC_PATTERN.match(metric) and get_metric_aggregate(metric)
+        ]
+        self.stale_while_revalidate = False
+
+    def get_tile_cache_key(self, x, y, z):
+        return sha224(
+            f'grid_{super().get_tile_cache_key(x, y, z)}_{self.shape}_{self.cell_pixels}_{",".join(self.aggregates)}'
+            .encode()
+        ).hexdigest()
+
+    def get_cell_size(self, xmin, xmax):
+        """ Cell circumradius for hexagons, width for squares, in EPSG:3857 units """
+        width = (xmax - xmin) / self.TILE_WIDTH_PIXEL * self.cell_pixels
+        return width / 2 if self.shape == 'hexagon' else width
+
+    def generate_tile(self, x, y, z, name=None, features_pks=None):
+        xmin, ymin, xmax, ymax = self.get_tile_bbox(x, y, z)
+        size = self.get_cell_size(xmin, xmax)
+
+        # cells on tile edges get all their features
+        layer_query = self.layer.features.filter(
+            geom__intersects=Transform(MakeEnvelope(xmin - 2 * size, ymin - 2 * size, xmax + 2 * size, ymax + 2 * size,
+                                                    EPSG_3857),
+                                       app_settings.INTERNAL_GEOMETRY_SRID)
+        ).annotate(
+            centroid3857=Centroid(Transform('geom', EPSG_3857)),
+            **{f'value_{i}': get_property_expression(metric.split(':', 1)[1], 'number')
+               for i, metric in enumerate(self.aggregates)}
+        )
+        layer_query = self._filter_on_property(layer_query, self.features_filter)
+        layer_query = layer_query.annotate(center=GridCell('centroid3857', size, shape=self.shape))
+        layer_raw_query, args = layer_query.query.sql_with_params()
+
+        # metrics aggregate the values computed by features query
+        compiler = layer_query.query.get_compiler(layer_query.db)
+        aggregates = ''
+        for i, metric in enumerate(self.aggregates):
+            aggregate = get_metric_aggregate(metric, RawSQL(f'value_{i}', (), output_field=FloatField()))
+            aggregate_sql, aggregate_args = compiler.compile(aggregate.resolve_expression(layer_query.query))
+            aggregates += f', {aggregate_sql} AS "{metric}"'
+            args += tuple(aggregate_args)
+        columns = ''.join(f', "{metric}"' for metric in self.aggregates)
+
+        cells_query = f'''
+            SELECT
+                ST_Translate(ST_GeomFromEWKT('{get_cell_template(self.shape, size).ewkt}'), center[1], center[2]) AS cell,
+                count(*) AS count{aggregates}
+            FROM
+                fullgeom
+            GROUP BY
+                center
+        '''
+
+        with connections[layer_query.db].cursor() as cursor:
+            sql_query = f'''
+                WITH
+                fullgeom AS ({layer_raw_query}),
+                cells AS ({cells_query}),
+                tilegeom AS (
+                    SELECT
+                        count{columns},
+                        ST_AsMvtGeom(
+                            cell,
+                            ST_MakeEnvelope({xmin}, {ymin}, {xmax}, {ymax}, {EPSG_3857}),
+                            {self.TILE_WIDTH_PIXEL * self.EXTENT_RATIO},
+                            {self.pixel_buffer * self.EXTENT_RATIO},
+                            true) AS geometry
+                    FROM
+                        cells)
+                SELECT
+                    count(*) AS count,
+                    ST_AsMVT(
+                        tilegeom,
+                        CAST(%s AS text),
+                        {self.TILE_WIDTH_PIXEL * self.EXTENT_RATIO},
+                        'geometry'
+                    ) AS mvt
+                FROM
+                    tilegeom
+                WHERE
+                    geometry IS NOT NULL
+            '''
+            cursor.execute(sql_query, args + (name if name else self.layer.name,))
+            row = cursor.fetchone()
+
+            return row[0], row[1]
@@ -0,0 +1,121 @@
+import struct
+import zlib
+from hashlib import sha224
+
+import numpy as np
+from django.contrib.gis.db.models.functions import Transform
+from django.db import connections
+
+from . import EPSG_3857
+from .funcs import MakeEnvelope
+from .helpers import VectorTile
+from .. import settings as app_settings
+
+# Heatmap colour ramp, as (intensity, RGBA) stops
+COLOR_STOPS = (
+    (0, (0, 0, 255, 0)),
+    (0.2, (0, 0, 255, 160)),
+    (0.5, (0, 255, 255, 200)),
+    (0.8, (255, 255, 0, 230)),
+    (1, (255, 0, 0, 255)),
+)
+COLOR_MAP = np.stack([
+    np.interp(np.linspace(0, 1, 256), [stop for stop, color in COLOR_STOPS], [color[i] for stop, color in COLOR_STOPS])
+    for i in range(4)
+], axis=1).round().astype(np.uint8)
+
+
+def encode_png(rgba):
+    """ Encode a (height, width, 4) uint8 array as RGBA PNG """
+    height, width, _ = rgba.shape
+    # each scanline starts with its filter type, 0 (None)
+    raw = np.hstack((np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, width * 4)))
+
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+    return b''.join((
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)),
+        chunk(b'IEND', b''),
+    ))
+
+
+def render_heatmap(counts, saturation):
+    """ Colour points count by pixel on a logarithmic scale, saturated at `saturation` points """
+    intensity = np.log1p(counts) / np.log1p(max(saturation, 1))
+    return encode_png(COLOR_MAP[(np.clip(intensity, 0, 1) * 255).astype(np.uint8)])
+
+
+class HeatmapTile(VectorTile):
+    """
+    Points count by pixel of a tile, cached as (px, py, count) int32 cells of non empty pixels.
+    Counts of many layers are summed before rendering, they are never served stale.
+    """
+    def __init__(self, layer, cache_key=None, size=256):
+        super().__init__(layer, cache_key)
+        self.size = size
+        self.stale_while_revalidate = False
+
+    def get_tile_cache_key(self, x, y, z):
+        return sha224(f'heatmap_{super().get_tile_cache_key(x, y, z)}_{self.size}'.encode()).hexdigest()
+
+    def generate_tile(self, x, y, z, name=None, features_pks=None):
+        xmin, ymin, xmax, ymax = self.get_tile_bbox(x, y, z)
+        pixel_width_x, pixel_width_y = (xmax - xmin) / self.size, (ymax - ymin) / self.size
+
+        layer_query = self.layer.features.filter(
+            geom__intersects=Transform(MakeEnvelope(xmin, ymin, xmax, ymax, EPSG_3857),
+                                       app_settings.INTERNAL_GEOMETRY_SRID)
+        ).annotate(
+            outgeom3857=Transform('geom', EPSG_3857),
+        )
+        layer_query = self._filter_on_property(layer_query, self.features_filter)
+        layer_raw_query, args = layer_query.query.sql_with_params()
+
+        # Pixel centers grid
+        xorigin, yorigin = xmin + pixel_width_x / 2, ymin + pixel_width_y / 2
+        ytop = ymax - pixel_width_y / 2
+
+        with connections[layer_query.db].cursor() as cursor:
+            sql_query = f'''
+                WITH
+                fullgeom AS ({layer_raw_query}),
+                cells AS (
+                    SELECT
+                        ST_SnapToGrid(ST_Centroid(outgeom3857),
+                                      {xorigin}, {yorigin}, {pixel_width_x}, {pixel_width_y}) AS cell
+                    FROM
+                        fullgeom),
+                pixels AS (
+                    SELECT
+                        round((ST_X(cell) - {xorigin}) / {pixel_width_x})::integer AS px,
+                        round(({ytop} - ST_Y(cell)) / {pixel_width_y})::integer AS py
+                    FROM
+                        cells)
+                SELECT
+                    px, py, count(*)
+                FROM
+                    pixels
+                WHERE
+                    px BETWEEN 0 AND {self.size - 1} AND py BETWEEN 0 AND {self.size - 1}
+                GROUP BY
+                    px, py
+            '''
+            cursor.execute(sql_query, args)
+            cells = np.array(cursor.fetchall(), dtype=np.int32).reshape(-1, 3)
+
+        return int(cells[:, 2].sum()), cells.tobytes()
+
+    @staticmethod
+    def empty_counts(size):
+        return np.zeros((size, size), dtype=np.int64)
+
+    def get_counts(self, x, y, z):
+        """ Return a (size, size) array of points count by pixel, first row on top """
+        unused, data = self.get_tile(x, y, z)
+        cells = np.frombuffer(data, dtype=np.int32).reshape(-1, 3)
+        counts = self.empty_counts(self.size)
+        counts[cells[:, 1], cells[:, 0]] = cells[:, 2]
+        return counts
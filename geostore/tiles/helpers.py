@@ -1,16 +1,20 @@
+from collections import defaultdict
 from hashlib import sha224
 from random import uniform
 
 import mercantile
 from django.contrib.gis.db.models.functions import Transform, Length
 from django.core.cache import cache
-from django.db import connection
+from django.db import connections
+from django.utils.functional import cached_property
+from django.utils.timezone import now
 from math import ceil, floor, log, pi
 
 from . import EARTH_RADIUS, EPSG_3857
 from .funcs import MakeEnvelope, SimplifyPreserveTopology, Area
 from .sigtools import SIGTools
 from .. import settings as app_settings
+from ..helpers import execute_async_func
 
 
 def get_cache_version(layer):
@@ -21,22 +25,24 @@ def get_cache_version(layer):
         return 1
 
 
+def get_cache_expiration(z):
+    # Cache expiry calculation is based on a logarithmic function where we add a random factor of +-10%
+    expiration_factor = (log(5, z) ** 0.9)
+    return int(expiration_factor * (3600 * 24 * 7) * uniform(0.9, 1.1))
+
+
 def cached_tile(func):
     def wrapper(self, x, y, z,
                 *args, **kwargs):
-        cache_key = self.get_tile_cache_key(x, y, z)
-        version = get_cache_version(self.layer)
-        expiration_factor = (log(5, z) ** 0.9)
-
-        # Cache expiry calculation is based on a logarithmic function where we add a random factor of +-10%
-        expiration = int(expiration_factor * (3600 * 24 * 7) * uniform(0.9, 1.1))
+        tile = self.get_cached_tiles([(z, x, y)], *args, **kwargs).get((z, x, y))
 
-        def build_tile():
+        if tile is None:
             (a, b) = func(
                 self, x, y, z, *args, **kwargs)
-            return a, b.tobytes()
+            tile = a, bytes(b)
+            self.set_cached_tiles({(z, x, y): tile})
 
-        return cache.get_or_set(cache_key, build_tile, expiration, version=version)
+        return tile
 
     return wrapper
 
@@ -48,10 +54,62 @@ class VectorTile(object):
         self.features_filter = self.layer.layer_settings_with_default('tiles', 'features_filter')
         self.properties_filter = self.layer.layer_settings_with_default('tiles', 'properties_filter')
         self.features_limit = self.layer.layer_settings_with_default('tiles', 'features_limit')
+        self.stale_while_revalidate = self.layer.layer_settings_with_default('tiles', 'stale_while_revalidate')
+        self.max_stale = self.layer.layer_settings_with_default('tiles', 'max_stale')
 
     # Number of tile units per pixel
     EXTENT_RATIO = 8
     TILE_WIDTH_PIXEL = 512
+    # Cache version used when tiles are stored with their own layer version, to be served stale
+    STALE_CACHE_VERSION = 0
+
+    @cached_property
+    def cache_version(self):
+        return get_cache_version(self.layer)
+
+    def get_cached_tiles(self, tiles, name=None, features_pks=None, allow_stale=True):
+        """
+        Return cached (count, tile) by (z, x, y) for requested tiles.
+
+        If the layer allows it, tiles of a previous layer version are returned while they are rebuilt
+        in background, until the layer was updated more than max_stale seconds ago.
+        """
+        cache_keys = {self.get_tile_cache_key(x, y, z): (z, x, y) for z, x, y in tiles}
+
+        if not self.stale_while_revalidate:
+            cached = cache.get_many(cache_keys.keys(), version=self.cache_version)
+            return {cache_keys[cache_key]: tile for cache_key, tile in cached.items()}
+
+        # Relation tiles are filtered on features, they are never served stale
+        serve_stale = allow_stale and features_pks is None and now().timestamp() - self.cache_version <= self.max_stale
+        results = {}
+        for cache_key, (version, *tile) in cache.get_many(cache_keys.keys(), version=self.STALE_CACHE_VERSION).items():
+            if version == self.cache_version:
+                results[cache_keys[cache_key]] = tuple(tile)
+            elif version < self.cache_version and serve_stale:
+                results[cache_keys[cache_key]] = tuple(tile)
+                self.refresh_stale_tile(cache_key, *cache_keys[cache_key], name)
+        return results
+
+    def set_cached_tiles(self, tiles):
+        """ Store (count, tile) by (z, x, y) in cache """
+        version = self.STALE_CACHE_VERSION if self.stale_while_revalidate else self.cache_version
+        tiles_by_zoom = defaultdict(dict)
+
+        for (z, x, y), tile in tiles.items():
+            tiles_by_zoom[z][self.get_tile_cache_key(x, y, z)] = (
+                (self.cache_version, *tile) if self.stale_while_revalidate else tile
+            )
+
+        for z, values in tiles_by_zoom.items():
+            cache.set_many(values, get_cache_expiration(z), version=version)
+
+    def refresh_stale_tile(self, cache_key, z, x, y, name=None):
+        """ Enqueue a stale tile rebuild, only once by tile and layer version """
+        from ..tasks import refresh_tile
+
+        if cache.add(f'{cache_key}-refresh', True, timeout=self.max_stale, version=self.cache_version):
+            execute_async_func(refresh_tile, (self.layer._meta.label, self.layer.pk, x, y, z, self.cache_key, name))
 
     def _simplify(self, layer_query, pixel_width_x, pixel_width_y):
         if self.layer.is_polygon:
@@ -109,6 +167,26 @@ class VectorTile(object):
 
     @cached_tile
     def get_tile(self, x, y, z, name=None, features_pks=None):
+        return self.generate_tile(x, y, z, name, features_pks)
+
+    def get_tiles(self, tiles, name=None, features_pks=None, allow_stale=True):
+        """
+        Return a dict of (count, tile) by (z, x, y) for all requested tiles.
+
+        Cached tiles are read at once, the missing ones are generated then stored back at once.
+        """
+        results = self.get_cached_tiles(tiles, name, features_pks, allow_stale)
+
+        generated = {}
+        for z, x, y in tiles:
+            if (z, x, y) not in results:
+                count, tile = self.generate_tile(x, y, z, name, features_pks)
+                results[(z, x, y)] = generated[(z, x, y)] = (count, bytes(tile))
+
+        self.set_cached_tiles(generated)
+        return results
+
+    def generate_tile(self, x, y, z, name=None, features_pks=None):
         xmin, ymin, xmax, ymax = self.get_tile_bbox(x, y, z)
         pixel_width_x, pixel_width_y = self.pixel_widths(xmin, ymin, xmax, ymax)
 
@@ -154,7 +232,7 @@ class VectorTile(object):
 
         properties += " || json_build_object('_id', identifier)::jsonb"
 
-        with connection.cursor() as cursor:
+        with connections[layer_query.db].cursor() as cursor:
             sql_query = f'''
                 WITH
                 fullgeom AS ({layer_raw_query}),
@@ -207,6 +285,31 @@ class VectorTile(object):
         ).hexdigest()
 
 
+def warm_hot_tiles(layer, count):
+    """
+    Generate the most requested tiles of the layer, if not already cached for its current version.
+    Return the number of warmed tiles.
+    """
+    minzoom = layer.layer_settings_with_default('tiles', 'minzoom')
+    maxzoom = layer.layer_settings_with_default('tiles', 'maxzoom')
+    tiles = list(
+        layer.tile_hits.filter(z__gte=minzoom, z__lte=maxzoom)
+        .order_by('-hits')
+        .values_list('z', 'x', 'y')[:count]
+    )
+    VectorTile(layer).get_tiles(tiles, allow_stale=False)
+    return len(tiles)
+
+
+def schedule_tiles_warming(layer_id):
+    """ Warm the most requested tiles of the layer after GEOSTORE_TILES_WARM_DELAY, once for all its updates """
+    from ..tasks import warm_layer_tiles
+
+    if app_settings.GEOSTORE_TILES_WARM_CELERY_ASYNC and cache.add(f'warm-layer-tiles-{layer_id}', True,
+                                                                   app_settings.GEOSTORE_TILES_WARM_DELAY):
+        execute_async_func(warm_layer_tiles, (layer_id,), countdown=app_settings.GEOSTORE_TILES_WARM_DELAY)
+
+
 def guess_maxzoom(layer):
     features = layer.features.all()
     layer_query = features.annotate(
@@ -216,7 +319,7 @@ def guess_maxzoom(layer):
     layer_raw_query, args = layer_query.query.sql_with_params()
 
     try:
-        with connection.cursor() as cursor:
+        with connections[layer_query.db].cursor() as cursor:
             sql_query = f'''
                 WITH
                 q1 AS ({layer_raw_query}),
@@ -1,6 +1,11 @@
+import struct
 from hashlib import sha224
+from itertools import islice
+from random import randrange
 from urllib.parse import unquote, urljoin
+from uuid import uuid4
 
+import mercantile
 from django.core.cache import cache
 from django.db.models import Q
 from django.http import HttpResponse, QueryDict
@@ -10,12 +15,16 @@ from django.utils.encoding import escape_uri_path
 from django.utils.text import slugify
 from django.utils.html import escape
 from django.utils.timezone import now
+from django.utils.translation import gettext as _
+from rest_framework import status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 
-from ..models import Feature
+from ..models import Feature, TileHit
 from .. import settings as app_settings
 from ..tokens import tiles_token_generator
+from .grid import GridTile
+from .heatmap import HeatmapTile, render_heatmap
 from .helpers import VectorTile
 
 
@@ -44,6 +53,7 @@ class AuthenticatedGroupsMixin:
 class MVTViewMixin(AuthenticatedGroupsMixin):
     tile_response_class = HttpResponse
     tile_content_type = 'application/vnd.mapbox-vector-tile'
+    tiles_batch_content_type = 'application/vnd.geostore.mvt-batch'
 
     @action(detail=True, url_path=r'tiles/\{z\}/\{x\}/\{y\}', permission_classes=[], url_name='tiles-pattern')
     def tiles_pattern(self, request, *args, **kwargs):
@@ -68,10 +78,179 @@ class MVTViewMixin(AuthenticatedGroupsMixin):
     @action(detail=True, url_name='tiles', permission_classes=[],
             url_path=r'tiles/(?P<z>[\d-]+)/(?P<x>[\d-]+)/(?P<y>[\d-]+)', )
     def tiles(self, request, z, x, y, **kwargs):
-        return self.tile_response_class(
+        response = self.tile_response_class(
             self.get_tile(int(z), int(x), int(y)),
             content_type=self.tile_content_type
         )
+        self.record_tile_hits([(int(z), int(x), int(y))])
+        return response
+
+    def record_tile_hits(self, tiles):
+        """ Record 1 out of GEOSTORE_TILES_HITS_SAMPLING requests, counting all skipped ones """
+        sampling = app_settings.GEOSTORE_TILES_HITS_SAMPLING
+        if sampling and not randrange(sampling):
+            # out of range coordinates of tiles route would fail or grow hits without limit
+            tiles = [tile for tile in tiles if self.is_valid_tile(*tile)]
+            TileHit.record([layer.pk for layer in self.layers], tiles, sampling)
+
+    @action(detail=True, methods=['get', 'post'], url_name='tiles-batch', permission_classes=[],
+            url_path='tiles/batch')
+    def tiles_batch(self, request, *args, **kwargs):
+        """
+        Return many tiles in one response, requested with a list of z/x/y or a bbox and a zoom.
+
+        Tiles are framed one after the other, each one prefixed by a big-endian header
+        (z: uint8, x: uint32, y: uint32, length: uint32), or sent as multipart/mixed parts
+        if requested by the Accept header.
+        """
+        try:
+            tiles = self.get_batch_tiles(request)
+        except (TypeError, ValueError) as error:
+            return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+
+        tiles_content = self.get_tiles(tiles)
+        self.record_tile_hits(tiles)
+
+        if 'multipart/mixed' in request.META.get('HTTP_ACCEPT', ''):
+            return self.get_tiles_multipart_response(tiles, tiles_content)
+        return self.get_tiles_framed_response(tiles, tiles_content)
+
+    def get_batch_tiles(self, request):
+        """ Parse requested tiles from ?tiles=z/x/y,z/x/y or ?bbox=w,s,e,n&zoom=z (query string or body) """
+        params = request.data if request.method == 'POST' else request.query_params
+        tiles = params.get('tiles')
+        bbox, zoom = params.get('bbox'), params.get('zoom')
+
+        if tiles:
+            if isinstance(tiles, str):
+                tiles = tiles.split(',')
+            tiles = [
+                tuple(int(c) for c in (tile.split('/') if isinstance(tile, str) else tile))
+                for tile in tiles
+            ]
+            if not all(self.is_valid_tile(*tile) for tile in tiles):
+                raise ValueError(_('Tiles must be valid z/x/y coordinates, with zoom between %(min)s and %(max)s') % {
+                    'min': app_settings.MIN_TILE_ZOOM, 'max': app_settings.MAX_TILE_ZOOM
+                })
+        elif bbox and zoom is not None:
+            if isinstance(bbox, str):
+                bbox = bbox.split(',')
+            bbox, zoom = [float(c) for c in bbox], int(zoom)
+            if len(bbox) != 4:
+                raise ValueError(_('Bbox must be formatted as west,south,east,north'))
+            if not app_settings.MIN_TILE_ZOOM <= zoom <= app_settings.MAX_TILE_ZOOM:
+                raise ValueError(_('Zoom must be between %(min)s and %(max)s') % {
+                    'min': app_settings.MIN_TILE_ZOOM, 'max': app_settings.MAX_TILE_ZOOM
+                })
+            # tiles are generated lazily, only up to the limit
+            bbox_tiles = islice(mercantile.tiles(*bbox, [zoom]), app_settings.GEOSTORE_TILES_BATCH_MAX_TILES + 1)
+            tiles = [(tile.z, tile.x, tile.y) for tile in bbox_tiles]
+        else:
+            raise ValueError(_('Provide "tiles" or "bbox" and "zoom" parameters'))
+
+        # keep requested order, without duplicates
+        tiles = list(dict.fromkeys(tiles))
+        if len(tiles) > app_settings.GEOSTORE_TILES_BATCH_MAX_TILES:
+            raise ValueError(_('Too many tiles requested, limit is %(limit)s') % {
+                'limit': app_settings.GEOSTORE_TILES_BATCH_MAX_TILES
+            })
+        return tiles
+
+    @staticmethod
+    def is_valid_tile(z, x, y):
+        return app_settings.MIN_TILE_ZOOM <= z <= app_settings.MAX_TILE_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+    def get_tiles_framed_response(self, tiles, tiles_content):
+        content = b''.join(
+            struct.pack('>BIII', z, x, y, len(tiles_content[(z, x, y)])) + tiles_content[(z, x, y)]
+            for z, x, y in tiles
+        )
+        return self.tile_response_class(content, content_type=self.tiles_batch_content_type)
+
+    def get_tiles_multipart_response(self, tiles, tiles_content):
+        boundary = uuid4().hex
+        parts = []
+        for z, x, y in tiles:
+            parts.append(
+                f'--{boundary}\r\n'
+                f'Content-Type: {self.tile_content_type}\r\n'
+                f'X-Tile: {z}/{x}/{y}\r\n\r\n'.encode() + tiles_content[(z, x, y)] + b'\r\n'
+            )
+        parts.append(f'--{boundary}--\r\n'.encode())
+        return self.tile_response_class(b''.join(parts), content_type=f'multipart/mixed; boundary={boundary}')
+
+    def get_tiles(self, tiles):
+        """
+        Return a dict of tile content by (z, x, y), resolving layers, authorizations and settings once.
+        """
+        tiles_arrays = {tile: [] for tile in tiles}
+
+        def add_tiles(vtile, tiles_to_get, name=None, features_pks=None):
+            if not tiles_to_get:
+                return
+            results = vtile.get_tiles(tiles_to_get, name, features_pks)
+            for tile in tiles_to_get:
+                tiles_arrays[tile].append(results[tile][1])
+
+        for layer in self.layers:
+            minzoom = layer.layer_settings_with_default('tiles', 'minzoom')
+            maxzoom = layer.layer_settings_with_default('tiles', 'maxzoom')
+            if self.is_authorized(layer):
+                add_tiles(VectorTile(layer), [tile for tile in tiles if minzoom <= tile[0] <= int(maxzoom)])
+
+            for extra_layer in layer.extra_geometries.all():
+                add_tiles(VectorTile(extra_layer), tiles)
+
+            for relation in layer.relations_as_origin.all():
+                add_tiles(VectorTile(relation.destination), tiles,
+                          f'relation-{slugify(layer.name)}-{slugify(relation.name)}',
+                          relation.related_features.values_list('destination', flat=True))
+
+        return {tile: b''.join(tiles_array) for tile, tiles_array in tiles_arrays.items()}
+
+    @action(detail=True, url_name='heatmap', permission_classes=[],
+            url_path=r'heatmap/(?P<z>[\d-]+)/(?P<x>[\d-]+)/(?P<y>[\d-]+)', )
+    def heatmap(self, request, z, x, y, **kwargs):
+        """ Density heatmap PNG tile of features, 256 or 512 pixels wide with ?size=512 """
+        size = 512 if request.query_params.get('size') == '512' else 256
+        return self.tile_response_class(
+            self.get_heatmap(int(z), int(x), int(y), size),
+            content_type='image/png'
+        )
+
+    def get_heatmap(self, z, x, y, size):
+        counts, saturation = HeatmapTile.empty_counts(size), 1
+        for layer in self.layers:
+            minzoom = layer.layer_settings_with_default('tiles', 'minzoom')
+            maxzoom = layer.layer_settings_with_default('tiles', 'maxzoom')
+            if minzoom <= z <= int(maxzoom) and self.is_authorized(layer):
+                counts += HeatmapTile(layer, size=size).get_counts(x, y, z)
+                saturation = max(saturation, layer.layer_settings_with_default('tiles', 'heatmap_saturation'))
+
+        return render_heatmap(counts, saturation)
+
+    @action(detail=True, url_name='grid', permission_classes=[],
+            url_path=r'grid/(?P<z>[\d-]+)/(?P<x>[\d-]+)/(?P<y>[\d-]+)', )
+    def grid(self, request, z, x, y, **kwargs):
+        """ Vector tile of features binned into grid cells, hexagons or squares with ?shape=square """
+        shape = request.query_params.get('shape')
+        if shape is not None and shape not in GridTile.SHAPES:
+            return Response({'error': _('Shape must be one of %(shapes)s') % {'shapes': ', '.join(GridTile.SHAPES)}},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return self.tile_response_class(
+            self.get_grid_tile(int(z), int(x), int(y), shape),
+            content_type=self.tile_content_type
+        )
+
+    def get_grid_tile(self, z, x, y, shape=None):
+        # grid tiles are overviews, served below layers minzoom too
+        tiles_array = []
+        for layer in self.layers:
+            if self.is_authorized(layer):
+                unused, tile = GridTile(layer, shape=shape).get_tile(x, y, z)
+                tiles_array.append(tile)
+
+        return b''.join(tiles_array)
 
     def get_tile_for_layer(self, layer, z, x, y, name=None, features_pk=None):
         tile = VectorTile(layer)
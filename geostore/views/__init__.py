@@ -1,29 +1,37 @@
 import json
+from collections import OrderedDict
 from copy import deepcopy
+from hashlib import sha224
 
 from django.contrib.gis.gdal.error import GDALException
 from django.contrib.gis.geos import GEOSException, GEOSGeometry
+from django.core.cache import cache
 from django.core.serializers import serialize
 from django.db import transaction
-from django.db.models import Q
-from django.http import HttpResponse, HttpResponseBadRequest
+from django.db.models import F, Q
+from django.db.models.fields.json import KeyTransform
+from django.db.models.functions import JSONObject
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
 from django.utils.datastructures import MultiValueDictKeyError
 from django.utils.module_loading import import_string
 from django.utils.translation import gettext as _
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.generics import get_object_or_404
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, SAFE_METHODS
 from rest_framework.renderers import JSONRenderer, BrowsableAPIRenderer
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 
 from geostore import settings as app_settings
 from geostore.renderers import KMLRenderer, GPXRenderer
-from .mixins import MultipleFieldLookupMixin
-from ..filters import JSONFieldFilterBackend, JSONFieldOrderingFilter, JSONSearchField
-from ..helpers import execute_async_func
+from .mixins import (AggregateMixin, ChangesFeedMixin, GeometryOutputMixin, MultipleFieldLookupMixin,
+                     NearestFeaturesMixin, ReadDatabaseMixin, cache_geometry_output)
+from ..filters import JSONFieldFilterBackend, JSONFieldOrderingFilter, JSONSearchField, SpatialFilterBackend
+from ..helpers import execute_async_func, stream_json_array
 from ..tasks import generate_shapefile_async, generate_geojson_async, generate_kml_async
-from ..models import Layer, LayerGroup
+from ..models import Feature, Layer, LayerGroup
 from ..permissions import FeaturePermission, LayerPermission, LayerImportExportPermission
 from ..renderers import GeoJSONRenderer
 from ..serializers import (FeatureExtraGeomSerializer, FeatureSerializer)
@@ -31,22 +39,35 @@ from ..serializers.geojson import FinalGeoJSONSerializer
 from ..tiles.mixins import MVTViewMixin, MultipleMVTViewMixin
 
 
-class LayerGroupViewsSet(MultipleMVTViewMixin, viewsets.ReadOnlyModelViewSet):
+class LayerGroupViewsSet(ReadDatabaseMixin, NearestFeaturesMixin, MultipleMVTViewMixin, viewsets.ReadOnlyModelViewSet):
     queryset = LayerGroup.objects.all()
     lookup_field = 'slug'
+    read_database_actions = ('tilejson', 'tiles', 'tiles_batch', 'heatmap', 'grid')
+
+    @action(detail=True, methods=['get'])
+    def nearest(self, request, *args, **kwargs):
+        """ Features of the group authorized layers closest to a geometry """
+        return self.get_nearest_response(Feature.objects.filter(layer__in=self.layers))
 
 
-class LayerViewSet(MultipleFieldLookupMixin, MVTViewMixin, viewsets.ModelViewSet):
+class LayerViewSet(ReadDatabaseMixin, MultipleFieldLookupMixin, GeometryOutputMixin, NearestFeaturesMixin, AggregateMixin,
+                   ChangesFeedMixin, MVTViewMixin, viewsets.ModelViewSet):
     permission_classes = (LayerPermission, )
     queryset = Layer.objects.all()
     serializer_class = import_string(app_settings.GEOSTORE_LAYER_SERIALIZER)
     lookup_fields = ('pk', 'name')
+    facets_default_limit = 10
+    facets_max_limit = 100
+    # intersects features are paginated with this class if set, streamed otherwise
+    intersects_pagination_class = None
+    read_database_actions = ('tilejson', 'tiles', 'tiles_batch', 'heatmap', 'grid', 'shapefile', 'geojson', 'kml',
+                             'facets')
 
     def post_shapefile_sync(self, request, layer):
         try:
             shape_file = request.FILES['shapefile']
             with transaction.atomic():
-                layer.features.all().delete()
+                layer.clear_features()
                 layer.from_shapefile(shape_file)
                 response = Response(status=status.HTTP_200_OK)
 
@@ -104,8 +125,16 @@ class LayerViewSet(MultipleFieldLookupMixin, MVTViewMixin, viewsets.ModelViewSet
             return Response({"error": _("Your user has no mail address.")},
                             status=status.HTTP_406_NOT_ACCEPTABLE)
 
+    def get_geometry_output_layer(self):
+        return self.get_object()
+
     @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
+    @cache_geometry_output
     def intersects(self, request, *args, **kwargs):
+        """
+        Layer features intersecting the posted geometry, rendered by PostgreSQL.
+        Streamed unless `intersects_pagination_class` is set, only `properties` (comma separated) are returned if set.
+        """
         layer = self.get_object()
         callbackid = self.request.data.get('callbackid', None)
 
@@ -115,19 +144,41 @@ class LayerViewSet(MultipleFieldLookupMixin, MVTViewMixin, viewsets.ModelViewSet
             return HttpResponseBadRequest(
                 content=_('Geometry is not valid'))
 
-        response = {
-            'request': {
-                'callbackid': callbackid,
-                'geom': geometry.json,
-            },
-            'results': json.loads(serialize('geojson',
-                                            layer.features.intersects(geometry),
-                                            fields=('properties',),
-                                            geometry_field='geom',
-                                            properties_field='properties')),
+        params = dict(self.get_geometry_output_params())
+        if params.get('srid', 4326) != app_settings.INTERNAL_GEOMETRY_SRID:
+            params.setdefault('srid', 4326)
+        queryset = layer.features.intersects(geometry, max_vertices=app_settings.GEOSTORE_INTERSECTS_SUBDIVIDE_VERTICES)
+        if params:
+            queryset = queryset.with_output_geometry(**params)
+
+        properties = None
+        if request.query_params.get('properties'):
+            properties = JSONObject(**{name: KeyTransform(name, 'properties')
+                                       for name in request.query_params['properties'].split(',')})
+        queryset = queryset.annotate_geojson(properties=properties,
+                                             geometry='output_geom' if params else 'geom',
+                                             precision=params.get('precision', 8))
+
+        request_data = {
+            'callbackid': callbackid,
+            'geom': geometry.json,
         }
-
-        return Response(response)
+        crs = {'type': 'name', 'properties': {'name': f"EPSG:{params.get('srid', 4326)}"}}
+        if self.intersects_pagination_class is not None:
+            paginator = self.intersects_pagination_class()
+            page = paginator.paginate_queryset(queryset.only('pk'), request, view=self)
+            response = paginator.get_paginated_response({
+                'type': 'FeatureCollection',
+                'crs': crs,
+                'features': [json.loads(feature.geojson) for feature in page],
+            })
+            response.data = OrderedDict([('request', request_data), *response.data.items()])
+            return response
+
+        rows = queryset.values_list('geojson', flat=True).iterator(chunk_size=app_settings.GEOSTORE_GEOJSON_CHUNK_SIZE)
+        prefix = f'{{"request": {json.dumps(request_data)}, ' \
+                 f'"results": {{"type": "FeatureCollection", "crs": {json.dumps(crs)}, "features": ['
+        return StreamingHttpResponse(stream_json_array(rows, prefix, ']}}'), content_type='application/json')
 
     def partial_update(self, request, *args, **kwargs):
         layer = self.get_object()
@@ -148,6 +199,11 @@ class LayerViewSet(MultipleFieldLookupMixin, MVTViewMixin, viewsets.ModelViewSet
         else:
             return HttpResponseBadRequest(_('Features are missing in GeoJSON'))
 
+    @action(detail=True, methods=['get'])
+    def nearest(self, request, *args, **kwargs):
+        """ Layer features closest to a geometry """
+        return self.get_nearest_response(self.get_object().features.all())
+
     @action(detail=True, methods=['get'])
     def property_values(self, request, *args, **kwargs):
         """
@@ -168,6 +224,54 @@ class LayerViewSet(MultipleFieldLookupMixin, MVTViewMixin, viewsets.ModelViewSet
 
         return Response(result)
 
+    @action(detail=True, methods=['get'])
+    def facets(self, request, *args, **kwargs):
+        """
+          Most frequent values of "property" GET params (repeated or comma separated) with their
+          count, "limit" values by property. Features can be filtered by properties and geometry,
+          counts are cached until the layer features are updated.
+        """
+        properties = [prop for value in request.query_params.getlist('property')
+                      for prop in value.split(',') if prop]
+        if not properties:
+            return Response({'error': _('Invalid "property" GET parameter')},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            limit = int(request.query_params.get('limit', self.facets_default_limit))
+            if not 0 < limit <= self.facets_max_limit:
+                raise ValueError
+        except ValueError:
+            raise ValidationError({'limit': _('Limit should be an integer between 1 and %s') % self.facets_max_limit})
+
+        layer = self.get_object()
+        cache_key = sha224(f"facets-{layer.pk}-{request.build_absolute_uri()}".encode()).hexdigest()
+        # changed by deletes and updates too
+        version = layer.get_features_version()
+        facets = cache.get(cache_key, version=version)
+        if facets is None:
+            features = layer.features.all()
+            backends = [backend() for backend in (JSONFieldFilterBackend, SpatialFilterBackend)]
+            if any(backend.is_filtered(request, features) for backend in backends):
+                for backend in backends:
+                    features = backend.filter_queryset(request, features, self)
+            else:
+                # counts of all features are read from layer statistics, or grouped if not maintained
+                features = None
+            facets = layer.get_property_facets(properties, limit, features=features)
+            cache.set(cache_key, facets, version=version)
+        return Response(facets)
+
+    @action(detail=True, methods=['get'])
+    def aggregate(self, request, *args, **kwargs):
+        """ Layer features grouped by properties or bins, with their statistics """
+        return self.get_aggregate_response(self.get_object())
+
+    @action(detail=True, methods=['get'])
+    def changes(self, request, *args, **kwargs):
+        """ Layer features created, updated or deleted after a cursor """
+        return self.get_changes_response(self.get_object())
+
     @action(detail=True, methods=['get'], renderer_classes=[JSONRenderer])
     def extent(self, request, *args, **kwargs):
         """ Returns the extent of the layer."""
@@ -178,15 +282,18 @@ class LayerViewSet(MultipleFieldLookupMixin, MVTViewMixin, viewsets.ModelViewSet
         return Response(extent)
 
 
-class FeatureViewSet(viewsets.ModelViewSet):
+class FeatureViewSet(ReadDatabaseMixin, GeometryOutputMixin, viewsets.ModelViewSet):
     permission_classes = (FeaturePermission, )
     serializer_class = FeatureSerializer
     serializer_class_extra_geom = FeatureExtraGeomSerializer
     renderer_classes = (JSONRenderer, GeoJSONRenderer, BrowsableAPIRenderer, KMLRenderer, GPXRenderer)
-    filter_backends = (JSONFieldFilterBackend, JSONFieldOrderingFilter, JSONSearchField)
+    filter_backends = (JSONFieldFilterBackend, SpatialFilterBackend, JSONFieldOrderingFilter, JSONSearchField)
     filter_fields = ('properties', )
     ordering_fields = ('id', 'identifier', 'created_at', 'updated_at')
     lookup_field = 'identifier'
+    pagination_class = (import_string(app_settings.GEOSTORE_FEATURE_PAGINATION_CLASS)
+                        if app_settings.GEOSTORE_FEATURE_PAGINATION_CLASS else api_settings.DEFAULT_PAGINATION_CLASS)
+    read_database_actions = ('list', 'retrieve')
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -220,15 +327,61 @@ class FeatureViewSet(viewsets.ModelViewSet):
         """
         context = super().get_serializer_context()
         layer = self.get_layer()
-        context.update({'layer_pk': layer.pk})
+        context.update({'layer_pk': layer.pk, 'layer': layer})
         return context
 
+    def get_geometry_output_layer(self):
+        return self.get_layer()
+
     def get_queryset(self):
         layer = self.get_layer()
         qs = layer.features.all()
-        qs = qs.prefetch_related('layer__relations_as_origin')
+        if self.request.method in SAFE_METHODS:
+            qs = self.get_geometry_output_queryset(qs)
         return qs
 
+    @cache_geometry_output
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    @cache_geometry_output
+    def list(self, request, *args, **kwargs):
+        if request.accepted_renderer.format == 'geojson' and app_settings.GEOSTORE_GEOJSON_DB_RENDERING \
+                and self.serializer_class is FeatureSerializer:
+            return self.list_geojson()
+        return super().list(request, *args, **kwargs)
+
+    def list_geojson(self):
+        """
+        GeoJSON features rendered by PostgreSQL. Without pagination, the collection is streamed
+        from a server-side cursor, so memory does not grow with the layer size.
+        """
+        serializer = self.get_serializer()
+        url_templates = serializer.get_url_templates(self.get_layer().pk)
+        params = self.get_geometry_output_params()
+        queryset = self.filter_queryset(self.get_queryset()).annotate_geojson(
+            extra_properties={'identifier': F('identifier'), 'layer': F('layer_id'), **url_templates},
+            geometry='output_geom' if params else 'geom',
+            precision=params.get('precision', 8),
+        )
+
+        page = self.paginate_queryset(queryset.only('pk', 'identifier'))
+        if page is not None:
+            return self.get_paginated_response({
+                'type': 'FeatureCollection',
+                'features': [json.loads(serializer.format_url(feature.geojson, feature.identifier))
+                             for feature in page],
+            })
+
+        rows = queryset.values_list('geojson', 'identifier').iterator(
+            chunk_size=app_settings.GEOSTORE_GEOJSON_CHUNK_SIZE
+        )
+        features = (serializer.format_url(geojson, identifier) for geojson, identifier in rows)
+        return StreamingHttpResponse(
+            stream_json_array(features, '{"type": "FeatureCollection", "features": [', ']}'),
+            content_type='application/json'
+        )
+
     def perform_create(self, serializer):
         layer = self.get_layer()
         serializer.save(layer_id=layer.pk)
@@ -295,7 +448,7 @@ class FeatureViewSet(viewsets.ModelViewSet):
         feature = self.get_object()
         layer_relation = get_object_or_404(feature.layer.relations_as_origin.all(),
                                            pk=kwargs.get('id_relation'))
-        qs = feature.get_stored_relation_qs(layer_relation)
+        qs = self.get_geometry_output_queryset(feature.get_stored_relation_qs(layer_relation))
         # keep original viewset filtering
         qs = self.filter_queryset(qs)
         # keep original viewset pagination
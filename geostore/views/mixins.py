@@ -1,5 +1,34 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from contextlib import ExitStack
+from datetime import timedelta
+from functools import wraps
+from hashlib import sha224
+
+from django.contrib.gis.db.models import GeometryField
+from django.contrib.gis.db.models.functions import Centroid, Transform
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
-from django.http import Http404
+from django.db import connection
+from django.db.models import Count, F, Func, OuterRef, Q, Subquery
+from django.db.models.fields.json import KeyTransform
+from django.http import Http404, StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import now
+from django.utils.translation import gettext as _
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
+
+from geostore import settings as app_settings
+from ..db.aggregates import get_metric_aggregate
+from ..db.functions import GridCell
+from ..db.routers import read_database
+from ..filters import JSONFieldFilterBackend, SpatialFilterBackend
+from ..helpers import stream_json_array
+from ..models import FeatureTombstone
+from ..serializers import NearestFeatureSerializer
+from ..tiles.helpers import get_cache_version
 
 
 class MultipleFieldLookupMixin(object):
@@ -23,3 +52,430 @@ class MultipleFieldLookupMixin(object):
                 self.check_object_permissions(self.request, obj)
                 return obj
         raise Http404
+
+
+class GeometryOutputMixin:
+    """
+    Geometries of returned features transformed, simplified and rounded in database,
+    following `srid`, `simplify` (tolerance in srid units) and `precision` (decimals) query parameters.
+    """
+    precision_query_param = 'precision'
+    simplify_query_param = 'simplify'
+    srid_query_param = 'srid'
+    max_precision = 15
+    geometry_output_params = None
+
+    def get_geometry_output_params(self):
+        """ Validated output geometry parameters, as FeatureQuerySet.with_output_geometry keyword arguments """
+        if self.geometry_output_params is None:
+            query_params = self.request.query_params
+            params, errors = {}, {}
+
+            precision = query_params.get(self.precision_query_param)
+            if precision:
+                try:
+                    params['precision'] = int(precision)
+                    if not 0 <= params['precision'] <= self.max_precision:
+                        raise ValueError
+                except ValueError:
+                    errors[self.precision_query_param] = _('Precision should be an integer between 0 and %s') % self.max_precision
+
+            tolerance = query_params.get(self.simplify_query_param)
+            if tolerance:
+                try:
+                    params['tolerance'] = float(tolerance)
+                    if not 0 <= params['tolerance'] < float('inf'):
+                        raise ValueError
+                except ValueError:
+                    errors[self.simplify_query_param] = _('Simplification tolerance should be a positive number')
+
+            srid = query_params.get(self.srid_query_param)
+            if srid:
+                SpatialRefSys = connection.ops.spatial_ref_sys()
+                try:
+                    params['srid'] = int(srid)
+                    if not SpatialRefSys.objects.filter(srid=params['srid']).exists():
+                        raise ValueError
+                except ValueError:
+                    errors[self.srid_query_param] = _('Unknown SRID')
+
+            if errors:
+                raise ValidationError(errors)
+            self.geometry_output_params = params
+        return self.geometry_output_params
+
+    def get_geometry_output_queryset(self, queryset):
+        params = self.get_geometry_output_params()
+        if not params:
+            return queryset
+        return queryset.with_output_geometry(**params)
+
+    def get_geometry_output_layer(self):
+        """ Layer whose version is used to cache responses """
+        raise NotImplementedError
+
+
+def cache_geometry_output(view_func):
+    """
+    Cache responses of GeometryOutputMixin views requested with output geometry parameters,
+    by request and layer version. Object permissions are still checked for detail views.
+    """
+    @wraps(view_func)
+    def wrapper(self, request, *args, **kwargs):
+        if not self.get_geometry_output_params():
+            return view_func(self, request, *args, **kwargs)
+
+        layer = self.get_geometry_output_layer()
+        cache_key = sha224(
+            f"geometry-output-{layer.pk}-{request.accepted_renderer.format}-{request.build_absolute_uri()}"
+            f"-{json.dumps(request.data, sort_keys=True, default=str)}".encode()
+        ).hexdigest()
+        version = get_cache_version(layer)
+        data = cache.get(cache_key, version=version)
+
+        if data is None:
+            response = view_func(self, request, *args, **kwargs)
+            if isinstance(response, Response) and response.status_code == 200:
+                cache.set(cache_key, response.data, version=version)
+            return response
+
+        if self.detail:
+            self.get_object()
+        return Response(data)
+    return wrapper
+
+
+class NearestFeaturesMixin:
+    """
+    Features closest to `geom` query parameter (GeoJSON, WKT or EWKT), with their distance in meters.
+    `limit` features are returned, at most at `max_distance` meters if set.
+    """
+    geometry_query_param = 'geom'
+    limit_query_param = 'limit'
+    max_distance_query_param = 'max_distance'
+    default_limit = 10
+    max_limit = 100
+
+    def get_nearest_response(self, features):
+        params = self.request.query_params
+        geometry = SpatialFilterBackend.get_geometry(self.geometry_query_param, params.get(self.geometry_query_param))
+
+        errors = {}
+        try:
+            limit = int(params.get(self.limit_query_param, self.default_limit))
+            if not 0 < limit <= self.max_limit:
+                raise ValueError
+        except ValueError:
+            errors[self.limit_query_param] = _('Limit should be an integer between 1 and %s') % self.max_limit
+
+        max_distance = params.get(self.max_distance_query_param) or None
+        if max_distance is not None:
+            try:
+                max_distance = float(max_distance)
+                if not 0 <= max_distance < float('inf'):
+                    raise ValueError
+            except ValueError:
+                errors[self.max_distance_query_param] = _('Maximum distance in meters should be a positive number')
+        if errors:
+            raise ValidationError(errors)
+
+        queryset = features.nearest(geometry, limit, max_distance=max_distance)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = NearestFeatureSerializer(page, many=True, context=self.get_serializer_context())
+            return self.get_paginated_response(serializer.data)
+        serializer = NearestFeatureSerializer(queryset, many=True, context=self.get_serializer_context())
+        return Response(serializer.data)
+
+
+class AggregateMixin:
+    """
+    Features grouped by `group_by` properties and by `bin`, with `metrics` computed by PostgreSQL.
+
+    * group_by=country,type : property names
+    * metrics=count,sum:population,avg:population,min:age,max:age,p90:population : count and
+      property statistics, non numeric values are ignored
+    * bin=square|hexagon&size=<bin_srid units>&bin_srid=3857 : grid cells, as their [x, y] center
+    * bin=layer&bin_layer=<pk or name>&bin_property=name : polygons of another layer containing features,
+      as the property value (identifier by default)
+
+    Features can be filtered with properties and spatial filters.
+    Results are columns and rows, cached until the layer features are updated.
+    """
+    bin_shapes = ('square', 'hexagon')
+    default_bin_srid = 3857
+
+    def get_aggregate_groups(self, params, errors):
+        groups = {}
+        for prop in params.get('group_by', '').split(','):
+            if prop:
+                groups[prop] = KeyTransform(prop, 'properties')
+
+        shape = params.get('bin')
+        if shape in self.bin_shapes:
+            try:
+                size = float(params.get('size', ''))
+                if not 0 < size < float('inf'):
+                    raise ValueError
+            except ValueError:
+                errors['size'] = _('Bin size should be a positive number')
+            try:
+                srid = int(params.get('bin_srid', self.default_bin_srid))
+                if not connection.ops.spatial_ref_sys().objects.filter(srid=srid).exists():
+                    raise ValueError
+            except ValueError:
+                errors['bin_srid'] = _('Unknown SRID')
+            if 'size' not in errors and 'bin_srid' not in errors:
+                groups['bin'] = GridCell(Transform(Centroid('geom'), srid), size, shape=shape)
+
+        elif shape == 'layer':
+            bin_layer = self.get_aggregate_bin_layer(params.get('bin_layer'))
+            if bin_layer is None:
+                errors['bin_layer'] = _('Unknown layer')
+            else:
+                bin_property = params.get('bin_property')
+                # GeoFunc can not resolve an outer reference
+                point = Func(OuterRef('geom'), function='ST_POINTONSURFACE',
+                             output_field=GeometryField(srid=app_settings.INTERNAL_GEOMETRY_SRID))
+                bins = bin_layer.features.filter(geom__intersects=point).order_by('pk')
+                bins = bins.annotate(bin=KeyTransform(bin_property, 'properties')) if bin_property \
+                    else bins.annotate(bin=F('identifier'))
+                groups['bin'] = Subquery(bins.values('bin')[:1])
+
+        elif shape:
+            errors['bin'] = _('Bin should be one of %s') % ', '.join((*self.bin_shapes, 'layer'))
+        return groups
+
+    def get_aggregate_bin_layer(self, value):
+        """ Layer whose polygons are used as bins, by pk or name """
+        Layer = self.get_queryset().model
+        query = Q(name=value)
+        if value and value.isdigit():
+            query |= Q(pk=value)
+        return Layer.objects.filter(query).first() if value else None
+
+    def get_aggregate_metrics(self, params, errors):
+        metrics = {}
+        for metric in params.get('metrics', 'count').split(','):
+            if metric == 'count':
+                metrics[metric] = Count('pk')
+                continue
+
+            aggregate = get_metric_aggregate(metric)
+            if aggregate is None:
+                errors['metrics'] = _('Invalid metric %s') % metric
+            else:
+                metrics[metric] = aggregate
+        return metrics
+
+    def get_aggregate_response(self, layer):
+        params = self.request.query_params
+        cache_key = sha224(f"aggregate-{layer.pk}-{self.request.build_absolute_uri()}".encode()).hexdigest()
+        version = layer.get_features_version()
+        data = cache.get(cache_key, version=version)
+        if data is not None:
+            return Response(data)
+
+        errors = {}
+        groups = self.get_aggregate_groups(params, errors)
+        metrics = self.get_aggregate_metrics(params, errors)
+        if errors:
+            raise ValidationError(errors)
+
+        features = layer.features.all()
+        for backend in (JSONFieldFilterBackend, SpatialFilterBackend):
+            features = backend().filter_queryset(self.request, features, self)
+
+        columns = [*groups, *metrics]
+        max_groups = app_settings.GEOSTORE_AGGREGATE_MAX_GROUPS
+        if groups:
+            # columns are aliased, so they can not clash with features fields
+            aliases = {column: f'column_{i}' for i, column in enumerate(columns)}
+            rows = features.order_by().annotate(**{aliases[name]: expression for name, expression in groups.items()}) \
+                .values(*[aliases[name] for name in groups]) \
+                .annotate(**{aliases[name]: expression for name, expression in metrics.items()}) \
+                .order_by(*[aliases[name] for name in groups]) \
+                .values_list(*aliases.values())
+            rows = [list(row) for row in rows[:max_groups + 1]]
+        else:
+            aggregates = features.aggregate(**{f'column_{i}': expression for i, expression in enumerate(metrics.values())})
+            rows = [[aggregates[f'column_{i}'] for i in range(len(metrics))]]
+
+        data = {
+            'columns': columns,
+            'rows': rows[:max_groups],
+            'truncated': len(rows) > max_groups,
+        }
+        cache.set(cache_key, data, version=version)
+        return Response(data)
+
+
+class ChangesFeedMixin:
+    """
+    Layer features created or updated, and deleted, after a `cursor`, following their updated_at / deleted_at.
+    Changes of the last GEOSTORE_CHANGES_FEED_DELAY seconds, and changes since the start of the oldest open
+    transaction, are returned on next requests, so rows of transactions committed meanwhile are not skipped.
+
+    Returned as a GeoJSON FeatureCollection with `deleted` features and a `next` cursor. With `page_size`,
+    at most page_size features and deletions are returned, and `has_more` tells if next cursor has more
+    changes yet. Without it, all changes are streamed. Cursors older than GEOSTORE_TOMBSTONES_RETENTION_DAYS
+    are expired.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    max_page_size = 10000
+
+    def decode_changes_cursor(self):
+        """ Positions (timestamp, id) of features and deletions already returned, None at the beginning """
+        encoded = self.request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, None
+
+        try:
+            cursor = json.loads(urlsafe_b64decode(encoded.encode('ascii')))
+            return tuple(
+                (parse_datetime(cursor[key][0]), cursor[key][1]) if cursor[key] else None
+                for key in ('features', 'deleted')
+            )
+        except (TypeError, ValueError, KeyError, IndexError, UnicodeError):
+            raise NotFound(_('Invalid cursor'))
+
+    @staticmethod
+    def encode_changes_cursor(features_position, deleted_position):
+        cursor = {
+            key: [position[0].isoformat(), position[1]] if position else None
+            for key, position in (('features', features_position), ('deleted', deleted_position))
+        }
+        return urlsafe_b64encode(json.dumps(cursor).encode()).decode('ascii')
+
+    @staticmethod
+    def get_after_position(field, position):
+        """ Rows after a (timestamp, id) position, or after the timestamp if id is None """
+        if position is None:
+            return Q()
+        timestamp, pk = position
+        if pk is None:
+            return Q(**{f'{field}__gt': timestamp})
+        return Q(**{f'{field}__gt': timestamp}) | Q(**{field: timestamp, 'pk__gt': pk})
+
+    @staticmethod
+    def get_changes_until():
+        """
+        End of the returned changes window. Timestamps are set on write, not on commit, so rows of
+        transactions still open may be committed later with timestamps older than now.
+        """
+        until = now() - timedelta(seconds=app_settings.GEOSTORE_CHANGES_FEED_DELAY)
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT MIN(xact_start) FROM pg_stat_activity
+                WHERE datname = current_database() AND backend_type = 'client backend'
+                AND state <> 'idle' AND pid <> pg_backend_pid()
+            """)
+            oldest_transaction_start = cursor.fetchone()[0]
+        if oldest_transaction_start is not None:
+            until = min(until, oldest_transaction_start - timedelta(microseconds=1))
+        return until
+
+    def get_changes_page_size(self):
+        page_size = self.request.query_params.get(self.page_size_query_param)
+        if not page_size:
+            return None
+        try:
+            page_size = int(page_size)
+            if not 0 < page_size <= self.max_page_size:
+                raise ValueError
+        except ValueError:
+            raise ValidationError({self.page_size_query_param: _('Page size should be an integer between 1 and %s')
+                                   % self.max_page_size})
+        return page_size
+
+    def get_changes_response(self, layer):
+        features_position, deleted_position = self.decode_changes_cursor()
+        retention_limit = FeatureTombstone.get_retention_limit()
+        if deleted_position is not None and retention_limit is not None and deleted_position[0] < retention_limit:
+            # deletions may have been purged since, clients sync the layer again without cursor
+            raise NotFound(_('Expired cursor'))
+        page_size = self.get_changes_page_size()
+        until = self.get_changes_until()
+
+        params = self.get_geometry_output_params()
+        features = self.get_geometry_output_queryset(
+            layer.features.filter(self.get_after_position('updated_at', features_position), updated_at__lte=until)
+        ).annotate_geojson(
+            extra_properties={'identifier': F('identifier'), 'updated_at': F('updated_at')},
+            geometry='output_geom' if params else 'geom',
+            precision=params.get('precision', 8),
+        ).order_by('updated_at', 'pk').values_list('geojson', 'updated_at', 'pk')
+        deleted = layer.tombstones.filter(
+            self.get_after_position('deleted_at', deleted_position), deleted_at__lte=until
+        ).order_by('deleted_at', 'pk').values_list('identifier', 'deleted_at', 'pk')
+
+        if page_size is None:
+            deleted = [{'identifier': identifier, 'deleted_at': deleted_at.isoformat()}
+                       for identifier, deleted_at, pk in deleted]
+            prefix = (f'{{"type": "FeatureCollection", '
+                      f'"next": "{self.encode_changes_cursor((until, None), (until, None))}", "has_more": false, '
+                      f'"deleted": {json.dumps(deleted)}, "features": [')
+            rows = (geojson for geojson, updated_at, pk in
+                    features.iterator(chunk_size=app_settings.GEOSTORE_GEOJSON_CHUNK_SIZE))
+            return StreamingHttpResponse(stream_json_array(rows, prefix, ']}'), content_type='application/json')
+
+        features, deleted = list(features[:page_size + 1]), list(deleted[:page_size + 1])
+        has_more = len(features) > page_size or len(deleted) > page_size
+        features, deleted = features[:page_size], deleted[:page_size]
+        # all changes until the window end are returned when a list is not full
+        features_position = features[-1][1:] if len(features) == page_size else (until, None)
+        deleted_position = deleted[-1][1:] if len(deleted) == page_size else (until, None)
+
+        return Response({
+            'type': 'FeatureCollection',
+            'next': self.encode_changes_cursor(features_position, deleted_position),
+            'has_more': has_more,
+            'deleted': [{'identifier': identifier, 'deleted_at': deleted_at.isoformat()}
+                        for identifier, deleted_at, pk in deleted],
+            'features': [json.loads(geojson) for geojson, updated_at, pk in features],
+        })
+
+
+class ReadDatabaseMixin:
+    """
+    Read from the GEOSTORE_READ_DATABASE replica in read_database_actions requested with safe methods.
+    After their successful writes, users read from the default database for GEOSTORE_READ_DATABASE_STICKINESS
+    seconds, so they get their own changes. Views choose their actions, or override use_read_database().
+    """
+    read_database_actions = ()
+
+    @staticmethod
+    def get_read_database_stickiness_key(user):
+        return f'geostore-read-primary-{user.pk}'
+
+    def use_read_database(self, request):
+        if not app_settings.GEOSTORE_READ_DATABASE or request.method not in SAFE_METHODS \
+                or self.action not in self.read_database_actions:
+            return False
+        return not request.user.is_authenticated or not cache.get(self.get_read_database_stickiness_key(request.user))
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if self.use_read_database(request):
+            self.read_database_context = ExitStack()
+            self.read_database_context.enter_context(read_database(app_settings.GEOSTORE_READ_DATABASE))
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        context = getattr(self, 'read_database_context', None)
+        if context is not None:
+            context.close()
+            if response.streaming:
+                response.streaming_content = self.stream_from_read_database(response.streaming_content)
+        elif request.method not in SAFE_METHODS and response.status_code < 400 and request.user.is_authenticated \
+                and app_settings.GEOSTORE_READ_DATABASE and app_settings.GEOSTORE_READ_DATABASE_STICKINESS:
+            cache.set(self.get_read_database_stickiness_key(request.user), True,
+                      app_settings.GEOSTORE_READ_DATABASE_STICKINESS)
+        return response
+
+    @staticmethod
+    def stream_from_read_database(content):
+        """ Streamed querysets are evaluated after the view, keep reading them from the replica """
+        with read_database(app_settings.GEOSTORE_READ_DATABASE):
+            yield from content
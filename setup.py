@@ -52,6 +52,7 @@ setup(
         "Fiona>=1.9",
         "jsonschema",
         "celery",
+        "numpy",
     ],
     tests_require=test_require,
     extras_require={
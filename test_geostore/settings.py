@@ -90,9 +90,23 @@ DATABASES = {
         'NAME': 'travis_ci_test',
         'PASSWORD': 'travis_ci_test',
         'HOST': os.getenv('POSTGRES_HOST', '127.0.0.1')
-    }
+    },
+    # read replica of default database, enabled in tests with GEOSTORE_READ_DATABASE.
+    # Its test database is a distinct one, where tests copy replicated rows
+    'replica': {
+        'ENGINE': 'django.contrib.gis.db.backends.postgis',
+        'USER': 'travis_ci_test',
+        'NAME': 'travis_ci_test',
+        'PASSWORD': 'travis_ci_test',
+        'HOST': os.getenv('POSTGRES_HOST', '127.0.0.1'),
+        'TEST': {
+            'NAME': 'test_travis_ci_test_replica',
+        },
+    },
 }
 
+DATABASE_ROUTERS = ['geostore.db.routers.ReadReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators